@@ -1,57 +1,128 @@
 import os
 from dotenv import load_dotenv
 
-from flask import Flask, jsonify, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from flask import Blueprint, Flask, current_app, jsonify, render_template, request, flash, redirect, session, g, abort, make_response
+from flask_wtf.csrf import CSRFProtect
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.exc import IntegrityError
 
+from caching import (
+    cache_policy, csrf_etag_parts, make_etag, set_cache_policy,
+    set_static_policy, static_url, PRIVATE_MAX_AGE, PUBLIC_MAX_AGE)
+from config import PROFILES
 from forms import UserAddForm, LoginForm, MessageForm, CSRFOnlyForm, UserEditForm
-from models import db, connect_db, User, Message, Like
+from fragment_cache import fragment_cache
+from models import db, connect_db, User, Message, Like, TimelineEntry, Follows
+from hashing import HashingUnavailable
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, init_metrics, scrape
+from pagination import InvalidCursor
+from query_budget import init_query_budgets, query_budget
+from query_watch import init_query_watch
+from replicas import init_replicas
+from serializers import (
+    InvalidIds, messages_by_ids, parse_ids, serialize_messages,
+    serialize_user, user_messages_page, user_row)
+from user_cache import user_cache
+from write_behind import WriteBehindUnavailable, init_write_behind
 
 load_dotenv()
 
 CURR_USER_KEY = "curr_user"
 
-app = Flask(__name__)
+bp = Blueprint('warbler', __name__)
 
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['DEBUG'] = True
-# db = SQLAlchemy(SQLALCHEMY_URI, app=app, record_queries=True)
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ['DATABASE_URL'].replace("postgres://", "postgresql://"))
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
-app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
-app.config['SQLALCHEMY_RECORD_QUERIES'] = True
-toolbar = DebugToolbarExtension(app)
+csrf = CSRFProtect()
 
-connect_db(app)
 
-from flask_wtf.csrf import CSRFProtect
+def create_app(config=None):
+    """Create the app with a profile from config.py.
+
+    `config` is 'dev', 'test' or 'prod'; if not given, WARBLER_CONFIG,
+    else 'dev'. Only profiles that use it import the debug toolbar, and
+    SQL is recorded and checked against query budgets only where
+    SQLALCHEMY_RECORD_QUERIES is on. Every profile serves /metrics.
+    """
+
+    profile = PROFILES[config or os.environ.get('WARBLER_CONFIG', 'dev')]
+
+    app = Flask(__name__)
+    app.config.from_object(profile)
+    app.config.update(profile.from_environment())
+
+    if app.config['DEBUG_TOOLBAR']:
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    # no indenting or key sorting in JSON responses, even in debug mode
+    app.json.compact = True
+    app.json.sort_keys = False
+
+    app.jinja_env.globals['static_url'] = static_url
+    app.jinja_env.globals['cached_fragment'] = fragment_cache.render
+
+    connect_db(app)
+
+    # first, so requests are timed from and to their outermost hooks
+    init_metrics(app, db)
+    init_query_watch(app, db)
+
+    # before the other hooks, so the SQL they run counts towards the budgets
+    if app.config['SQLALCHEMY_RECORD_QUERIES']:
+        init_query_budgets(app)
+
+    # also before them, so they read from a replica too
+    init_replicas(app, db)
 
-csrf = CSRFProtect(app)
+    init_write_behind(app)
+
+    csrf.init_app(app)
+    app.register_blueprint(bp)
+
+    return app
 
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@bp.before_app_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
     # breakpoint()
     if CURR_USER_KEY in session: # creates single source of truth throughout entire session. by setting user through user id in session
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = get_session_user(session[CURR_USER_KEY])
 
     else:
         g.user = None
 
-@app.before_request
+
+def get_session_user(user_id):
+    """Get the user for `user_id`, from the user cache if possible.
+
+    A cached snapshot is merged into this request's db session without a
+    query; a miss loads the user and caches it.
+    """
+
+    cached = user_cache.get(user_id)
+
+    if cached is not None:
+        return db.session.merge(cached, load=False)
+
+    user = User.query.get(user_id)
+
+    if user:
+        user_cache.put(user)
+
+    return user
+
+@bp.before_app_request
 def add_csrf_form_to_g():
-    """ Add CSRF form to Flask global. """
-    g.csrf_form = CSRFOnlyForm()
+    """ Add CSRF form to Flask global.
+
+    Only for logged-in users: making the form puts a CSRF token in the
+    session, and anonymous pages must stay cookie-free to be cacheable.
+    """
+    g.csrf_form = CSRFOnlyForm() if g.user else None
 
 
 def do_login(user):
@@ -64,10 +135,12 @@ def do_logout():
     """Log out user."""
 
     if CURR_USER_KEY in session:
+        user_cache.invalidate(session[CURR_USER_KEY])
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+@bp.route('/signup', methods=["GET", "POST"])
+@query_budget(3, sql_ms=250)
 def signup():
     """Handle user signup.
 
@@ -97,6 +170,10 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except HashingUnavailable:
+            flash("We're very busy right now. Please try again.", 'danger')
+            return (render_template('users/signup.html', form=form), 503)
+
         do_login(user)
 
         return redirect("/")
@@ -105,18 +182,26 @@ def signup():
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@bp.route('/login', methods=["GET", "POST"])
+@query_budget(4, sql_ms=250)
 def login():
     """Handle user login and redirect to homepage on success."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(
-            form.username.data,
-            form.password.data)
+        try:
+            user = User.authenticate(
+                form.username.data,
+                form.password.data)
+
+        except HashingUnavailable:
+            flash("We're very busy right now. Please try again.", 'danger')
+            return (render_template('users/login.html', form=form), 503)
 
         if user:
+            # saves the hash if authenticate upgraded its work factor
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -126,7 +211,8 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.post('/logout')
+@bp.post('/logout')
+@query_budget(1, sql_ms=100)
 def logout():
     """Handle logout of user and redirect to homepage."""
 
@@ -153,41 +239,90 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.get('/users')
+@bp.get('/users')
+@cache_policy()
+@query_budget(4, sql_ms=100)
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username, and
+    an 'after' cursor for the next page of results.
     """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    search = request.args.get('q')
+    search = request.args.get('q', '')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    try:
+        page = User.search(search, after=request.args.get('after'))
+    except InvalidCursor:
+        abort(400)
+
+    User.annotate_followed(g.user, page.items)
 
-    return render_template('users/index.html', users=users)
+    return render_template(
+        'users/index.html',
+        users=page.items,
+        search=search,
+        next_cursor=page.next_cursor,
+    )
 
 
-@app.get('/users/<int:user_id>')
+@bp.get('/users/<int:user_id>')
+@cache_policy(private=0)
+@query_budget(5, sql_ms=100)
 def show_user(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    The ETag comes from the versions of the user and the viewer, so a
+    revalidation that finds neither changed gets a 304 without loading
+    or rendering anything. It also covers the page's CSRF tokens.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    versions = User.versions([user_id, g.user.id])
+
+    if user_id not in versions:
+        abort(404)
+
+    etag = make_etag(
+        user_id,
+        versions[user_id],
+        g.user.id,
+        versions[g.user.id],
+        request.args.get('before'),
+        *csrf_etag_parts(),
+    )
+
+    # a pending flash would be shown by a fresh render, so render one
+    if etag in request.if_none_match and '_flashes' not in session:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
     user = User.query.get_or_404(user_id)
+    page = get_list_page(user.messages_page)
+    User.annotate_followed(g.user, [user])
+
+    response = make_response(render_template(
+        'users/show.html',
+        user=user,
+        messages=page.items,
+        next_cursor=page.next_cursor,
+    ))
+    response.set_etag(etag)
 
-    return render_template('users/show.html', user=user)
+    return response
 
 
-@app.get('/users/<int:user_id>/following')
+@bp.get('/users/<int:user_id>/following')
+@cache_policy(private=0)
+@query_budget(5, sql_ms=100)
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -195,11 +330,13 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    return user_list_response(
+        user_id, 'following_page', 'users/following.html', 'following')
 
 
-@app.get('/users/<int:user_id>/followers')
+@bp.get('/users/<int:user_id>/followers')
+@cache_policy(private=0)
+@query_budget(5, sql_ms=100)
 def show_followers(user_id):
     """Show list of followers of this user."""
 
@@ -207,11 +344,72 @@ def show_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    return user_list_response(
+        user_id, 'followers_page', 'users/followers.html', 'followers')
+
+
+def user_list_response(user_id, page_name, template, items_name):
+    """Render a page of one of a user's lists, with an ETag.
+
+    `page_name` is a User method like 'followers_page'. The follow forms
+    redirect to these pages, so they mustn't be kept stale by the
+    browser. Following or unfollowing changes both users' counters, and
+    so their versions; the ETag covers those of the user and the viewer,
+    and those of the listed users, which change when they edit their
+    profiles.
+    """
+
+    versions = User.versions([user_id, g.user.id])
+
+    if user_id not in versions:
+        abort(404)
+
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    page = get_list_page(getattr(user, page_name))
+
+    etag = make_etag(
+        user_id,
+        versions[user_id],
+        g.user.id,
+        versions[g.user.id],
+        request.args.get('before'),
+        [(listed.id, listed.version) for listed in page.items],
+        *csrf_etag_parts(),
+    )
+
+    if etag in request.if_none_match and '_flashes' not in session:
+        response = current_app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
+    User.annotate_followed(g.user, [user, *page.items])
+
+    response = make_response(render_template(
+        template,
+        user=user,
+        next_cursor=page.next_cursor,
+        **{items_name: page.items},
+    ))
+    response.set_etag(etag)
+
+    return response
+
+
+def get_list_page(page_of):
+    """Get the page of a profile list after the `before` querystring cursor.
 
+    `page_of` is a User method like `user.followers_page`. Responds 400 if
+    the cursor is garbled.
+    """
+
+    try:
+        return page_of(before=request.args.get('before'))
+    except InvalidCursor:
+        abort(400)
 
-@app.post('/users/follow/<int:follow_id>')
+
+@bp.post('/users/follow/<int:follow_id>')
+@query_budget(8, sql_ms=250)
 def start_following(follow_id):
     """Add a follow for the currently-logged-in user.
 
@@ -223,13 +421,36 @@ def start_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    write_behind = current_app.extensions.get('write_behind')
+
+    if write_behind:
+        try:
+            write_behind.follow(g.user.id, followed_user.id, True, wait=True)
+        except WriteBehindUnavailable:
+            flash("We're very busy right now. Please try again.", 'danger')
+
+    else:
+        # already following them is fine; there's just nothing to add
+        followed = db.session.execute(
+            pg_insert(Follows)
+            .values(user_following_id=g.user.id,
+                    user_being_followed_id=followed_user.id)
+            .on_conflict_do_nothing()
+            .returning(Follows.user_being_followed_id)
+        ).first()
+
+        if followed:
+            User.adjust_counts(g.user.id, following_count=1)
+            User.adjust_counts(followed_user.id, followers_count=1)
+            TimelineEntry.backfill(g.user.id, followed_user.id)
+
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.post('/users/stop-following/<int:follow_id>')
+@bp.post('/users/stop-following/<int:follow_id>')
+@query_budget(7, sql_ms=250)
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user.
 
@@ -240,14 +461,34 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = User.query.get_or_404(follow_id)
+    write_behind = current_app.extensions.get('write_behind')
+
+    if write_behind:
+        try:
+            write_behind.follow(g.user.id, followed_user.id, False, wait=True)
+        except WriteBehindUnavailable:
+            flash("We're very busy right now. Please try again.", 'danger')
+
+    else:
+        # not following them is fine; there's just nothing to undo
+        unfollowed = (Follows.query
+                      .filter_by(user_following_id=g.user.id,
+                                 user_being_followed_id=followed_user.id)
+                      .delete(synchronize_session=False))
+
+        if unfollowed:
+            User.adjust_counts(g.user.id, following_count=-1)
+            User.adjust_counts(followed_user.id, followers_count=-1)
+            TimelineEntry.remove_author(g.user.id, followed_user.id)
+
+        db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@bp.route('/users/profile', methods=["GET", "POST"])
+@query_budget(3, sql_ms=250)
 def profile():
     """
     Update profile for current user.
@@ -266,14 +507,23 @@ def profile():
 
         password = form.password.data
 
-        if User.authenticate(username=g.user.username, password=password):
+        try:
+            is_auth = g.user.check_password(password)
+        except HashingUnavailable:
+            flash("We're very busy right now. Please try again.", 'danger')
+            return (render_template("users/edit.html", form=form), 503)
+
+        if is_auth:
             g.user.username = form.data.get("username", g.user.username)
             g.user.email = form.data.get("email", g.user.email)
             g.user.image_url = form.data.get("image_url", g.user.image_url)
             g.user.header_image_url = form.data.get("header_image_url", g.user.header_image_url)
             g.user.bio = form.data.get("bio", g.user.bio)
+            g.user.version = User.version + 1
 
             db.session.commit()
+            user_cache.invalidate(g.user.id)
+            fragment_cache.invalidate_owner(g.user.id)
 
             return redirect(f"/users/{g.user.id}")
         else:
@@ -282,7 +532,8 @@ def profile():
     return render_template("users/edit.html", form=form)
 
 
-@app.post('/users/delete')
+@bp.post('/users/delete')
+@query_budget(7, sql_ms=250)
 def delete_user():
     """Delete user.
 
@@ -293,18 +544,27 @@ def delete_user():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    user_id = g.user.id
     do_logout()
 
+    g.user.remove_from_counts()
+
+    # timeline rows owned by or authored by this user go via ON DELETE CASCADE
     db.session.delete(g.user)
     db.session.commit()
 
+    # again, in case another request re-cached them before the commit
+    user_cache.invalidate(user_id)
+    fragment_cache.invalidate_owner(user_id)
+
     return redirect("/signup")
 
 
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@bp.route('/messages/new', methods=["GET", "POST"])
+@query_budget(7, sql_ms=250)
 def add_message():
     """Add a message:
 
@@ -320,6 +580,9 @@ def add_message():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        User.adjust_counts(g.user.id, messages_count=1)
+        TimelineEntry.fan_out(msg)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -327,7 +590,9 @@ def add_message():
     return render_template('messages/create.html', form=form)
 
 
-@app.get('/messages/<int:message_id>')
+@bp.get('/messages/<int:message_id>')
+@cache_policy()
+@query_budget(5, sql_ms=100)
 def show_message(message_id):
     """Show a message."""
 
@@ -337,17 +602,56 @@ def show_message(message_id):
 
     msg = Message.query.get_or_404(message_id)
 
-    liked_messages_ids = [message.id for message in g.user.liked_messages ]
-
-    if message_id in liked_messages_ids: #able to add property on objects as a one time thing
-        msg.is_liked = True
-    else:
-        msg.is_liked = False
+    Message.annotate_liked(g.user, [msg])
+    User.annotate_followed(g.user, [msg.user])
 
     return render_template('messages/show.html', message=msg)
 
 
-@app.post('/messages/<int:message_id>/delete')
+@bp.get('/messages/search')
+@cache_policy()
+@query_budget(3, sql_ms=100)
+def search_messages():
+    """Search messages for the 'q' querystring param.
+
+    'order=relevant' ranks best matches first, otherwise newest first;
+    'before' takes the cursor of the previous page.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    page = get_search_page()
+    Message.annotate_liked(g.user, page.items)
+
+    return render_template(
+        'messages/search.html',
+        messages=page.items,
+        search=request.args.get('q', ''),
+        order=request.args.get('order', 'recent'),
+        next_cursor=page.next_cursor,
+    )
+
+
+def get_search_page():
+    """Get the page of message search results for the querystring.
+
+    Responds 400 if the cursor is garbled.
+    """
+
+    try:
+        return Message.search(
+            request.args.get('q', ''),
+            by_relevance=request.args.get('order') == 'relevant',
+            before=request.args.get('before'),
+        )
+    except InvalidCursor:
+        abort(400)
+
+
+@bp.post('/messages/<int:message_id>/delete')
+@query_budget(6, sql_ms=250)
 def delete_message(message_id):
     """Delete a message.
 
@@ -361,13 +665,18 @@ def delete_message(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    msg.remove_from_counts()
+
+    # removed from every timeline via ON DELETE CASCADE
     db.session.delete(msg)
     db.session.commit()
+    fragment_cache.invalidate('message', message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
-@app.post('/messages/<int:message_id>/like')
+@bp.post('/messages/<int:message_id>/like')
+@query_budget(5, sql_ms=250)
 def like_message(message_id):
     """ Allows a user to “like” or "unlike" a warble.
         Returns: Redirect to "/"
@@ -387,25 +696,26 @@ def like_message(message_id):
     form = g.csrf_form
 
     if form.validate_on_submit():
+        write_behind = current_app.extensions.get('write_behind')
 
-        # get all message_ids of liked messages
-        # like_message_ids = [message.id for message in g.user.liked_messages]
+        if write_behind:
+            try:
+                write_behind.like(g.user.id, message.id, None,
+                                  message.likes_count, wait=True)
+            except WriteBehindUnavailable:
+                flash("We're very busy right now. Please try again.",
+                      'danger')
 
-        # Like.query.get(message_id=message., ) in g.user.like
-
-        if message in g.user.liked_messages:
-        # if message_id in like_message_ids:
-            g.user.liked_messages.remove(message)
-            # db.session.commit()
         else:
-            # handles unfilled star
-            g.user.liked_messages.append(message) #adding message to a list of messages (users's liked messages)
-
-        db.session.commit()
+            Like.set_liked(g.user.id, message.id)
+            db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
-@app.get('/users/<int:user_id>/likes')
+
+@bp.get('/users/<int:user_id>/likes')
+@cache_policy()
+@query_budget(3, sql_ms=100)
 def list_like_messages(user_id):
     """Shows list of liked messages"""
 
@@ -414,8 +724,14 @@ def list_like_messages(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+    page = get_list_page(user.liked_messages_page)
 
-    return render_template('messages/liked_messages.html', user=user)
+    return render_template(
+        'messages/liked_messages.html',
+        user=user,
+        messages=page.items,
+        next_cursor=page.next_cursor,
+    )
 
 
 
@@ -425,62 +741,102 @@ def list_like_messages(user_id):
 # Homepage and error pages
 
 
-@app.get('/')
+@bp.get('/')
+@cache_policy(public=PUBLIC_MAX_AGE)
+@query_budget(4, sql_ms=100)
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: newest page of the home feed; `before` takes the cursor
+      of the previous page
     """
 
-
     if g.user:
-        following_users_id = [user.id for user in g.user.following]+[g.user.id]
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_users_id))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        page = get_feed_page()
+        Message.annotate_liked(g.user, page.items)
 
-        # TODO: I don't like this b/c it doesn't seem efficient
+        return render_template(
+            'home.html',
+            messages=page.items,
+            next_cursor=page.next_cursor,
+        )
 
-        liked_messages_ids = [message.id for message in g.user.liked_messages]
+    else:
+        return render_template('home-anon.html')
 
-        for message in messages:
-            if message.id in liked_messages_ids:
-                message.is_liked = True
-            else:
-                message.is_liked = False
 
-        return render_template('home.html', messages=messages)
+def get_feed_page():
+    """Get the page of g.user's feed before the `before` querystring cursor.
 
-    else:
-        return render_template('home-anon.html')
+    Responds 400 if the cursor is garbled.
+    """
 
+    try:
+        return TimelineEntry.feed_for(g.user, before=request.args.get('before'))
+    except InvalidCursor:
+        abort(400)
 
 
-@app.errorhandler(404)
+@bp.app_errorhandler(404)
 def page_note_found(e):
     """ Show a custom 404 page """
-    return render_template("404.html")
 
+    response = make_response(render_template("404.html"), 404)
+
+    if not session.modified:
+        set_cache_policy(
+            response,
+            (PRIVATE_MAX_AGE, PUBLIC_MAX_AGE),
+            logged_in=bool(g.get('user')),
+        )
+
+    return response
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Metrics: see metrics.py
+
+
+@bp.get('/metrics')
+@query_budget(1)
+def show_metrics():
+    """Request, SQL, template and hashing metrics, for Prometheus to
+    scrape."""
+
+    return current_app.response_class(
+        scrape(), content_type=METRICS_CONTENT_TYPE)
 
-@app.after_request
+
+##############################################################################
+# HTTP caching: see caching.py for the policies
+
+
+@bp.after_app_request
 def add_header(response):
-    """Add non-caching headers on every request."""
+    """Apply the view's declared cache policy; default to no-store."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    if request.endpoint == 'static':
+        set_static_policy(response, request.view_args['filename'],
+                          request.args.get('v'))
+        return response
+
+    # views that set their own policy (see conditional_json) keep it
+    if response.cache_control:
+        return response
+
+    view = current_app.view_functions.get(request.endpoint)
+    policy = getattr(view, 'cache_policy', None)
+
+    if (policy
+            and request.method in ('GET', 'HEAD')
+            and response.status_code in (200, 304)
+            and not session.modified):
+        set_cache_policy(response, policy, logged_in=bool(g.get('user')))
+    else:
+        response.cache_control.no_store = True
+
     return response
 
 
@@ -488,48 +844,249 @@ def add_header(response):
 
 # ============================= API ===============================
 
-@app.post('/api/messages/<int:message_id>/like')
+@bp.post('/api/messages/<int:message_id>/like')
+@query_budget(4, sql_ms=250)
 def like_message_api(message_id):
     """
-    Allows a user to “like” or "unlike" a warble.
+    Toggle the current user's like of a warble.
 
-    Returns: {message: {id, text, user_id }}
+    Returns: {message: {id, text, timestamp, user_id, is_liked,
+              likes_count}}
     """
 
-    is_msg_liked = False
+    return change_like(message_id, None)
+
+
+@bp.put('/api/messages/<int:message_id>/like')
+@query_budget(4, sql_ms=250)
+def put_like_api(message_id):
+    """
+    Like a warble. Liking it again changes nothing, so a double click or
+    a retried request is harmless.
+
+    Returns: {message: {id, text, timestamp, user_id, is_liked,
+              likes_count}}
+    """
+
+    return change_like(message_id, True)
+
+
+@bp.delete('/api/messages/<int:message_id>/like')
+@query_budget(4, sql_ms=250)
+def delete_like_api(message_id):
+    """
+    Unlike a warble. Unliking it again changes nothing.
+
+    Returns: {message: {id, text, timestamp, user_id, is_liked,
+              likes_count}}
+    """
+
+    return change_like(message_id, False)
+
+
+def change_like(message_id, liked):
+    """Like (True), unlike (False) or toggle (None) a message for g.user.
+
+    Responds 401 if not logged in, 404 for a missing message, 403 for the
+    user's own message and 400 without a valid CSRF token.
+    """
 
     if not g.user:
-        flash("Access unauthorized.", "danger")
-        return redirect("/")
+        return (jsonify(error="Access unauthorized."), 401)
 
     message = Message.query.get_or_404(message_id)
 
-    if message.user == g.user:
-        flash("You cannot like your own warble.", "danger")
-        return redirect("/")
-
-    form = g.csrf_form
+    if message.user_id == g.user.id:
+        return (jsonify(error="You cannot like your own warble."), 403)
 
-    # breakpoint()
+    if not g.csrf_form.validate_on_submit():
+        return (jsonify(error="Invalid CSRF token."), 400)
 
+    write_behind = current_app.extensions.get('write_behind')
 
-    if form.validate_on_submit():
-        if message in g.user.liked_messages:
-            g.user.liked_messages.remove(message)
-        else:
-            g.user.liked_messages.append(message)
-            is_msg_liked = True
+    if write_behind:
+        try:
+            is_liked, likes_count = write_behind.like(
+                g.user.id, message.id, liked, message.likes_count)
+        except WriteBehindUnavailable:
+            return (jsonify(error="We're very busy right now. "
+                                  "Please try again."), 503)
 
+    else:
+        is_liked, likes_count = Like.set_liked(g.user.id, message.id, liked)
         db.session.commit()
 
     serialized = message.serialize()
-    serialized["is_liked"] = is_msg_liked
+    serialized["is_liked"] = is_liked
+    serialized["likes_count"] = likes_count
+
+    return jsonify(message=serialized)
+
+
+@bp.get('/api/users/search')
+@query_budget(3, sql_ms=100)
+def search_users_api():
+    """
+    Users for the search box to suggest as the user types the `q`
+    querystring param: usernames starting with it first.
+
+    Returns: {users: [{id, username, image_url}]}
+    """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    users = User.autocomplete(request.args.get('q', ''))
+
+    return jsonify(users=[
+        {"id": user.id, "username": user.username, "image_url": user.image_url}
+        for user in users
+    ])
+
+
+@bp.get('/api/messages/search')
+@query_budget(3, sql_ms=100)
+def search_messages_api():
+    """
+    Page of messages matching the `q` querystring param, newest first, or
+    best match first with `order=relevant`. Pass the returned cursor back
+    as `before` to get the next page.
+
+    Returns: {messages: [{id, text, timestamp, user_id, username,
+              image_url, is_liked}], next_cursor}
+    """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    page = get_search_page()
+    Message.annotate_liked(g.user, page.items)
+
+    return jsonify(
+        messages=[serialize_with_author(message) for message in page.items],
+        next_cursor=page.next_cursor,
+    )
+
+
+@bp.get('/api/feed')
+@query_budget(4, sql_ms=100)
+def feed_api():
+    """
+    Page of the current user's home feed, newest first. Pass the returned
+    cursor back as `before` to get the next page.
+
+    Returns: {messages: [{id, text, timestamp, user_id, username,
+              image_url, is_liked}], next_cursor}
+    """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    page = get_feed_page()
+    Message.annotate_liked(g.user, page.items)
+
+    return jsonify(
+        messages=[serialize_with_author(message) for message in page.items],
+        next_cursor=page.next_cursor,
+    )
+
+
+def serialize_with_author(message):
+    """Serialize an annotated message with its author's name and image."""
+
+    serialized = message.serialize()
+    serialized["username"] = message.user.username
+    serialized["image_url"] = message.user.image_url
+    serialized["is_liked"] = message.is_liked
+
+    return serialized
+
+
+@bp.get('/api/messages')
+@query_budget(3, sql_ms=100)
+def messages_api():
+    """
+    Bulk fetch messages by id: `ids` is a comma-separated list of up to
+    100 ids. Unknown ids are left out; the rest keep the order asked for.
+
+    Returns: {messages: [{id, text, timestamp, user_id, username,
+              image_url, likes_count, is_liked}]}
+    """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    try:
+        ids = parse_ids(request.args.get('ids', ''))
+    except InvalidIds:
+        return (jsonify(error="ids must be up to 100 integers."), 400)
+
+    return conditional_json(
+        messages=serialize_messages(messages_by_ids(ids), g.user.id))
+
+
+@bp.get('/api/users/<int:user_id>')
+@query_budget(3, sql_ms=100)
+def user_api(user_id):
+    """
+    A user's public profile and counters.
+
+    Returns: {user: {id, username, image_url, header_image_url, bio,
+              location, messages_count, followers_count, following_count,
+              likes_count, is_followed}}
+    """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    row = user_row(user_id)
 
+    if row is None:
+        return (jsonify(error="User not found."), 404)
 
-    print(g.user)
+    return conditional_json(user=serialize_user(row, g.user.id))
 
-    # if serialized['is_liked_status'] is True:
-    #     serialized['is_liked_status'] = False
 
+@bp.get('/api/users/<int:user_id>/messages')
+@query_budget(4, sql_ms=100)
+def user_messages_api(user_id):
+    """
+    Page of a user's messages, newest first. Pass the returned cursor back
+    as `before` to get the next page.
+
+    Returns: {messages: [{id, text, timestamp, user_id, username,
+              image_url, likes_count, is_liked}], next_cursor}
+    """
+
+    if not g.user:
+        return (jsonify(error="Access unauthorized."), 401)
+
+    if user_row(user_id) is None:
+        return (jsonify(error="User not found."), 404)
+
+    try:
+        page = user_messages_page(user_id, request.args.get('before'))
+    except InvalidCursor:
+        return (jsonify(error="Invalid cursor."), 400)
+
+    return conditional_json(
+        messages=serialize_messages(page.items, g.user.id),
+        next_cursor=page.next_cursor,
+    )
+
+
+def conditional_json(**payload):
+    """JSON response with an ETag, answered with 304 Not Modified when it
+    matches the request's If-None-Match.
+
+    The body depends on the viewer, so only the browser may cache it, and
+    it must revalidate each time.
+    """
+
+    response = jsonify(**payload)
+    response.add_etag()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
 
-    return (jsonify(message=serialized), 201)
\ No newline at end of file
+    return response.make_conditional(request)
@@ -0,0 +1,87 @@
+"""Benchmark password checks (the cost of a login) against pool size.
+
+    python -m benchmarks.bench_login [--rounds 12] [--seconds 5]
+                                     [--threads 16] [--workers 1,2,4,8]
+
+Request threads call PasswordHasher.check() as fast as they can for
+each pool size. The script prints logins/second, rejected calls (queue
+full or timed out) and latency percentiles. Throughput should grow with
+workers up to the number of cores, whatever the thread count.
+"""
+
+import argparse
+import statistics
+import threading
+import time
+
+from hashing import HashingUnavailable, PasswordHasher, _hash
+
+
+def run(workers, threads, seconds, rounds):
+    """Drive one pool size; return (logins/s, rejected, p50, p99) in ms."""
+
+    hasher = PasswordHasher(
+        workers=workers,
+        queue_limit=workers * 4,
+        timeout=5,
+        rounds=rounds,
+    )
+    hashed = _hash(b"password", rounds)
+
+    # start the pool processes before timing
+    hasher.check(hashed, "password")
+
+    latencies = []
+    rejected = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client():
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                hasher.check(hashed, "password")
+            except HashingUnavailable:
+                with lock:
+                    rejected[0] += 1
+                time.sleep(0.01)
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    pool = [threading.Thread(target=client) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    hasher.shutdown()
+
+    latencies.sort()
+    p50 = statistics.median(latencies) * 1000
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000
+
+    return len(latencies) / seconds, rejected[0], p50, p99
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--workers', default='1,2,4,8')
+    args = parser.parse_args()
+
+    print(f"bcrypt rounds={args.rounds}, {args.threads} request threads")
+    print(f"{'workers':>8} {'logins/s':>10} {'rejected':>9} "
+          f"{'p50 ms':>8} {'p99 ms':>8}")
+
+    for workers in (int(n) for n in args.workers.split(',')):
+        rate, rejected, p50, p99 = run(
+            workers, args.threads, args.seconds, args.rounds)
+        print(f"{workers:>8} {rate:>10.1f} {rejected:>9} "
+              f"{p50:>8.1f} {p99:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+"""Benchmark Warbler's routes under concurrent load.
+
+    python -m benchmarks.bench_routes [--database-url postgresql:///warbler_bench]
+        [--seed] [--users 2000] [--messages 20000] [--follows 60000]
+        [--likes 40000] [--routes feed,profile,...] [--requests 200]
+        [--concurrency 4] [--output FILE] [--compare FILE]
+
+--seed generates a synthetic snapshot of the given size and loads it
+into --database-url (which must exist, and is wiped); without it, the
+data already there is used. Then each route is driven in turn by
+--concurrency processes, each with its own test client, logged in as
+a random user per request.
+
+For every route the script prints throughput, p50/p95/p99 latency and
+SQL statements per request, and writes them as JSON to --output
+(benchmarks/results/routes-<commit>.json by default). --compare takes
+an earlier results file and prints the change against it.
+
+Requests go through the app in-process, so the numbers leave out the
+HTTP server but include everything from routing to rendering. The app
+runs with the prod profile, without CSRF checks, and takes its other
+settings from the environment as usual, so e.g. WRITE_BEHIND=async
+benchmarks batched likes.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from sqlalchemy import create_engine, event, text
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DATABASE_URL = 'postgresql:///warbler_bench'
+
+# words and name prefixes that generator/create_csvs.py uses
+SEARCH_WORDS = ['coffee', 'birds', 'morning', 'rain', 'music', 'weekend']
+NAME_PREFIXES = ['ada', 'leo', 'mia', 'sam', 'zoe', 'kai']
+
+# requests per task handed to a worker process
+TASK_REQUESTS = 10
+
+# untimed requests per process before each route is measured
+WARMUP_REQUESTS = 5
+
+
+##############################################################################
+# Routes: each takes (client, rng, targets) and makes one request
+
+
+def feed(client, rng, targets):
+    return client.get('/')
+
+
+def feed_api(client, rng, targets):
+    return client.get('/api/feed')
+
+
+def profile(client, rng, targets):
+    return client.get(f"/users/{rng.choice(targets['user_ids'])}")
+
+
+def followers(client, rng, targets):
+    return client.get(f"/users/{rng.choice(targets['user_ids'])}/followers")
+
+
+def following(client, rng, targets):
+    return client.get(f"/users/{rng.choice(targets['user_ids'])}/following")
+
+
+def likes(client, rng, targets):
+    return client.get(f"/users/{rng.choice(targets['user_ids'])}/likes")
+
+
+def message(client, rng, targets):
+    return client.get(f"/messages/{rng.randint(1, targets['max_message_id'])}")
+
+
+def user_search(client, rng, targets):
+    return client.get('/users', query_string={'q': rng.choice(NAME_PREFIXES)})
+
+
+def message_search(client, rng, targets):
+    return client.get('/messages/search',
+                      query_string={'q': rng.choice(SEARCH_WORDS)})
+
+
+def like_toggle(client, rng, targets):
+    message_id = rng.randint(1, targets['max_message_id'])
+    return client.post(f"/api/messages/{message_id}/like")
+
+
+def viral_like(client, rng, targets):
+    return client.post(f"/api/messages/{targets['viral_message_id']}/like")
+
+
+def signup(client, rng, targets):
+    username = f"bench_{os.getpid()}_{rng.getrandbits(48):x}"
+    return client.post('/signup', data={
+        'username': username,
+        'email': f"{username}@example.com",
+        'password': 'password',
+    })
+
+
+def login(client, rng, targets):
+    return client.post('/login', data={
+        'username': rng.choice(targets['usernames']),
+        'password': 'password',
+    })
+
+
+ROUTES = {
+    'feed': feed,
+    'feed_api': feed_api,
+    'profile': profile,
+    'followers': followers,
+    'following': following,
+    'likes': likes,
+    'message': message,
+    'user_search': user_search,
+    'message_search': message_search,
+    'like_toggle': like_toggle,
+    'viral_like': viral_like,
+    'signup': signup,
+    'login': login,
+}
+
+# these log in (or out) themselves
+ANONYMOUS_ROUTES = {'signup', 'login'}
+
+
+##############################################################################
+# Worker processes
+
+
+_worker = {}
+
+
+def init_worker(database_url):
+    """Import the app in a fresh worker process and count its SQL."""
+
+    os.environ['DATABASE_URL'] = database_url
+
+    from app import create_app, CURR_USER_KEY
+    from models import db
+
+    app = create_app('prod')
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    # replicas too (DATABASE_REPLICA_URLS), so reads they take still count
+    for bind in [None, *(app.config['SQLALCHEMY_BINDS'] or {})]:
+        event.listen(db.get_engine(app, bind=bind), 'before_cursor_execute',
+                     count)
+
+    _worker.update(
+        client=app.test_client(),
+        session_key=CURR_USER_KEY,
+        statements=statements,
+    )
+
+
+def log_in_as(user_id):
+    """Set the worker's session user without going through /login."""
+
+    with _worker['client'].session_transaction() as session:
+        if user_id is None:
+            session.pop(_worker['session_key'], None)
+        else:
+            session[_worker['session_key']] = user_id
+
+
+def worker_main(database_url, tasks, results):
+    """Run tasks from the `tasks` queue until a None arrives."""
+
+    init_worker(database_url)
+
+    for task in iter(tasks.get, None):
+        results.put(drive(task))
+
+    # the process can't exit while its hashing pool is running
+    from hashing import hasher
+    hasher.shutdown()
+
+
+class Workers:
+    """Forked worker processes, each with its own app and connections.
+
+    Not a multiprocessing.Pool: its daemonic processes can't start the
+    password hashing pool, and a concurrent.futures worker deadlocks
+    forking it.
+    """
+
+    def __init__(self, count, database_url):
+        context = multiprocessing.get_context('fork')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.processes = [
+            context.Process(target=worker_main,
+                            args=(database_url, self.tasks, self.results))
+            for _ in range(count)
+        ]
+
+        for process in self.processes:
+            process.start()
+
+    def run(self, tasks):
+        """drive() each task on whichever worker is free; results come
+        back in no particular order."""
+
+        for task in tasks:
+            self.tasks.put(task)
+
+        return [self.results.get() for _ in tasks]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for _ in self.processes:
+            self.tasks.put(None)
+
+        for process in self.processes:
+            process.join()
+
+
+def drive(task):
+    """Make `requests` requests to one route.
+
+    Returns [(seconds, SQL statements, ok)] per request.
+    """
+
+    route, requests, seed, targets = task
+    rng = random.Random(seed)
+    client = _worker['client']
+    statements = _worker['statements']
+    results = []
+
+    for _ in range(requests):
+        if route in ANONYMOUS_ROUTES:
+            log_in_as(None)
+        else:
+            log_in_as(rng.choice(targets['user_ids']))
+
+        before = statements[0]
+        start = time.perf_counter()
+        response = ROUTES[route](client, rng, targets)
+        elapsed = time.perf_counter() - start
+
+        results.append(
+            (elapsed, statements[0] - before, response.status_code < 400))
+
+    return results
+
+
+##############################################################################
+# Driver
+
+
+def seed(database_url, users, messages, follows, likes):
+    """Generate a snapshot and load it into `database_url`."""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run(
+            [sys.executable, 'generator/create_csvs.py', '--out', data_dir,
+             '--users', str(users), '--messages', str(messages),
+             '--follows', str(follows), '--likes', str(likes)],
+            cwd=ROOT, check=True)
+        subprocess.run(
+            [sys.executable, 'seed.py', '--data-dir', data_dir, '--restart'],
+            cwd=ROOT, check=True,
+            env=dict(os.environ, DATABASE_URL=database_url))
+
+
+def get_targets(database_url, sample=1000):
+    """Sample user ids and usernames to request, and count the data."""
+
+    engine = create_engine(database_url)
+
+    with engine.connect() as conn:
+        dataset = {
+            table: conn.execute(text(f"SELECT count(*) FROM {table}")).scalar()
+            for table in ('users', 'messages', 'follows', 'likes')
+        }
+        max_user_id = conn.execute(text("SELECT max(id) FROM users")).scalar()
+        max_message_id = conn.execute(
+            text("SELECT max(id) FROM messages")).scalar()
+        viral_message_id = conn.execute(
+            text("SELECT id FROM messages ORDER BY likes_count DESC LIMIT 1")
+        ).scalar()
+
+        rng = random.Random(0)
+        wanted = [rng.randint(1, max_user_id) for _ in range(sample)]
+        users = conn.execute(
+            text("SELECT id, username FROM users WHERE id = ANY(:ids) "
+                 "AND username NOT LIKE 'bench\\_%'"),
+            {"ids": wanted},
+        ).all()
+
+    engine.dispose()
+
+    targets = {
+        'user_ids': [id for id, _ in users],
+        'usernames': [username for _, username in users],
+        'max_message_id': max_message_id,
+        'viral_message_id': viral_message_id,
+    }
+
+    return dataset, targets
+
+
+def percentile(sorted_values, fraction):
+    """The value at `fraction` of the way through `sorted_values`."""
+
+    return sorted_values[min(int(len(sorted_values) * fraction),
+                             len(sorted_values) - 1)]
+
+
+def run_tasks(workers, route, requests, targets, label):
+    """Drive `route` for about `requests` requests, in small tasks that
+    idle workers pick up. Returns (per-request results, seconds)."""
+
+    tasks = [(route, TASK_REQUESTS, f"{route}:{label}:{task}", targets)
+             for task in range(-(-requests // TASK_REQUESTS))]
+
+    start = time.perf_counter()
+    results = [result for task in workers.run(tasks) for result in task]
+
+    return results, time.perf_counter() - start
+
+
+def run_route(workers, route, requests, concurrency, targets):
+    """Warm up, then drive one route with every worker; return its
+    summary."""
+
+    run_tasks(workers, route, WARMUP_REQUESTS * concurrency, targets, 'warmup')
+    results, elapsed = run_tasks(workers, route, requests, targets, 'timed')
+
+    latencies = sorted(seconds * 1000 for seconds, _, _ in results)
+
+    return {
+        "requests": len(results),
+        "errors": sum(not ok for _, _, ok in results),
+        "rps": round(len(results) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+        "sql_per_request": round(
+            statistics.mean(count for _, count, _ in results), 2),
+    }
+
+
+def git_commit():
+    """The short hash of HEAD, with '+' if the tree has changes."""
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+    return commit + ('+' if dirty else '')
+
+
+def print_header(baseline):
+    print(f"{'route':<16} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'SQL/req':>8} {'errors':>7}"
+          + (f" {'req/s Δ':>8} {'p95 Δ':>8}" if baseline else ""))
+
+
+def print_result(route, result, baseline):
+    """Print one route's row, with changes from its `baseline` row."""
+
+    line = (f"{route:<16} {result['rps']:>8.1f} {result['p50_ms']:>8.2f} "
+            f"{result['p95_ms']:>8.2f} {result['p99_ms']:>8.2f} "
+            f"{result['sql_per_request']:>8.2f} {result['errors']:>7}")
+
+    old = (baseline or {}).get(route)
+    if old:
+        line += (f" {result['rps'] / old['rps'] - 1:>+8.0%}"
+                 f" {result['p95_ms'] / old['p95_ms'] - 1:>+8.0%}")
+
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url', default=DATABASE_URL)
+    parser.add_argument('--seed', action='store_true')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--follows', type=int, default=60000)
+    parser.add_argument('--likes', type=int, default=40000)
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--requests', type=int, default=200,
+                        help="requests per route, across all processes")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    args = parser.parse_args()
+
+    routes = args.routes.split(',')
+    unknown = [route for route in routes if route not in ROUTES]
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)}")
+
+    if args.seed:
+        seed(args.database_url, args.users, args.messages, args.follows,
+             args.likes)
+
+    dataset, targets = get_targets(args.database_url)
+    commit = git_commit()
+
+    print(f"{commit}: {dataset['users']:,} users, "
+          f"{dataset['messages']:,} messages, {dataset['follows']:,} follows, "
+          f"{dataset['likes']:,} likes; concurrency {args.concurrency}")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['routes']
+
+    print_header(baseline)
+
+    # fork before the app is imported, so no connection is shared
+    results = {}
+
+    with Workers(args.concurrency, args.database_url) as workers:
+        for route in routes:
+            results[route] = run_route(
+                workers, route, args.requests, args.concurrency, targets)
+            print_result(route, results[route], baseline)
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f"routes-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, 'w') as file:
+        json.dump({
+            "commit": commit,
+            "date": datetime.now(timezone.utc).isoformat(),
+            "dataset": dataset,
+            "concurrency": args.concurrency,
+            "routes": results,
+        }, file, indent=2)
+
+    print(f"Wrote {output}")
+
+
+if __name__ == '__main__':
+    main()
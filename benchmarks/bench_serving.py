@@ -0,0 +1,278 @@
+"""Benchmark how Warbler's throughput scales with server processes and threads.
+
+    python -m benchmarks.bench_serving [--database-url postgresql:///warbler_bench]
+        [--layouts 1x1,1x4,2x1,2x4,4x4] [--routes feed,profile,...]
+        [--clients 16] [--seconds 10] [--output FILE]
+
+For each layout, PROCESSESxTHREADS, the app is served by gunicorn with
+gunicorn.conf.py (pre-forked gthread workers, preloaded app), and
+--clients client processes each send requests over one keep-alive
+connection for --seconds, as soon as the previous response arrives.
+Each request is a random one of --routes, logged in as a random user
+with a signed session cookie.
+
+Unlike bench_routes, which calls the app in-process, this includes the
+HTTP server, and the connection pool is shared by a process's threads.
+The database must already hold data (see bench_routes --seed). Only
+GET routes are used, since the prod profile checks CSRF tokens on
+forms. Clients run on the same machine as the server, so with few
+cores they compete with it for CPU; compare layouts with each other
+rather than with other machines.
+"""
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from benchmarks.bench_routes import (
+    DATABASE_URL, NAME_PREFIXES, ROOT, SEARCH_WORDS, get_targets,
+    git_commit, percentile)
+
+HOST = '127.0.0.1'
+PORT = 8765
+
+# how long gunicorn gets to start answering
+STARTUP_SECONDS = 30
+
+# untimed seconds of load before each layout is measured
+WARMUP_SECONDS = 2
+
+
+##############################################################################
+# Routes: each takes (rng, targets) and returns a path to GET
+
+
+ROUTES = {
+    'feed': lambda rng, targets: '/',
+    'feed_api': lambda rng, targets: '/api/feed',
+    'profile': lambda rng, targets:
+        f"/users/{rng.choice(targets['user_ids'])}",
+    'followers': lambda rng, targets:
+        f"/users/{rng.choice(targets['user_ids'])}/followers",
+    'message': lambda rng, targets:
+        f"/messages/{rng.randint(1, targets['max_message_id'])}",
+    'user_search': lambda rng, targets:
+        f"/users?q={rng.choice(NAME_PREFIXES)}",
+    'message_search': lambda rng, targets:
+        f"/messages/search?q={rng.choice(SEARCH_WORDS)}",
+}
+
+
+def session_cookies(database_url, user_ids):
+    """Signed session cookies logging in each of `user_ids`."""
+
+    os.environ['DATABASE_URL'] = database_url
+
+    from app import create_app, CURR_USER_KEY
+
+    app = create_app('prod')
+    serializer = app.session_interface.get_signing_serializer(app)
+    name = app.config['SESSION_COOKIE_NAME']
+
+    return [f"{name}={serializer.dumps({CURR_USER_KEY: user_id})}"
+            for user_id in user_ids]
+
+
+##############################################################################
+# Server
+
+
+def start_server(database_url, processes, threads):
+    """Start gunicorn with `processes` workers of `threads` threads, and
+    wait until it answers."""
+
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f"{HOST}:{PORT}",
+         '--log-level', 'warning'],
+        cwd=ROOT,
+        env=dict(os.environ, DATABASE_URL=database_url,
+                 WEB_WORKERS=str(processes), WEB_THREADS=str(threads),
+                 WARBLER_CONFIG='prod'),
+    )
+
+    deadline = time.monotonic() + STARTUP_SECONDS
+
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with {server.returncode}")
+        try:
+            socket.create_connection((HOST, PORT), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+
+    stop_server(server)
+    raise RuntimeError(f"gunicorn didn't start in {STARTUP_SECONDS}s")
+
+
+def stop_server(server):
+    server.terminate()
+    server.wait()
+
+
+##############################################################################
+# Clients
+
+
+def client_main(task):
+    """Send requests over one connection until `seconds` have passed.
+
+    Returns [(seconds, ok)] per request.
+    """
+
+    routes, seconds, seed, targets, cookies = task
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection(HOST, PORT)
+    results = []
+
+    deadline = time.perf_counter() + seconds
+
+    while True:
+        path = ROUTES[rng.choice(routes)](rng, targets)
+        headers = {'Cookie': rng.choice(cookies)}
+
+        start = time.perf_counter()
+        if start >= deadline:
+            break
+
+        try:
+            connection.request('GET', path, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status < 400
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            ok = False
+
+        results.append((time.perf_counter() - start, ok))
+
+    connection.close()
+
+    return results
+
+
+def run_load(pool, clients, routes, seconds, targets, cookies, label):
+    """Load the server from every client; returns (results, seconds)."""
+
+    tasks = [(routes, seconds, f"{label}:{client}", targets, cookies)
+             for client in range(clients)]
+
+    start = time.perf_counter()
+    results = [result for client in pool.map(client_main, tasks)
+               for result in client]
+
+    return results, time.perf_counter() - start
+
+
+def run_layout(pool, database_url, processes, threads, args, targets,
+               cookies):
+    """Serve with one layout, warm it up, load it; return its summary."""
+
+    server = start_server(database_url, processes, threads)
+
+    try:
+        run_load(pool, args.clients, args.routes, WARMUP_SECONDS, targets,
+                 cookies, 'warmup')
+        results, elapsed = run_load(pool, args.clients, args.routes,
+                                    args.seconds, targets, cookies, 'timed')
+    finally:
+        stop_server(server)
+
+    latencies = sorted(seconds * 1000 for seconds, _ in results)
+
+    return {
+        "processes": processes,
+        "threads": threads,
+        "requests": len(results),
+        "errors": sum(not ok for _, ok in results),
+        "rps": round(len(results) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "p99_ms": round(percentile(latencies, 0.99), 2),
+    }
+
+
+def parse_layout(layout):
+    processes, threads = layout.lower().split('x')
+    return int(processes), int(threads)
+
+
+def print_result(layout, result, first):
+    print(f"{layout:<8} {result['rps']:>8.1f} "
+          f"{result['rps'] / first['rps']:>7.2f}x "
+          f"{result['p50_ms']:>8.2f} {result['p95_ms']:>8.2f} "
+          f"{result['p99_ms']:>8.2f} {result['errors']:>7}", flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--database-url', default=DATABASE_URL)
+    parser.add_argument('--layouts', default='1x1,1x4,2x1,2x4,4x4',
+                        help="PROCESSESxTHREADS to serve with, in turn")
+    parser.add_argument('--routes', default=','.join(ROUTES))
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    args.routes = args.routes.split(',')
+    unknown = [route for route in args.routes if route not in ROUTES]
+    if unknown:
+        parser.error(f"unknown routes: {', '.join(unknown)}")
+
+    try:
+        layouts = {layout: parse_layout(layout)
+                   for layout in args.layouts.split(',')}
+    except ValueError:
+        parser.error(f"bad --layouts: {args.layouts}")
+
+    dataset, targets = get_targets(args.database_url)
+    commit = git_commit()
+
+    print(f"{commit}: {dataset['users']:,} users, "
+          f"{dataset['messages']:,} messages; {args.clients} clients, "
+          f"{multiprocessing.cpu_count()} CPUs")
+    print(f"{'layout':<8} {'req/s':>8} {'scaling':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+
+    # fork the clients before the app is imported for the cookies
+    results = {}
+
+    with multiprocessing.get_context('fork').Pool(args.clients) as pool:
+        cookies = session_cookies(args.database_url, targets['user_ids'])
+
+        for layout, (processes, threads) in layouts.items():
+            results[layout] = run_layout(pool, args.database_url, processes,
+                                         threads, args, targets, cookies)
+            print_result(layout, results[layout],
+                         next(iter(results.values())))
+
+    output = args.output or os.path.join(
+        ROOT, 'benchmarks', 'results', f"serving-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, 'w') as file:
+        json.dump({
+            "commit": commit,
+            "date": datetime.now(timezone.utc).isoformat(),
+            "dataset": dataset,
+            "clients": args.clients,
+            "cpus": multiprocessing.cpu_count(),
+            "routes": args.routes,
+            "layouts": results,
+        }, file, indent=2)
+
+    print(f"Wrote {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""HTTP cache policy for Warbler's responses.
+
+Views declare how their GET responses may be cached with @cache_policy.
+app.add_header applies the policy after the view runs. Anything
+undeclared (forms carrying CSRF tokens, redirects, POSTs) stays
+`no-store`:
+
+- logged-in HTML is `private` with a short max-age, so back/forward and
+  repeat navigation skip the server;
+- pages an anonymous visitor sees are the same for everyone, so they may
+  be `public` and held by the CDN;
+- views that send an ETag (the profile page, the JSON API) use
+  `private, no-cache` and answer revalidations with 304;
+- static files requested through static_url() carry a content
+  fingerprint, so they never change under their URL and are `immutable`
+  (as long as the fingerprint is the file's current one).
+
+A response that changes the session (a new session, a consumed flash)
+is never cached, since its Set-Cookie and flash are one-offs.
+"""
+
+import hashlib
+import os
+import time
+
+from flask import current_app, session, url_for
+
+PRIVATE_MAX_AGE = 10
+PUBLIC_MAX_AGE = 3600
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+_fingerprints = {}
+_templates_digest = []
+
+
+def cache_policy(private=PRIVATE_MAX_AGE, public=None):
+    """Declare how long a view's responses may be cached, in seconds.
+
+    Logged-in viewers get `private, max-age=<private>`; 0 means `private,
+    no-cache` (always revalidate, for views that send an ETag).
+    Anonymous viewers get `public, max-age=<public>`, or the private
+    policy if `public` is None.
+    """
+
+    def decorator(view):
+        view.cache_policy = (private, public)
+        return view
+
+    return decorator
+
+
+def set_cache_policy(response, policy, logged_in):
+    """Set Cache-Control on `response` from a (private, public) policy."""
+
+    private, public = policy
+
+    if public is not None and not logged_in:
+        response.cache_control.public = True
+        response.cache_control.max_age = public
+
+    else:
+        response.cache_control.private = True
+        if private:
+            response.cache_control.max_age = private
+        else:
+            response.cache_control.no_cache = True
+
+    # the body depends on who is logged in, i.e. on the session cookie
+    response.vary.add('Cookie')
+
+
+def set_static_policy(response, filename, version):
+    """Cache a static file forever if it was fetched under its current
+    fingerprint, `version` (the `v` argument).
+
+    Files fetched without one, or with a stale or made-up one, keep
+    Flask's default, which revalidates with Last-Modified and ETag: the
+    URL serves the current bytes, which mustn't be kept under it.
+    """
+
+    if (version and response.status_code == 200
+            and version == fingerprint(filename)):
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+
+
+def static_url(filename):
+    """URL of a static file with a fingerprint of its contents.
+
+    The fingerprint changes whenever the file does, so browsers and the
+    CDN may keep each URL forever.
+    """
+
+    return url_for('static', filename=filename, v=fingerprint(filename))
+
+
+def fingerprint(filename):
+    """Digest of a static file's contents, recomputed only when its
+    mtime changes."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    mtime = os.stat(path).st_mtime_ns
+
+    cached = _fingerprints.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as file:
+            digest = hashlib.sha1(file.read()).hexdigest()[:12]
+        cached = _fingerprints[path] = (mtime, digest)
+
+    return cached[1]
+
+
+def make_etag(*parts):
+    """Build an ETag from `parts` (e.g. ids and versions).
+
+    Includes a digest of the templates, so a deploy that changes the
+    markup doesn't answer 304 for pages rendered by the old templates.
+    """
+
+    raw = repr((templates_digest(),) + parts).encode('UTF-8')
+
+    return hashlib.sha1(raw).hexdigest()
+
+
+def csrf_etag_parts():
+    """ETag parts for a page that embeds the session's CSRF token.
+
+    The token is signed with the session's secret and expires after
+    WTF_CSRF_TIME_LIMIT, so a 304 must not keep a page whose token
+    belongs to another session, or has expired. The parts are the
+    secret, and which half of the time limit it is now: a page
+    revalidated within the same half still has at least half its
+    token's lifetime left.
+    """
+
+    secret = session.get(current_app.config['WTF_CSRF_FIELD_NAME'])
+    limit = current_app.config['WTF_CSRF_TIME_LIMIT']
+
+    return (secret, int(time.time() // (limit / 2)) if limit else None)
+
+
+def templates_digest():
+    """Digest of every template's source, computed once per process."""
+
+    if not _templates_digest:
+        digest = hashlib.sha1()
+        folder = os.path.join(current_app.root_path,
+                              current_app.template_folder)
+
+        for root, dirs, files in sorted(os.walk(folder)):
+            for name in sorted(files):
+                with open(os.path.join(root, name), 'rb') as file:
+                    digest.update(name.encode('UTF-8'))
+                    digest.update(file.read())
+
+        _templates_digest.append(digest.hexdigest())
+
+    return _templates_digest[0]
@@ -0,0 +1,126 @@
+"""Configuration profiles for create_app().
+
+    create_app('dev')   # the default: debug mode, toolbar, query budgets
+    create_app('test')  # what the test suite runs: strict budgets, no CSRF
+    create_app('prod')  # none of the debug machinery
+
+WARBLER_CONFIG picks the profile when none is passed, e.g. for
+`flask run`. DATABASE_URL and SECRET_KEY come from the environment
+(or .env) in every profile, as do DATABASE_REPLICA_URLS, optional read
+replicas (see replicas.py), WRITE_BEHIND (see write_behind.py), and
+WEB_THREADS, the number of requests
+each process serves at once (see gunicorn.conf.py), which sizes its
+connection pool. WEB_WORKERS, the number of processes, divides the
+CPUs between their password hashing pools (see hashing.py).
+"""
+
+import os
+
+from metrics import TimedQueuePool
+
+DEFAULT_WEB_THREADS = 4
+
+
+def web_threads():
+    """How many requests each server process handles at once."""
+
+    return int(os.environ.get('WEB_THREADS', DEFAULT_WEB_THREADS))
+
+
+def web_workers():
+    """How many server processes run on this host (one per CPU by
+    default)."""
+
+    return int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1))
+
+
+def engine_options(threads):
+    """Connection pool settings for a process serving `threads` requests
+    at once.
+
+    A request holds at most one connection, so the pool keeps one per
+    thread, and the overflow absorbs anything else in the process that
+    needs one. Waiting longer than pool_timeout for a connection fails
+    the request rather than queueing it indefinitely. Connections are
+    pinged on checkout, in case the database or a proxy dropped them
+    while idle, and replaced after half an hour. Checkouts are timed
+    for /metrics.
+    """
+
+    return {
+        'poolclass': TimedQueuePool,
+        'pool_size': threads,
+        'max_overflow': threads,
+        'pool_timeout': 10,
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
+
+
+def replica_binds():
+    """A `replica<N>` bind for each URL in DATABASE_REPLICA_URLS."""
+
+    urls = os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+
+    return {f"replica{number}": url.replace("postgres://", "postgresql://")
+            for number, url in enumerate(filter(None, map(str.strip, urls)))}
+
+
+class Config:
+    """Settings every profile shares."""
+
+    DEBUG = False
+    TESTING = False
+
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    # record each request's SQL, for query budgets and the toolbar
+    SQLALCHEMY_RECORD_QUERIES = False
+    QUERY_BUDGET_STRICT = False
+
+    DEBUG_TOOLBAR = False
+
+    @staticmethod
+    def from_environment():
+        """Settings read from the environment when the app is created."""
+
+        return {
+            'SQLALCHEMY_DATABASE_URI': os.environ['DATABASE_URL'].replace(
+                "postgres://", "postgresql://"),
+            'SECRET_KEY': os.environ['SECRET_KEY'],
+            'SQLALCHEMY_BINDS': replica_binds(),
+            # 'async' or 'durable' to batch likes and follows; see
+            # write_behind.py
+            'WRITE_BEHIND': os.environ.get('WRITE_BEHIND') or None,
+            'SQLALCHEMY_ENGINE_OPTIONS': engine_options(web_threads()),
+        }
+
+
+class DevConfig(Config):
+    DEBUG = True
+    SQLALCHEMY_RECORD_QUERIES = True
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_RECORD_QUERIES = True
+
+    # fail any request that runs more SQL than its view's @query_budget
+    QUERY_BUDGET_STRICT = True
+
+    # Don't have WTForms use CSRF at all, since it's a pain to test
+    WTF_CSRF_ENABLED = False
+
+
+class ProdConfig(Config):
+    pass
+
+
+PROFILES = {
+    'dev': DevConfig,
+    'test': TestConfig,
+    'prod': ProdConfig,
+}
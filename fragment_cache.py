@@ -0,0 +1,135 @@
+"""In-process cache of rendered template fragments.
+
+A message's author, date and text render the same for every viewer, and
+so do a user card's images and name. Templates wrap those parts in
+
+    {% call cached_fragment('message', message.id, message.user_id) %}
+      ...
+    {% endcall %}
+
+and the block renders only on a miss. Anything viewer-specific (like and
+follow buttons) stays outside the block.
+
+Each fragment is keyed by (kind, key) and tagged with its owner's user
+id. Messages can't be edited, so a message fragment changes only when
+its author edits their profile, which drops every fragment they own;
+deleting a message drops its fragment. Other workers' copies expire
+after FRAGMENT_CACHE_TTL seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+from metrics import metrics
+
+FRAGMENT_CACHE_TTL = 60
+FRAGMENT_CACHE_SIZE = 50_000
+
+
+class FragmentCache:
+    """Thread-safe LRU of rendered HTML, keyed by (kind, key)."""
+
+    def __init__(self, maxsize=FRAGMENT_CACHE_SIZE, ttl=FRAGMENT_CACHE_TTL,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._owned = {}
+        self._lock = threading.Lock()
+
+    def render(self, kind, key, owner_id, caller):
+        """Get the cached fragment, rendering it with `caller()` on a miss.
+
+        Called from templates by a {% call %} block, which passes the
+        block's body as `caller`.
+        """
+
+        entry_key = (kind, key)
+        now = self.clock()
+
+        with self._lock:
+            entry = self._entries.get(entry_key)
+
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                metrics.inc('warbler_fragment_cache_hits_total')
+                return entry[2]
+
+            self.misses += 1
+            metrics.inc('warbler_fragment_cache_misses_total')
+
+        # render outside the lock; two threads may both render a miss
+        html = Markup(caller())
+
+        with self._lock:
+            if entry_key in self._entries:
+                self._forget(entry_key)
+
+            self._entries[entry_key] = (now + self.ttl, owner_id, html)
+            self._owned.setdefault(owner_id, set()).add(entry_key)
+
+            while len(self._entries) > self.maxsize:
+                self._forget(next(iter(self._entries)))
+
+        return html
+
+    def _forget(self, entry_key):
+        """Drop one entry and its owner tag. Call with the lock held."""
+
+        _, owner_id, _ = self._entries.pop(entry_key)
+        owned = self._owned.get(owner_id)
+
+        if owned is not None:
+            owned.discard(entry_key)
+            if not owned:
+                del self._owned[owner_id]
+
+    def invalidate(self, kind, key):
+        """Forget one fragment, e.g. a deleted message's."""
+
+        with self._lock:
+            if (kind, key) in self._entries:
+                self._forget((kind, key))
+
+    def invalidate_owner(self, owner_id):
+        """Forget every fragment `owner_id` owns, e.g. after a profile edit."""
+
+        with self._lock:
+            for entry_key in list(self._owned.get(owner_id, ())):
+                self._forget(entry_key)
+
+    def clear(self):
+        """Forget every fragment and reset the statistics."""
+
+        with self._lock:
+            self._entries.clear()
+            self._owned.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Get {hits, misses, hit_rate, size} since the last clear().
+
+        /metrics reports the hits and misses as counters, which clear()
+        doesn't reset.
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+            }
+
+
+fragment_cache = FragmentCache()
@@ -1,30 +1,76 @@
-"""Generate CSVs of random data for Warbler.
+"""Generate CSVs of synthetic data for Warbler.
 
 Students won't need to run this for the exercise; they will just use the CSV
-files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
-"""
+files that this generates. Run it to make bigger data sets for load tests:
 
-import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
-from faker import Faker
-from helpers import get_random_datetime
+    python generator/create_csvs.py --users 10000000 --messages 100000000 \\
+        --follows 1000000000 --likes 300000000 --workers 16
 
-MAX_WARBLER_LENGTH = 140
+Writes users.csv, messages.csv, follows.csv and likes.csv (the shapes
+seed.py loads) to --out. Nothing is fetched from the network, and the
+same --seed gives the same files whatever the number of workers.
+
+The data has the skew production has:
+
+- Popularity follows a power law. Picking users by popularity rank gives
+  rank r a chance proportional to 1/r. The top --celebrities ranks are
+  also followed by a large share of everyone (rank c by 20%/c of users).
+  Rank 1 is user 1, and ranks are spread over the other ids.
+- How many users each user follows, and how many likes a message gets,
+  are Pareto-distributed around the requested means. Totals for follows
+  and likes are therefore approximate.
+- How often users post is just as skewed, but isn't tied to how many
+  followers they have: a few users write most messages. Messages by
+  popular users get more likes.
+- Messages are in time order, with a daily cycle and random bursts of
+  3-10x the usual rate lasting from half an hour to four hours.
+
+Each table is generated in shards of a fixed size, one shard per task in
+a process pool. Every shard streams to its own file with its own seeded
+random generator; the parts are then concatenated in order.
+"""
+
+import argparse
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import time
+from datetime import datetime
+from itertools import accumulate
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+# bcrypt of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+MAX_WARBLER_LENGTH = 140
+
+# rows (users, messages) or followers per shard; fixed, so the output
+# doesn't depend on the number of workers
+SHARD_USERS = 500_000
+SHARD_FOLLOWERS = 50_000
+SHARD_MESSAGES = 500_000
+
+# Pareto shape for follows per user and likes per message: heavy tailed
+PARETO_ALPHA = 1.5
+MAX_FOLLOWING = 5_000
+MAX_LIKES_PER_MESSAGE = 100_000
+
+# rank c of the top celebrities is followed by this share / c of users
+CELEBRITY_REACH = 0.2
 
-# Generate random profile image URLs to use for users
+# spreads popularity ranks over user ids; any odd prime not dividing the
+# number of users gives a one-to-one mapping
+RANK_STRIDE = 2_654_435_761
+
+BURSTS_PER_DAY = 0.3
+
+DAY = 24 * 3600
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +78,351 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
 header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
+    "/static/images/nav-bg.png",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+first_names = """
+    ada alan alex ana ben cara dan eli emma finn gus hana ivan jade kai
+    lee leo lina max mia nia noah omar paz quin ravi rosa sam tara uma
+    vera wes xia yara zoe
+""".split()
+
+cities = """
+    Amsterdam Austin Berlin Bogota Cairo Chicago Denver Dublin Lagos Lima
+    Lisbon London Madrid Manila Mumbai Nairobi Oakland Osaka Oslo Paris
+    Portland Quito Seattle Seoul Sydney Taipei Tokyo Toronto Vienna Zurich
+""".split()
+
+# ordered roughly by frequency; word i is picked with weight 1 / (i + 1)
+words = """
+    the to and a of in is it you that for on my this with be at so just
+    have are was not but what all like out up get now love day can time
+    one about do today new good me we from no your more back will know see
+    when how got people go think night really need still make want great
+    work home going feel first happy never best coffee life much last week
+    birds sing morning rain song nest tree sky feather flight spring garden
+    summer winter music city friends weekend dinner book movie game team
+    news photo trip beach mountain river park street light dream idea plan
+""".split()
+
+word_weights = list(accumulate(1 / rank for rank in range(1, len(words) + 1)))
+
+
+def shard_rng(seed, table, shard):
+    """A random generator for one shard, independent of the others."""
+
+    return random.Random(f"{seed}:{table}:{shard}")
+
+
+def popular_rank(rng, n):
+    """Pick a rank in [1, n] with a chance proportional to 1 / rank."""
+
+    return min(int((n + 1) ** rng.random()), n)
+
+
+def rank_to_id(rank, n):
+    """Map popularity rank to user id, one to one; rank 1 is user 1."""
+
+    stride = RANK_STRIDE if math.gcd(RANK_STRIDE, n) == 1 else 1
+
+    return (rank - 1) * stride % n + 1
+
+
+def id_to_rank(user_id, n):
+    """Inverse of rank_to_id."""
+
+    stride = RANK_STRIDE if math.gcd(RANK_STRIDE, n) == 1 else 1
+
+    return (user_id - 1) * pow(stride, -1, n) % n + 1
+
+
+def active_id(rank, n):
+    """Map posting-activity rank to user id.
+
+    Offset from rank_to_id by half the users, so the most active posters
+    aren't the most followed; otherwise every message from a top poster
+    would fan out to a celebrity's followers.
+    """
+
+    return (rank_to_id(rank, n) + n // 2 - 1) % n + 1
+
+
+def pareto_count(rng, mean, cap):
+    """A Pareto-distributed count with about the given mean, at most cap."""
+
+    scale = mean * (PARETO_ALPHA - 1) / PARETO_ALPHA
+    count = rng.paretovariate(PARETO_ALPHA) * scale
+
+    # round at random, so small means aren't all rounded down
+    return min(int(count + rng.random()), cap)
+
+
+def like_boost(rank):
+    """How many times the usual likes a message by `rank` gets."""
+
+    return 1 + 4 / math.sqrt(rank)
+
+
+def mean_like_boost(n):
+    """Average like_boost per message.
+
+    Posting activity isn't tied to popularity, so this is about the
+    average over all ranks: 1 + 4 / n * sum(1 / sqrt(rank)).
+    """
+
+    return 1 + 8 / math.sqrt(n)
+
+
+def sentence(rng, count):
+    """`count` words, weighted towards the common ones."""
+
+    return ' '.join(rng.choices(words, cum_weights=word_weights, k=count))
+
+
+##############################################################################
+# Shards: each writes one part file and returns its row count
+
+
+def users_shard(path, seed, shard, first_id, last_id):
+    rng = shard_rng(seed, 'users', shard)
+
+    with open(path, 'w') as out:
+        for user_id in range(first_id, last_id + 1):
+            username = f"{rng.choice(first_names)}_{user_id}"
+            out.write(
+                f"{username}@example.com,{username},"
+                f"{rng.choice(image_urls)},{PASSWORD},"
+                f"{sentence(rng, rng.randint(3, 12))},"
+                f"{rng.choice(header_image_urls)},{rng.choice(cities)}\n")
+
+    return last_id - first_id + 1
+
+
+def follows_shard(path, seed, shard, first_id, last_id, users, mean,
+                  celebrities):
+    rng = shard_rng(seed, 'follows', shard)
+    cap = min(MAX_FOLLOWING, (users - 1) // 2)
+    celebrity_ids = [rank_to_id(rank, users)
+                     for rank in range(1, min(celebrities, users) + 1)]
+    rows = 0
+
+    with open(path, 'w') as out:
+        for follower in range(first_id, last_id + 1):
+            followed = {
+                celebrity
+                for rank, celebrity in enumerate(celebrity_ids, 1)
+                if rng.random() < CELEBRITY_REACH / rank
+            }
+
+            wanted = pareto_count(rng, mean, cap)
+            while len(followed) < wanted:
+                followed.add(rank_to_id(popular_rank(rng, users), users))
+
+            followed.discard(follower)
+
+            out.write(''.join(
+                f"{followed_id},{follower}\n" for followed_id in followed))
+            rows += len(followed)
+
+    return rows
+
+
+def make_bursts(seed, start, days):
+    """Random (start, end, multiplier) bursts over the whole time span."""
+
+    rng = random.Random(f"{seed}:bursts")
+    bursts = []
+
+    for day in range(days):
+        if rng.random() < BURSTS_PER_DAY:
+            begin = start + day * DAY + rng.uniform(0, DAY)
+            bursts.append(
+                (begin, begin + rng.uniform(1800, 4 * 3600),
+                 rng.uniform(3, 10)))
+
+    return bursts
+
+
+def message_rate(t, bursts):
+    """Relative posting rate at time t: a daily cycle times any burst."""
+
+    rate = 1 + 0.6 * math.sin(2 * math.pi * (t % DAY) / DAY - math.pi / 2)
+
+    for begin, end, multiplier in bursts:
+        if begin <= t < end:
+            rate *= multiplier
+
+    return rate
+
+
+def messages_shard(path, likes_path, seed, shard, first_id, count, users,
+                   window_start, window_end, bursts, likes_mean):
+    """Write `count` messages posted in [window_start, window_end), and
+    their likes.
+
+    Timestamps are drawn by rejection sampling against message_rate, then
+    sorted, so message ids increase with time.
+    """
+
+    rng = shard_rng(seed, 'messages', shard)
+    bursts = [b for b in bursts if b[1] > window_start and b[0] < window_end]
+    top_rate = 1.6 * max([b[2] for b in bursts], default=1)
+    like_cap = min(MAX_LIKES_PER_MESSAGE, users - 1)
+
+    timestamps = []
+    while len(timestamps) < count:
+        t = rng.uniform(window_start, window_end)
+        if rng.random() * top_rate < message_rate(t, bursts):
+            timestamps.append(t)
+    timestamps.sort()
+
+    likes = 0
+
+    with open(path, 'w') as out, open(likes_path, 'w') as likes_out:
+        for message_id, t in enumerate(timestamps, first_id):
+            author = active_id(popular_rank(rng, users), users)
+            text = sentence(rng, rng.randint(3, 25))[:MAX_WARBLER_LENGTH]
+            timestamp = datetime.utcfromtimestamp(t).isoformat(sep=' ')
+            out.write(f"{text},{timestamp},{author}\n")
+
+            # popular authors' messages get more likes
+            wanted = pareto_count(
+                rng, likes_mean * like_boost(id_to_rank(author, users)), like_cap)
+            likers = set()
+            while len(likers) < wanted:
+                likers.add(rank_to_id(popular_rank(rng, users), users))
+            likers.discard(author)
+
+            likes_out.write(''.join(
+                f"{liker},{message_id}\n" for liker in likers))
+            likes += len(likers)
+
+    return count, likes
+
+
+##############################################################################
+# Driver
+
+
+def split(total, size):
+    """Split 1..total into (first, last) ranges of up to `size`."""
+
+    return [(first, min(first + size - 1, total))
+            for first in range(1, total + 1, size)]
+
+
+def run_shard(task):
+    """Run one shard task in a pool worker; returns (table, shard, rows)."""
+
+    table, shard, fn, args = task
+    return table, shard, fn(*args)
+
+
+def concatenate(out_dir, table, headers, parts):
+    """Join a table's part files, in order, under a header row."""
+
+    with open(os.path.join(out_dir, f"{table}.csv"), 'wb') as out:
+        out.write((','.join(headers) + '\n').encode('UTF-8'))
+
+        for part in parts:
+            with open(part, 'rb') as source:
+                shutil.copyfileobj(source, out, 1 << 20)
+            os.remove(part)
+
+
+def generate(out_dir, users, messages, follows, likes, celebrities, days,
+             end, seed, workers):
+    parts_dir = os.path.join(out_dir, '.parts')
+    os.makedirs(parts_dir, exist_ok=True)
+
+    def part(table, shard):
+        return os.path.join(parts_dir, f"{table}.{shard:06d}.csv")
+
+    tasks = []
+    parts = {'users': [], 'follows': [], 'messages': [], 'likes': []}
+
+    for shard, (first, last) in enumerate(split(users, SHARD_USERS)):
+        parts['users'].append(part('users', shard))
+        tasks.append(('users', shard, users_shard,
+                      (part('users', shard), seed, shard, first, last)))
+
+    follow_mean = follows / users
+    for shard, (first, last) in enumerate(split(users, SHARD_FOLLOWERS)):
+        parts['follows'].append(part('follows', shard))
+        tasks.append(('follows', shard, follows_shard,
+                      (part('follows', shard), seed, shard, first, last,
+                       users, follow_mean, celebrities)))
+
+    end_ts = end.timestamp()
+    start_ts = end_ts - days * DAY
+    bursts = make_bursts(seed, start_ts, days)
+    message_shards = split(messages, SHARD_MESSAGES)
+    window = (end_ts - start_ts) / max(len(message_shards), 1)
+    # so that likes average out at the requested total
+    likes_mean = likes / messages / mean_like_boost(users) if messages else 0
+
+    for shard, (first, last) in enumerate(message_shards):
+        parts['messages'].append(part('messages', shard))
+        parts['likes'].append(part('likes', shard))
+        tasks.append(('messages', shard, messages_shard,
+                      (part('messages', shard), part('likes', shard), seed,
+                       shard, first, last - first + 1, users,
+                       start_ts + shard * window,
+                       start_ts + (shard + 1) * window,
+                       bursts, likes_mean)))
+
+    counts = {table: 0 for table in parts}
+    start = time.monotonic()
+
+    # fork, so workers don't re-run this script's argument parsing
+    context = multiprocessing.get_context('fork')
+    with context.Pool(workers) as pool:
+        for done, (table, shard, rows) in enumerate(
+                pool.imap_unordered(run_shard, tasks), 1):
+            if table == 'messages':
+                counts['messages'] += rows[0]
+                counts['likes'] += rows[1]
+            else:
+                counts[table] += rows
+            print(f"\r{done}/{len(tasks)} shards", end='', flush=True)
+
+    print()
+
+    for table, headers in [('users', USERS_CSV_HEADERS),
+                           ('messages', MESSAGES_CSV_HEADERS),
+                           ('follows', FOLLOWS_CSV_HEADERS),
+                           ('likes', LIKES_CSV_HEADERS)]:
+        concatenate(out_dir, table, headers, parts[table])
+
+    os.rmdir(parts_dir)
+
+    elapsed = time.monotonic() - start
+    total = sum(counts.values())
+    for table, rows in counts.items():
+        print(f"{table}: {rows:,} rows")
+    print(f"{total:,} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000,
+                        help="about how many follows in total")
+    parser.add_argument('--likes', type=int, default=3000,
+                        help="about how many likes in total")
+    parser.add_argument('--celebrities', type=int, default=3)
+    parser.add_argument('--days', type=int, default=730,
+                        help="messages span this many days before --end")
+    parser.add_argument('--end', type=datetime.fromisoformat,
+                        default=datetime(2023, 1, 1))
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--out', default='generator')
+    args = parser.parse_args()
+
+    generate(args.out, args.users, args.messages, args.follows, args.likes,
+             args.celebrities, args.days, args.end, args.seed, args.workers)
@@ -0,0 +1,44 @@
+"""Gunicorn settings for serving Warbler in production.
+
+    gunicorn                       # this file is read from the working dir
+    WEB_WORKERS=4 WEB_THREADS=8 gunicorn
+
+Each of WEB_WORKERS pre-forked processes (one per CPU by default) serves
+up to WEB_THREADS requests at once from a thread pool. Requests mostly
+wait on PostgreSQL, so threads let a process overlap them, while
+processes spread template rendering and JSON encoding across cores.
+config.py sizes each process's connection pool from WEB_THREADS, so
+expect up to WEB_WORKERS * WEB_THREADS * 2 connections at peak.
+Each process also has its own bcrypt pool, HASH_WORKERS processes that
+default to the CPUs divided by WEB_WORKERS (see hashing.py).
+
+The app is imported once in the master and forked into the workers,
+which shares its memory and makes restarts quick. connect_db() discards
+the engine's connections in each child after a fork.
+
+Set METRICS_DIR so that /metrics reports every worker, not just the one
+that answers the scrape (see metrics.py).
+"""
+
+import os
+
+from config import web_threads, web_workers
+from metrics import clear_directory
+
+wsgi_app = "app:create_app('prod')"
+
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+
+workers = web_workers()
+worker_class = 'gthread'
+threads = web_threads()
+
+preload_app = True
+
+# keep-alive connections hold a thread each, so don't keep them long
+keepalive = 2
+
+
+def on_starting(server):
+    # counters start from zero with the server, not with a worker
+    clear_directory()
@@ -0,0 +1,172 @@
+"""Password hashing in a bounded process pool.
+
+bcrypt is deliberately slow. Run on the request thread, a burst of
+logins pins every worker while feed requests queue behind them. Hashes
+run in a small process pool instead, so they don't hold the GIL. The
+number of hashes in flight is capped, and callers wait at most
+HASH_TIMEOUT seconds. Past either limit, callers get HashingUnavailable
+and can answer 503 instead of piling up.
+
+Settings come from the environment:
+
+- BCRYPT_LOG_ROUNDS: work factor for new hashes (default 12). Stored
+  hashes with a different factor are rehashed on the next login.
+- HASH_WORKERS: pool processes in each server process (default: the
+  CPUs shared out between WEB_WORKERS, at least 1). Every server
+  process has its own pool, so a host runs HASH_WORKERS * WEB_WORKERS
+  of them.
+- HASH_QUEUE_LIMIT: hashes running or waiting (default 4 per worker).
+- HASH_TIMEOUT: seconds a caller waits for a result (default 5).
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+from config import web_workers
+from metrics import metrics
+
+BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+HASH_WORKERS = int(os.environ.get(
+    'HASH_WORKERS', max(1, (os.cpu_count() or 1) // web_workers())))
+HASH_QUEUE_LIMIT = int(os.environ.get('HASH_QUEUE_LIMIT', HASH_WORKERS * 4))
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', 5))
+
+
+class HashingUnavailable(Exception):
+    """The hashing pool is full, or didn't answer in time."""
+
+
+def _hash(password, rounds):
+    """Hash `password` (bytes) with bcrypt. Runs in a pool process."""
+
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds)).decode('UTF-8')
+
+
+def _check(hashed, password):
+    """Does `password` (bytes) match `hashed`? Runs in a pool process."""
+
+    return bcrypt.checkpw(password, hashed.encode('UTF-8'))
+
+
+class PasswordHasher:
+    """Runs bcrypt in a process pool with a cap on queued work."""
+
+    def __init__(self, workers=HASH_WORKERS, queue_limit=HASH_QUEUE_LIMIT,
+                 timeout=HASH_TIMEOUT, rounds=BCRYPT_LOG_ROUNDS):
+        self.workers = workers
+        self.timeout = timeout
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(queue_limit)
+        self._pool = None
+        self._pool_pid = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self):
+        """Get this process's pool, starting it on first use.
+
+        A pool inherited across fork() (e.g. from a pre-forking server's
+        master) is unusable, so each process starts its own. Pool
+        processes come from a fork server rather than being forked from
+        this process: it is first used from a request thread, and a fork
+        while another thread holds a lock (e.g. the engines' in
+        Flask-SQLAlchemy) would leave the child stuck on it. The fork
+        server preloads only this module, not the running script.
+        """
+
+        with self._pool_lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                context = multiprocessing.get_context('forkserver')
+                context.set_forkserver_preload([__name__])
+
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=context,
+                )
+                self._pool_pid = os.getpid()
+
+            return self._pool
+
+    def _run(self, fn, *args):
+        """Run `fn(*args)` in the pool and wait for the result.
+
+        Raises HashingUnavailable if the queue is full, the result takes
+        longer than the timeout, or a pool process died.
+        """
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingUnavailable("Too many password hashes queued")
+
+        try:
+            pool = self._get_pool()
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool as error:
+            self._slots.release()
+            self._discard_pool(pool)
+            raise HashingUnavailable("Password hashing pool broke") from error
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise HashingUnavailable("Password hashing timed out")
+        except BrokenProcessPool as error:
+            self._discard_pool(pool)
+            raise HashingUnavailable("Password hashing pool broke") from error
+
+    def _discard_pool(self, pool):
+        """Drop `pool`, broken by a process dying (e.g. OOM killed), so
+        the next hash starts a new one."""
+
+        with self._pool_lock:
+            if self._pool is pool:
+                self._pool = None
+
+        pool.shutdown(wait=False)
+
+    def hash(self, password):
+        """Hash `password` at the configured work factor."""
+
+        if not password:
+            raise ValueError('Password must be non-empty.')
+
+        with metrics.timer('warbler_password_hash_seconds', ('hash',)):
+            return self._run(_hash, password.encode('UTF-8'), self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match the stored `hashed`?"""
+
+        with metrics.timer('warbler_password_hash_seconds', ('check',)):
+            return self._run(_check, hashed, password.encode('UTF-8'))
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a work factor other than the current one?
+
+        bcrypt hashes look like $2b$<rounds>$<salt+hash>.
+        """
+
+        try:
+            return int(hashed.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def shutdown(self):
+        """Stop the pool's processes, if it has been started."""
+
+        with self._pool_lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+
+hasher = PasswordHasher()
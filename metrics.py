@@ -0,0 +1,447 @@
+"""Request, SQL, template and hashing metrics, in Prometheus text format.
+
+init_metrics() measures, by view where there is one:
+
+- each request's latency, status and response size;
+- SQL statements and the time they took, from the engines' cursor
+  events, so also in prod, where queries aren't recorded;
+- template render time, by template, which includes any SQL run by lazy
+  loads in the template;
+- bcrypt time for password hashes and checks (see hashing.py);
+- waits for a pooled database connection (see TimedQueuePool).
+- hits and misses of the user and fragment caches (see user_cache.py
+  and fragment_cache.py).
+
+/metrics serves them all for Prometheus to scrape.
+
+Recording is on every request's path, so it must not become a hot spot
+itself. Each thread adds to its own dict, without a lock, and a scrape
+sums the dicts of all threads. A thread takes a lock only once, to
+register its dict the first time it records.
+
+Totals are kept per process. With several server processes, a scrape
+would see only whichever answered it, so set METRICS_DIR to a directory
+they share: each process writes its totals there every
+METRICS_SYNC_SECONDS, and /metrics adds up everyone's. Totals of
+processes that have exited stay in, as counters must;
+gunicorn.conf.py empties the directory when the server starts.
+
+Settings come from the environment:
+
+- METRICS_DIR: directory shared by the server's processes (default
+  none: each process reports only its own totals).
+- METRICS_SYNC_SECONDS: how often each process writes its totals
+  there (default 5).
+"""
+
+import atexit
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from time import perf_counter
+
+from flask import before_render_template, g, request, template_rendered
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+METRICS_DIR = os.environ.get('METRICS_DIR') or None
+METRICS_SYNC_SECONDS = float(os.environ.get('METRICS_SYNC_SECONDS', 5))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+logger = logging.getLogger(__name__)
+
+# name: (type, label names, histogram buckets, help)
+METRICS = {
+    'warbler_requests_total': (
+        'counter', ('view', 'status'), None,
+        "Requests answered."),
+    'warbler_request_duration_seconds': (
+        'histogram', ('view',), SECONDS_BUCKETS,
+        "Time from a request's first hook to its response."),
+    'warbler_response_size_bytes': (
+        'histogram', ('view',), BYTES_BUCKETS,
+        "Size of response bodies, where known before sending."),
+    'warbler_sql_statements_total': (
+        'counter', ('view',), None,
+        "SQL statements run; view is empty outside views."),
+    'warbler_sql_seconds_total': (
+        'counter', ('view',), None,
+        "Time spent running SQL statements."),
+    'warbler_n_plus_one_total': (
+        'counter', ('view',), None,
+        "Sampled requests' N+1s; see query_watch.py."),
+    'warbler_slow_statements_total': (
+        'counter', ('view',), None,
+        "Statements slower than SLOW_QUERY_MS; see query_watch.py."),
+    'warbler_template_render_seconds': (
+        'histogram', ('template',), SECONDS_BUCKETS,
+        "Time rendering templates, including SQL they run."),
+    'warbler_password_hash_seconds': (
+        'histogram', ('operation',), SECONDS_BUCKETS,
+        "Time waiting for bcrypt to hash or check a password."),
+    'warbler_user_cache_hits_total': (
+        'counter', (), None,
+        "Session users found in the user cache."),
+    'warbler_user_cache_misses_total': (
+        'counter', (), None,
+        "Session users loaded from the database, and then cached."),
+    'warbler_fragment_cache_hits_total': (
+        'counter', (), None,
+        "Template fragments found in the fragment cache."),
+    'warbler_fragment_cache_misses_total': (
+        'counter', (), None,
+        "Template fragments rendered, and then cached."),
+    'warbler_db_pool_wait_seconds': (
+        'histogram', (), SECONDS_BUCKETS,
+        "Time waiting for a pooled connection, including opening one."),
+}
+
+
+class Metrics:
+    """Counters and histograms, kept per thread and summed on demand.
+
+    A counter's value is a number. A histogram's is a list: the count of
+    observations in each bucket, then past the last bucket, then their
+    sum.
+    """
+
+    def __init__(self, directory=METRICS_DIR, interval=METRICS_SYNC_SECONDS):
+        self.directory = directory
+        self.interval = interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._pid = None
+
+        os.register_at_fork(after_in_child=self._forget)
+        atexit.register(self._write_at_exit)
+
+    def _shard(self):
+        """This thread's dict of {(name, labels): value}."""
+
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), amount=1):
+        """Add `amount` to a counter."""
+
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        """Record `value` in a histogram."""
+
+        buckets = METRICS[name][2]
+        shard = self._shard()
+        key = (name, labels)
+        counts = shard.get(key)
+
+        if counts is None:
+            counts = shard[key] = [0] * (len(buckets) + 1) + [0]
+
+        counts[bisect.bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def timer(self, name, labels=()):
+        """Record the seconds the `with` block takes in a histogram."""
+
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, labels, perf_counter() - start)
+
+    def totals(self):
+        """Sum every thread's values: {(name, labels): value}."""
+
+        with self._lock:
+            shards = list(self._shards)
+
+        totals = {}
+
+        for shard in shards:
+            # copying a dict or list holds the GIL, so the owning thread
+            # can't change it halfway through
+            for key, value in dict(shard).items():
+                add(totals, key, value)
+
+        return totals
+
+    def all_totals(self):
+        """Sum this process's totals and those other processes wrote."""
+
+        totals = self.totals()
+
+        if self.directory is None:
+            return totals
+
+        own = f"{os.getpid()}.json"
+
+        for filename in os.listdir(self.directory):
+            if not filename.endswith('.json') or filename == own:
+                continue
+
+            try:
+                with open(os.path.join(self.directory, filename)) as file:
+                    values = json.load(file)
+            except (OSError, ValueError):
+                continue
+
+            for name, labels, value in values:
+                if name in METRICS:
+                    add(totals, (name, tuple(labels)), value)
+
+        return totals
+
+    def start_sync(self):
+        """Start writing this process's totals to the directory, if one
+        is set and this process hasn't started yet."""
+
+        if self.directory is None or self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+
+        threading.Thread(
+            target=self._sync, name='metrics-sync', daemon=True).start()
+
+    def _sync(self):
+        while True:
+            try:
+                self.write()
+            except OSError:
+                # a full or missing directory shouldn't stop the thread
+                logger.exception("Couldn't write metrics to %s",
+                                 self.directory)
+            time.sleep(self.interval)
+
+    def write(self):
+        """Write this process's totals to the directory."""
+
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        values = [[name, list(labels), value]
+                  for (name, labels), value in self.totals().items()]
+
+        # replaced in one step, so readers never see half a file
+        with open(f"{path}.tmp", 'w') as file:
+            json.dump(values, file)
+        os.replace(f"{path}.tmp", path)
+
+    def _write_at_exit(self):
+        if self._pid == os.getpid():
+            self.write()
+
+    def _forget(self):
+        """Start afresh in a forked child, whose parent reports its own
+        totals; its other threads, and any lock they held, are gone."""
+
+        self._lock = threading.Lock()
+        self._shards = []
+        self._local = threading.local()
+        self._pid = None
+
+    def clear(self):
+        """Forget everything recorded in this process."""
+
+        with self._lock:
+            for shard in self._shards:
+                shard.clear()
+
+
+def add(totals, key, value):
+    """Add a counter's or histogram's `value` into `totals[key]`."""
+
+    total = totals.get(key)
+
+    if isinstance(value, list):
+        totals[key] = (list(value) if total is None
+                       else [a + b for a, b in zip(total, value)])
+    else:
+        totals[key] = (total or 0) + value
+
+
+def clear_directory(directory=METRICS_DIR):
+    """Remove totals written by an earlier server's processes."""
+
+    if directory is None:
+        return
+
+    os.makedirs(directory, exist_ok=True)
+
+    for filename in os.listdir(directory):
+        if filename.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(directory, filename))
+
+
+def scrape():
+    """Every process's metrics, as /metrics serves them."""
+
+    return render(metrics.all_totals())
+
+
+def render(totals):
+    """Format {(name, labels): value} in Prometheus text format."""
+
+    series = {}
+    for (name, labels), value in totals.items():
+        series.setdefault(name, []).append((labels, value))
+
+    lines = []
+
+    for name, (kind, label_names, buckets, help) in METRICS.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+
+        # a counter without labels exists from the start, e.g. a cache's
+        # misses before its first lookup
+        if kind == 'counter' and not label_names and name not in series:
+            series[name] = [((), 0)]
+
+        for labels, value in sorted(series.get(name, ())):
+            pairs = list(zip(label_names, labels))
+
+            if kind == 'counter':
+                lines.append(f"{name}{format_labels(pairs)} {value}")
+                continue
+
+            count = 0
+            for bound, in_bucket in zip(buckets + ('+Inf',), value):
+                count += in_bucket
+                le = format_labels(pairs + [('le', str(bound))])
+                lines.append(f"{name}_bucket{le} {count}")
+
+            lines.append(f"{name}_sum{format_labels(pairs)} {value[-1]}")
+            lines.append(f"{name}_count{format_labels(pairs)} {count}")
+
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"')
+               .replace('\n', r'\n') for _, value in pairs)
+
+    return "{" + ",".join(f'{name}="{value}"'
+                          for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+metrics = Metrics()
+
+# the view this thread is serving, and templates it is rendering
+_request = threading.local()
+
+
+class TimedQueuePool(QueuePool):
+    """A QueuePool that records how long checkouts wait."""
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            metrics.observe('warbler_db_pool_wait_seconds', (),
+                            perf_counter() - start)
+
+
+def init_metrics(app, db):
+    """Measure `app`'s requests, SQL and templates.
+
+    Call before registering other hooks, so that requests are timed from
+    the first and to the last of them.
+    """
+
+    binds = [None, *(app.config['SQLALCHEMY_BINDS'] or {})]
+
+    for bind in binds:
+        engine = db.get_engine(app, bind=bind)
+        event.listen(engine, 'before_cursor_execute', start_statement)
+        event.listen(engine, 'after_cursor_execute', finish_statement)
+
+    before_render_template.connect(start_render, app)
+    template_rendered.connect(finish_render, app)
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.teardown_request(end_request)
+
+
+def start_request():
+    metrics.start_sync()
+
+    g.metrics_start = perf_counter()
+    _request.view = request.endpoint or ''
+    _request.renders = []
+
+
+def finish_request(response):
+    """Record the request's latency, status and response size."""
+
+    if 'metrics_start' not in g:
+        return response
+
+    view = _request.view
+
+    metrics.observe('warbler_request_duration_seconds', (view,),
+                    perf_counter() - g.metrics_start)
+    metrics.inc('warbler_requests_total', (view, str(response.status_code)))
+
+    # None for streamed responses
+    size = response.calculate_content_length()
+    if size is not None:
+        metrics.observe('warbler_response_size_bytes', (view,), size)
+
+    return response
+
+
+def end_request(error):
+    _request.view = ''
+
+
+def start_statement(conn, cursor, statement, parameters, context, many):
+    context._metrics_start = perf_counter()
+
+
+def finish_statement(conn, cursor, statement, parameters, context, many):
+    view = (getattr(_request, 'view', ''),)
+
+    metrics.inc('warbler_sql_statements_total', view)
+    metrics.inc('warbler_sql_seconds_total', view,
+                perf_counter() - context._metrics_start)
+
+
+def start_render(app, template, context, **extra):
+    renders = getattr(_request, 'renders', None)
+
+    if renders is None:
+        renders = _request.renders = []
+
+    renders.append(perf_counter())
+
+
+def finish_render(app, template, context, **extra):
+    renders = getattr(_request, 'renders', None)
+
+    if renders:
+        metrics.observe('warbler_template_render_seconds',
+                        (template.name or '',), perf_counter() - renders.pop())
@@ -0,0 +1,129 @@
+"""Apply versioned schema migrations from migrations/ to the database.
+
+    python migrate.py                 # apply every pending migration
+    python migrate.py --status        # list applied and pending migrations
+    python migrate.py --stamp [NNNN]  # mark migrations as applied without
+                                      # running them (all, or up to NNNN)
+
+A database built by `db.create_all()` (seed.py, the tests) already has
+everything the migrations add, so seed.py stamps it.
+"""
+
+import importlib
+import pkgutil
+import sys
+
+from sqlalchemy import text
+
+import migrations
+from app import create_app
+from models import db
+
+
+def discover():
+    """List (version, module) for every migration, oldest first."""
+
+    found = []
+
+    for info in pkgutil.iter_modules(migrations.__path__):
+        version = info.name.split('_', 1)[0]
+        if version.isdigit():
+            module = importlib.import_module(f"migrations.{info.name}")
+            found.append((version, module))
+
+    return sorted(found, key=lambda pair: pair[0])
+
+
+def ensure_version_table(conn):
+    """Create the table recording applied migrations, if needed."""
+
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version TEXT PRIMARY KEY,
+            applied_at TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT now()
+        )
+    """))
+
+
+def applied_versions():
+    """Get the set of versions already applied."""
+
+    with db.engine.begin() as conn:
+        ensure_version_table(conn)
+        rows = conn.execute(text("SELECT version FROM schema_migrations"))
+
+        return {version for (version,) in rows}
+
+
+def record(conn, version):
+    """Mark `version` as applied."""
+
+    conn.execute(
+        text("INSERT INTO schema_migrations (version) VALUES (:version) "
+             "ON CONFLICT DO NOTHING"),
+        {"version": version},
+    )
+
+
+def apply(version, module):
+    """Run one migration and record it.
+
+    Transactional migrations run and are recorded in one transaction.
+    Others (CONCURRENTLY builds) run in autocommit mode, so they must be
+    safe to re-run if interrupted.
+    """
+
+    if getattr(module, 'TRANSACTIONAL', True):
+        with db.engine.begin() as conn:
+            module.upgrade(conn)
+            record(conn, version)
+
+    else:
+        with db.engine.connect() as conn:
+            conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+            module.upgrade(conn)
+            record(conn, version)
+
+
+def upgrade():
+    """Apply every pending migration, oldest first."""
+
+    done = applied_versions()
+
+    for version, module in discover():
+        if version not in done:
+            print(f"Applying {module.__name__}")
+            apply(version, module)
+
+
+def stamp(up_to=None):
+    """Mark migrations (all, or up to version `up_to`) as applied."""
+
+    with db.engine.begin() as conn:
+        ensure_version_table(conn)
+
+        for version, module in discover():
+            if up_to is None or version <= up_to:
+                record(conn, version)
+
+
+def status():
+    """Print each migration and whether it has been applied."""
+
+    done = applied_versions()
+
+    for version, module in discover():
+        state = "applied" if version in done else "pending"
+        print(f"{state:8} {module.__name__}")
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+
+    with create_app().app_context():
+        if args[:1] == ['--status']:
+            status()
+        elif args[:1] == ['--stamp']:
+            stamp(args[1] if len(args) > 1 else None)
+        else:
+            upgrade()
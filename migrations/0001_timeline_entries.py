@@ -0,0 +1,52 @@
+"""Add the materialized home timeline table and fill it.
+
+Timelines are rebuilt from messages and follows. Authors with more than
+10,000 followers are left out; the feed merges them in at read time.
+"""
+
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS timeline_entries (
+            user_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            message_id INTEGER NOT NULL
+                REFERENCES messages (id) ON DELETE CASCADE,
+            author_id INTEGER NOT NULL
+                REFERENCES users (id) ON DELETE CASCADE,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (user_id, message_id)
+        )
+    """))
+
+    conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_timeline_entries_user_id_timestamp
+        ON timeline_entries (user_id, timestamp, message_id)
+    """))
+    conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_timeline_entries_author_id_user_id
+        ON timeline_entries (author_id, user_id)
+    """))
+    conn.execute(text("""
+        CREATE INDEX IF NOT EXISTS ix_timeline_entries_message_id
+        ON timeline_entries (message_id)
+    """))
+
+    conn.execute(text("""
+        INSERT INTO timeline_entries (user_id, message_id, author_id, timestamp)
+        SELECT m.user_id, m.id, m.user_id, m.timestamp
+        FROM messages m
+        UNION
+        SELECT f.user_following_id, m.id, m.user_id, m.timestamp
+        FROM follows f
+        JOIN messages m ON m.user_id = f.user_being_followed_id
+        WHERE m.user_id NOT IN (
+            SELECT user_being_followed_id
+            FROM follows
+            GROUP BY user_being_followed_id
+            HAVING count(*) > 10000
+        )
+        ON CONFLICT DO NOTHING
+    """))
@@ -0,0 +1,37 @@
+"""Secondary indexes for the feed, profile and like queries.
+
+- messages (user_id, timestamp DESC, id DESC): a user's newest messages,
+  used by profile pages, timeline backfill and read-time feed merges.
+- follows (user_following_id, user_being_followed_id): "who does X
+  follow". The primary key leads with user_being_followed_id, so it
+  only covers "who follows X".
+- likes (message_id): like counts, and the cascade when a message is
+  deleted. The (user_id, message_id) unique constraint only covers
+  lookups by user.
+
+The indexes are built CONCURRENTLY, so posting, following and liking
+keep working while they build. Plans are in
+explain/0002_hot_query_indexes.txt.
+"""
+
+from migrations import create_index_concurrently
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    create_index_concurrently(
+        conn,
+        "ix_messages_user_id_timestamp",
+        "ON messages (user_id, timestamp DESC, id DESC)",
+    )
+    create_index_concurrently(
+        conn,
+        "ix_follows_user_following_id",
+        "ON follows (user_following_id, user_being_followed_id)",
+    )
+    create_index_concurrently(
+        conn,
+        "ix_likes_message_id",
+        "ON likes (message_id)",
+    )
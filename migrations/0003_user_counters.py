@@ -0,0 +1,44 @@
+"""Add denormalized message/follow/like counters to users.
+
+The columns are added with a constant default, which PostgreSQL stores
+in the catalog without rewriting the table. They are then filled in
+batches of 10,000 users, each committed separately, so no long-running
+transaction holds row locks on users.
+"""
+
+from sqlalchemy import text
+
+TRANSACTIONAL = False
+
+BATCH_SIZE = 10_000
+
+
+def upgrade(conn):
+    for column in ('messages_count', 'following_count',
+                   'followers_count', 'likes_count'):
+        conn.execute(text(
+            f"ALTER TABLE users "
+            f"ADD COLUMN IF NOT EXISTS {column} INTEGER NOT NULL DEFAULT 0"))
+
+    last_id = conn.execute(text("SELECT max(id) FROM users")).scalar() or 0
+
+    for first_id in range(1, last_id + 1, BATCH_SIZE):
+        conn.execute(
+            text("""
+                UPDATE users u SET
+                    messages_count = (
+                        SELECT count(*) FROM messages m
+                        WHERE m.user_id = u.id),
+                    following_count = (
+                        SELECT count(*) FROM follows f
+                        WHERE f.user_following_id = u.id),
+                    followers_count = (
+                        SELECT count(*) FROM follows f
+                        WHERE f.user_being_followed_id = u.id),
+                    likes_count = (
+                        SELECT count(*) FROM likes l
+                        WHERE l.user_id = u.id)
+                WHERE u.id BETWEEN :first_id AND :last_id
+            """),
+            {"first_id": first_id, "last_id": first_id + BATCH_SIZE - 1},
+        )
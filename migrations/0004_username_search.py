@@ -0,0 +1,31 @@
+"""Indexes for searching users by username.
+
+- users (lower(username) COLLATE "C", id): prefix matches, in order. The
+  C collation makes `LIKE 'abc%'` a plain range scan whatever the
+  database's default collation is.
+- users USING gin (lower(username) gin_trgm_ops): substring matches
+  (`LIKE '%abc%'`), from the pg_trgm extension.
+
+Both are built CONCURRENTLY. Plans are in explain/0004_username_search.txt.
+"""
+
+from sqlalchemy import text
+
+from migrations import create_index_concurrently
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+    create_index_concurrently(
+        conn,
+        "ix_users_username_lower",
+        'ON users ((lower(username) COLLATE "C"), id)',
+    )
+    create_index_concurrently(
+        conn,
+        "ix_users_username_trgm",
+        "ON users USING gin (lower(username) gin_trgm_ops)",
+    )
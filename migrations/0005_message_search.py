@@ -0,0 +1,74 @@
+"""Full-text search over messages.
+
+Adds messages.search_vector, the English tsvector of the text, kept up
+to date by PostgreSQL's built-in tsvector_update_trigger. It is a plain
+column rather than a generated one, so adding it doesn't rewrite the
+table under an exclusive lock; existing rows are filled in batches of
+10,000, each committed separately. Storing the vector, rather than
+indexing the to_tsvector() expression, means matching a message found by
+walking an index, and ranking it, doesn't re-parse its text.
+
+search_vector's statistics target is raised so the planner knows how
+rare uncommon words are, not just the common ones. Without that it
+guesses thousands of matches for a word in a handful of messages, and
+scans the newest messages for them instead of using the GIN index.
+
+Indexes, built CONCURRENTLY:
+
+- messages USING gin (search_vector): the inverted index, messages by
+  stemmed word.
+- messages (timestamp DESC, id DESC): for words in a large share of
+  messages, walking the newest messages and checking each finds a page
+  sooner than collecting every match from the GIN index.
+
+Plans are in explain/0005_message_search.txt.
+"""
+
+from sqlalchemy import text
+
+from migrations import create_index_concurrently
+
+TRANSACTIONAL = False
+
+BATCH_SIZE = 10_000
+
+
+def upgrade(conn):
+    conn.execute(text(
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector TSVECTOR"))
+
+    conn.execute(text("""
+        CREATE OR REPLACE TRIGGER messages_search_vector_update
+        BEFORE INSERT OR UPDATE OF text ON messages
+        FOR EACH ROW EXECUTE FUNCTION
+        tsvector_update_trigger(search_vector, 'pg_catalog.english', text)
+    """))
+
+    last_id = conn.execute(text("SELECT max(id) FROM messages")).scalar() or 0
+
+    for first_id in range(1, last_id + 1, BATCH_SIZE):
+        conn.execute(
+            text("""
+                UPDATE messages
+                SET search_vector = to_tsvector('pg_catalog.english', text)
+                WHERE id BETWEEN :first_id AND :last_id
+                  AND search_vector IS NULL
+            """),
+            {"first_id": first_id, "last_id": first_id + BATCH_SIZE - 1},
+        )
+
+    create_index_concurrently(
+        conn,
+        "ix_messages_search_vector",
+        "ON messages USING gin (search_vector)",
+    )
+    conn.execute(text(
+        "ALTER TABLE messages ALTER COLUMN search_vector "
+        "SET STATISTICS 10000"))
+    conn.execute(text("ANALYZE messages"))
+
+    create_index_concurrently(
+        conn,
+        "ix_messages_timestamp",
+        "ON messages (timestamp DESC, id DESC)",
+    )
@@ -0,0 +1,19 @@
+"""Index likes by (user_id, id) for a user's likes page.
+
+The page lists a user's likes newest first and pages by likes.id. The
+(user_id, message_id) unique constraint finds the user's likes but not
+in that order, so every page sorted all of them. Built CONCURRENTLY;
+plans are in explain/0006_likes_user_id_id.txt.
+"""
+
+from migrations import create_index_concurrently
+
+TRANSACTIONAL = False
+
+
+def upgrade(conn):
+    create_index_concurrently(
+        conn,
+        "ix_likes_user_id_id",
+        "ON likes (user_id, id)",
+    )
@@ -0,0 +1,34 @@
+"""Add a denormalized likes_count to messages.
+
+Like 0003: the column is added with a constant default, without
+rewriting the table, then filled for messages that have likes in id
+batches of 10,000, each committed separately.
+"""
+
+from sqlalchemy import text
+
+TRANSACTIONAL = False
+
+BATCH_SIZE = 10_000
+
+
+def upgrade(conn):
+    conn.execute(text(
+        "ALTER TABLE messages "
+        "ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0"))
+
+    last_id = conn.execute(text("SELECT max(id) FROM messages")).scalar() or 0
+
+    for first_id in range(1, last_id + 1, BATCH_SIZE):
+        conn.execute(
+            text("""
+                UPDATE messages m SET likes_count = c.n
+                FROM (SELECT message_id, count(*) AS n
+                      FROM likes
+                      WHERE message_id BETWEEN :first_id AND :last_id
+                      GROUP BY message_id) c
+                WHERE m.id = c.message_id
+                  AND m.likes_count != c.n
+            """),
+            {"first_id": first_id, "last_id": first_id + BATCH_SIZE - 1},
+        )
@@ -0,0 +1,13 @@
+"""Add users.version, the profile page's ETag (see caching.py).
+
+A constant default is stored in the catalog, so this doesn't rewrite
+the table. Existing users start at version 1.
+"""
+
+from sqlalchemy import text
+
+
+def upgrade(conn):
+    conn.execute(text(
+        "ALTER TABLE users "
+        "ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1"))
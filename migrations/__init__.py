@@ -0,0 +1,48 @@
+"""Versioned schema migrations for Warbler.
+
+Each module here is named `NNNN_description.py` and defines
+`upgrade(conn)`. Modules that set `TRANSACTIONAL = False` get an
+autocommit connection, which CREATE INDEX CONCURRENTLY needs. Run them
+with `python migrate.py`.
+
+Every migration that changes a hot query plan records EXPLAIN output from
+before and after in explain/NNNN_description.txt.
+"""
+
+from sqlalchemy import text
+
+
+def index_is_valid(conn, name):
+    """Does index `name` exist, and is it valid?
+
+    Returns None if it doesn't exist. An interrupted CREATE INDEX
+    CONCURRENTLY leaves behind an index that is not valid.
+    """
+
+    return conn.execute(
+        text("""SELECT i.indisvalid
+                FROM pg_index i
+                JOIN pg_class c ON c.oid = i.indexrelid
+                WHERE c.relname = :name"""),
+        {"name": name},
+    ).scalar()
+
+
+def create_index_concurrently(conn, name, definition):
+    """Build index `name` without taking a lock that blocks writes.
+
+    `definition` is everything after the index name, e.g.
+    "ON messages (user_id, timestamp DESC)". `conn` must be in autocommit
+    mode. An invalid leftover from an interrupted build is dropped and
+    rebuilt.
+    """
+
+    valid = index_is_valid(conn, name)
+
+    if valid:
+        return
+
+    if valid is False:
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    conn.execute(text(f"CREATE INDEX CONCURRENTLY {name} {definition}"))
@@ -1,23 +1,160 @@
 """SQLAlchemy models for Warbler."""
 
-from datetime import datetime
+import os
+from datetime import datetime, timezone
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR, insert as pg_insert
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from hashing import hasher
+from pagination import (
+    PER_PAGE, decode_cursor, keyset_after, keyset_before, make_page, paginate)
+from replicas import RoutingSQLAlchemy
+
+# sessions send GET requests' reads to replicas, if any: see replicas.py
+db = RoutingSQLAlchemy()
 # db = SQLAlchemy(SQLALCHEMY_URI, app=app, record_queries=True)
 
 DEFAULT_IMAGE_URL = "/static/images/default-pic.png"
 DEFAULT_HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
 
+# Authors with more followers than this are not fanned out on write; their
+# messages are merged into followers' feeds at read time instead.
+FANOUT_FOLLOWER_LIMIT = 10_000
+
+# How many of an author's recent messages are copied into a timeline when
+# someone starts following them.
+TIMELINE_BACKFILL = 100
+
+# User search only looks for the term in the middle of usernames from this
+# length on; trigram indexes can't help with shorter terms.
+SEARCH_SUBSTRING_MIN_LENGTH = 3
+
+# Autocomplete sorts at most this many substring matches, so a term that
+# matches half the users costs no more than a rare one.
+AUTOCOMPLETE_CANDIDATES = 100
+
+# Relevance search ranks only this many of the newest matches, so a term
+# found in millions of messages costs no more than a rare one.
+SEARCH_RANK_CANDIDATES = 500
+
+# the username trigram index needs this before create_all builds it
+event.listen(
+    db.metadata,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm'),
+)
+
+
+def unnest_rows(rows, *names):
+    """A table of integer `rows`, e.g. [(user_id, message_id), ...], to
+    select from or join in SQL.
+
+    It is sent as one array parameter per column, so the statement is
+    the same however many rows there are.
+    """
+
+    columns = [list(column) for column in zip(*rows)]
+
+    return (db.func.unnest(*(db.literal(column, ARRAY(db.Integer))
+                             for column in columns))
+            .table_valued(*names)
+            .render_derived())
+
+
+class CountersMixin:
+    """Models with denormalized counter columns (e.g. likes_count)."""
+
+    @classmethod
+    def adjust_counts(cls, ids, **deltas):
+        """Add `deltas` to counter columns of the given rows in SQL.
+
+        `ids` is one id, a list of ids or a select of ids. The increment
+        happens in the UPDATE, so concurrent requests can't lose each
+        other's changes.
+
+            User.adjust_counts(user.id, followers_count=1)
+        """
+
+        if isinstance(ids, int):
+            ids = [ids]
+
+        values = {
+            getattr(cls, name): getattr(cls, name) + delta
+            for name, delta in deltas.items()
+        }
+
+        # counters show on the profile page, whose ETag is the version
+        if 'version' in cls.__table__.c:
+            values[cls.version] = cls.version + 1
+
+        db.session.execute(
+            db.update(cls)
+            .where(cls.id.in_(ids))
+            .values(values)
+            .execution_options(synchronize_session=False)
+        )
+
+    @classmethod
+    def adjust_counts_by_id(cls, deltas, *returning):
+        """Add each row's own deltas to its counter columns, in one UPDATE
+        after locking the rows.
+
+        `deltas` maps ids to {column: delta}. Rows with no deltas still
+        get their version bumped. Returns the result, with the
+        `returning` columns of the updated rows.
+
+            User.adjust_counts_by_id({1: {'likes_count': 2}, 7: {}})
+        """
+
+        ids = sorted(deltas)
+
+        # the UPDATE locks rows in whatever order the planner joins them,
+        # so lock them in id order first, or concurrent batches could
+        # deadlock
+        db.session.execute(
+            db.select(cls.id)
+            .where(cls.id.in_(ids))
+            .order_by(cls.id)
+            .with_for_update()
+        )
+
+        names = sorted({name for row in deltas.values() for name in row})
+        rows = unnest_rows(
+            zip(ids, *([deltas[id].get(name, 0) for id in ids]
+                       for name in names)),
+            'id', *names)
+
+        values = {
+            getattr(cls, name): getattr(cls, name) + rows.c[name]
+            for name in names
+        }
+
+        if 'version' in cls.__table__.c:
+            values[cls.version] = cls.version + 1
+
+        return db.session.execute(
+            db.update(cls)
+            .where(cls.id == rows.c.id)
+            .values(values)
+            .returning(*returning)
+            .execution_options(synchronize_session=False)
+        )
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
 
+    # the primary key covers "who follows X"; this covers "who does X follow"
+    __table_args__ = (
+        db.Index(
+            'ix_follows_user_following_id',
+            'user_following_id', 'user_being_followed_id',
+        ),
+    )
+
     # recursive relationship
     user_being_followed_id = db.Column(
         db.Integer,
@@ -31,6 +168,81 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    @classmethod
+    def followed_ids(cls, user_id, user_ids):
+        """Which of `user_ids` does `user_id` follow? Returns a set."""
+
+        if not user_ids:
+            return set()
+
+        followed = (db.session
+                    .query(cls.user_being_followed_id)
+                    .filter(cls.user_following_id == user_id,
+                            cls.user_being_followed_id.in_(user_ids)))
+
+        return {followed_id for (followed_id,) in followed}
+
+    @classmethod
+    def apply_changes(cls, follows, unfollows):
+        """Add the `follows` and remove the `unfollows`, both lists of
+        (follower id, followed id), with their counters and timelines.
+
+        A handful of statements, however many pairs. Pairs already in
+        the wanted state, or naming a deleted user, change nothing.
+        """
+
+        changes = []
+
+        if unfollows:
+            pairs = unnest_rows(unfollows, 'follower_id', 'followed_id')
+            changes += [
+                (follower_id, followed_id, -1)
+                for follower_id, followed_id in db.session.execute(
+                    db.delete(cls)
+                    .where(db.tuple_(cls.user_following_id,
+                                     cls.user_being_followed_id)
+                           .in_(db.select(pairs.c.follower_id,
+                                          pairs.c.followed_id)))
+                    .returning(cls.user_following_id,
+                               cls.user_being_followed_id)
+                    .execution_options(synchronize_session=False))
+            ]
+
+        if follows:
+            pairs = unnest_rows(follows, 'follower_id', 'followed_id')
+            followed = db.aliased(User)
+            new = (db.select(pairs.c.followed_id, pairs.c.follower_id)
+                   .join(User, User.id == pairs.c.follower_id)
+                   .join(followed, followed.id == pairs.c.followed_id))
+            changes += [
+                (follower_id, followed_id, 1)
+                for followed_id, follower_id in db.session.execute(
+                    pg_insert(cls)
+                    .from_select(['user_being_followed_id',
+                                  'user_following_id'], new)
+                    .on_conflict_do_nothing()
+                    .returning(cls.user_being_followed_id,
+                               cls.user_following_id))
+            ]
+
+        if not changes:
+            return
+
+        deltas = {}
+        for follower_id, followed_id, delta in changes:
+            row = deltas.setdefault(follower_id, {})
+            row['following_count'] = row.get('following_count', 0) + delta
+            row = deltas.setdefault(followed_id, {})
+            row['followers_count'] = row.get('followers_count', 0) + delta
+
+        User.adjust_counts_by_id(deltas)
+
+        TimelineEntry.backfill_many(
+            [(follower, followed) for follower, followed, delta in changes
+             if delta > 0])
+        TimelineEntry.remove_authors(
+            [(follower, followed) for follower, followed, delta in changes
+             if delta < 0])
 
 
 class Like(db.Model):
@@ -43,6 +255,8 @@ class Like(db.Model):
             'user_id',
             'message_id',
             ),
+        db.Index('ix_likes_message_id', 'message_id'),
+        db.Index('ix_likes_user_id_id', 'user_id', 'id'),
         )
 
     id = db.Column(
@@ -68,8 +282,162 @@ class Like(db.Model):
     # user = db.relationship('User', backref="likes")
     # message = db.relationship('Message', backref="likes")
 
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """Which of `message_ids` has `user_id` liked? Returns a set."""
+
+        if not message_ids:
+            return set()
+
+        liked = (db.session
+                 .query(cls.message_id)
+                 .filter(cls.user_id == user_id,
+                         cls.message_id.in_(message_ids)))
 
-class User(db.Model):
+        return {message_id for (message_id,) in liked}
+
+    @classmethod
+    def set_liked(cls, user_id, message_id, liked=None):
+        """Like (`liked=True`), unlike (False) or toggle (None) a message.
+
+        Idempotent: liking a liked message changes nothing. The likes row,
+        the message's likes_count and the user's likes_count change in
+        one statement, which never reads the user's other likes; a
+        concurrent duplicate hits the unique constraint and is ignored.
+        The message must exist.
+
+        Returns (is_liked, message's likes_count) after the change.
+        """
+
+        changed = []
+
+        if liked is not True:
+            deleted = (db.delete(cls)
+                       .where(cls.user_id == user_id,
+                              cls.message_id == message_id)
+                       .returning(cls.id)
+                       .cte('deleted'))
+            changed.append(-db.select(db.func.count())
+                           .select_from(deleted)
+                           .scalar_subquery())
+
+        if liked is not False:
+            row = db.select(db.literal(user_id), db.literal(message_id))
+            if liked is None:
+                row = row.where(~db.exists(deleted.select()))
+
+            inserted = (pg_insert(cls)
+                        .from_select(['user_id', 'message_id'], row)
+                        .on_conflict_do_nothing()
+                        .returning(cls.id)
+                        .cte('inserted'))
+            changed.append(db.select(db.func.count())
+                           .select_from(inserted)
+                           .scalar_subquery())
+
+        change = db.select(sum(changed[1:], changed[0]).label('n')).cte('change')
+        delta = db.select(change.c.n).scalar_subquery()
+
+        message_count = (db.update(Message)
+                         .where(Message.id == message_id, delta != 0)
+                         .values(likes_count=Message.likes_count + delta)
+                         .returning(Message.likes_count)
+                         .cte('message_count'))
+        # the liker's likes_count and the author's profile (which shows
+        # the message's count) both change; one UPDATE covers both rows
+        # in case they are the same user
+        author_id = (db.select(Message.user_id)
+                     .where(Message.id == message_id)
+                     .scalar_subquery())
+        user_count = (db.update(User)
+                      .where(db.or_(User.id == user_id, User.id == author_id),
+                             delta != 0)
+                      .values(
+                          likes_count=User.likes_count + db.case(
+                              (User.id == user_id, delta), else_=0),
+                          version=User.version + 1)
+                      .returning(User.id)
+                      .cte('user_count'))
+
+        if liked is None:
+            is_liked = ~db.exists(deleted.select())
+        else:
+            is_liked = db.literal(liked)
+
+        # unchanged rows aren't updated, so fall back to the current count
+        likes_count = db.func.coalesce(
+            db.select(message_count.c.likes_count).scalar_subquery(),
+            db.select(Message.likes_count)
+            .where(Message.id == message_id)
+            .scalar_subquery(),
+        )
+
+        # marked, so it isn't taken for a read and sent to a replica
+        return db.session.execute(
+            db.select(is_liked, likes_count).add_cte(user_count)
+            .execution_options(writes=True)
+        ).one()
+
+    @classmethod
+    def apply_changes(cls, likes, unlikes):
+        """Add the `likes` and remove the `unlikes`, both lists of
+        (user_id, message_id), with their counters.
+
+        A handful of statements, however many pairs. Pairs already in
+        the wanted state, or naming a deleted user or message, change
+        nothing; counters change by what did.
+        """
+
+        changes = []
+
+        if unlikes:
+            pairs = unnest_rows(unlikes, 'user_id', 'message_id')
+            changes += [
+                (user_id, message_id, -1)
+                for user_id, message_id in db.session.execute(
+                    db.delete(cls)
+                    .where(db.tuple_(cls.user_id, cls.message_id)
+                           .in_(db.select(pairs.c.user_id,
+                                          pairs.c.message_id)))
+                    .returning(cls.user_id, cls.message_id)
+                    .execution_options(synchronize_session=False))
+            ]
+
+        if likes:
+            pairs = unnest_rows(likes, 'user_id', 'message_id')
+            new = (db.select(pairs.c.user_id, pairs.c.message_id)
+                   .join(User, User.id == pairs.c.user_id)
+                   .join(Message, Message.id == pairs.c.message_id))
+            changes += [
+                (user_id, message_id, 1)
+                for user_id, message_id in db.session.execute(
+                    pg_insert(cls)
+                    .from_select(['user_id', 'message_id'], new)
+                    .on_conflict_do_nothing()
+                    .returning(cls.user_id, cls.message_id))
+            ]
+
+        if not changes:
+            return
+
+        message_deltas = {}
+        user_deltas = {}
+        for user_id, message_id, delta in changes:
+            row = message_deltas.setdefault(message_id, {'likes_count': 0})
+            row['likes_count'] += delta
+            row = user_deltas.setdefault(user_id, {'likes_count': 0})
+            row['likes_count'] += delta
+
+        # the authors' profiles show their messages' counts
+        author_ids = Message.adjust_counts_by_id(
+            message_deltas, Message.user_id).scalars()
+        for author_id in author_ids:
+            user_deltas.setdefault(author_id, {})
+
+        User.adjust_counts_by_id(user_deltas)
+
+
+class User(CountersMixin, db.Model):
     """User in the system."""
 
     __tablename__ = 'users'
@@ -114,9 +482,77 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counters for the profile stats. Kept in step by the
+    # routes that post, follow and like, and repaired by reconcile_counts.
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever anything on the user's profile page changes: profile
+    # fields, counters or the likes on their messages. The page's ETag is
+    # built from it; see caching.py.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # User search: a C-collation btree on lower(username) serves prefix
+    # matches in order; a trigram GIN index serves substring matches.
+    __table_args__ = (
+        db.Index(
+            'ix_users_username_lower',
+            db.func.lower(username).collate('C'),
+            id,
+        ),
+        db.Index(
+            'ix_users_username_trgm',
+            db.func.lower(username).label('username_lower'),
+            postgresql_using='gin',
+            postgresql_ops={'username_lower': 'gin_trgm_ops'},
+        ),
+    )
+
+    # The collections below can hold hundreds of thousands of rows, so
+    # they are query-style ("dynamic"): append() and remove() write without
+    # loading the collection, and reading one means building a query.
+    # Pages come from messages_page(), following_page(), followers_page()
+    # and liked_messages_page(). passive_deletes leaves their rows to the
+    # foreign keys' ON DELETE CASCADE when a user is deleted.
+
     # the instance sbeing returned will always be what I passed in
     # as my first arg (Message)
-    messages = db.relationship('Message', backref="user")
+    messages = db.relationship(
+        'Message',
+        backref="user",
+        lazy="dynamic",
+        passive_deletes=True,
+    )
 
     # we have two fk that link back to user
     # which column are we linking to?
@@ -136,7 +572,13 @@ class User(db.Model):
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
         secondaryjoin=(Follows.user_following_id == id),
-        backref="following",
+        backref=db.backref(
+            "following",
+            lazy="dynamic",
+            passive_deletes=True,
+        ),
+        lazy="dynamic",
+        passive_deletes=True,
     )
 
     """
@@ -174,6 +616,8 @@ class User(db.Model):
     liked_messages = db.relationship(
         "Message",
         secondary="likes",
+        lazy="dynamic",
+        passive_deletes=True,
         # primaryjoin=(Like.user_id == id),
         # secondaryjoin=(Like.message_id == id),
         # backref="user"
@@ -192,7 +636,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -214,33 +658,358 @@ class User(db.Model):
 
         If this can't find matching user (or if password is wrong), returns
         False.
+
+        Raises HashingUnavailable if the hashing pool is overloaded.
         """
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
-    def is_followed_by(self, other_user): # TODO: CAN WE USE THIS IN OUR SQL-ALCHEMY FILTERS SOME HOW?
+    def check_password(self, password):
+        """Does `password` match this user's?
+
+        On a match, a hash stored with an old work factor is replaced with
+        one at the current factor; the caller commits it.
+        """
+
+        if not hasher.check(self.password, password):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+
+        return True
+
+    @classmethod
+    def _search_clauses(cls, term):
+        """Get (name, prefix, substring) clauses for searching on `term`.
+
+        `name` is lower(username) in the C collation, the sort key. The
+        prefix match and the sort use the btree on it; the substring match
+        is on plain lower(username), which the trigram index covers.
+        """
+
+        escaped = (term.lower()
+                   .replace('\\', '\\\\')
+                   .replace('%', '\\%')
+                   .replace('_', '\\_'))
+
+        name = db.func.lower(cls.username).collate('C')
+        prefix = name.like(f"{escaped}%", escape='\\')
+        substring = db.func.lower(cls.username).like(
+            f"%{escaped}%", escape='\\')
+
+        return name, prefix, substring
+
+    @classmethod
+    def autocomplete(cls, term, limit=10):
+        """Up to `limit` users for a search-as-you-type box.
+
+        Like the first page of search(), except that past the prefix
+        matches it sorts only a sample of AUTOCOMPLETE_CANDIDATES substring
+        matches, so the cost stays flat however common the term is.
+        """
+
+        name, prefix, substring = cls._search_clauses(term)
+
+        users = (cls.query
+                 .filter(prefix)
+                 .order_by(name, cls.id)
+                 .limit(limit)
+                 .all())
+
+        if len(users) < limit and len(term) >= SEARCH_SUBSTRING_MIN_LENGTH:
+            candidates = (db.select(cls.id, name.label('name'))
+                          .filter(substring, ~prefix)
+                          .limit(AUTOCOMPLETE_CANDIDATES)
+                          .subquery())
+
+            users += (cls.query
+                      .join(candidates, candidates.c.id == cls.id)
+                      .order_by(candidates.c.name, cls.id)
+                      .limit(limit - len(users))
+                      .all())
+
+        return users
+
+    @classmethod
+    def search(cls, term, after=None, per_page=PER_PAGE):
+        """One page of users whose username contains `term`.
+
+        Case-insensitive. Usernames starting with `term` come first, then
+        the rest, each alphabetically. `after` is the cursor from the
+        previous page. Both parts are index scans that stop after one
+        page, however many users match.
+
+        Raises InvalidCursor for a garbled cursor.
+        """
+
+        term = term.lower()
+        name, prefix, substring = cls._search_clauses(term)
+
+        # cursor is (part, name, id); part 0 is prefix matches, 1 the rest
+        cursor = decode_cursor(after, (cls.id, cls.username, cls.id))
+        part, last_name, last_id = cursor or (0, None, None)
+
+        rows = []
+
+        if part == 0:
+            query = cls.query.add_columns(name).filter(prefix)
+            if last_name is not None:
+                query = query.filter(
+                    keyset_after((name, cls.id), (last_name, last_id)))
+
+            rows = [
+                (0, user, user_name) for user, user_name in
+                query.order_by(name, cls.id).limit(per_page + 1)
+            ]
+            last_name = None
+
+        if (len(rows) <= per_page
+                and len(term) >= SEARCH_SUBSTRING_MIN_LENGTH):
+            query = cls.query.add_columns(name).filter(substring, ~prefix)
+            if last_name is not None:
+                query = query.filter(
+                    keyset_after((name, cls.id), (last_name, last_id)))
+
+            rows += [
+                (1, user, user_name) for user, user_name in
+                query.order_by(name, cls.id).limit(per_page + 1 - len(rows))
+            ]
+
+        page = make_page(
+            rows,
+            per_page,
+            lambda row: (row[0], row[2], row[1].id),
+        )
+        page.items = [user for _, user, _ in page.items]
+
+        return page
+
+    def remove_from_counts(self):
+        """Take this user out of other users' counters before deleting it.
+
+        The follows and likes rows themselves go by ON DELETE CASCADE.
+        """
+
+        User.adjust_counts(
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id),
+            followers_count=-1,
+        )
+
+        User.adjust_counts(
+            db.select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == self.id),
+            following_count=-1,
+        )
+
+        # users who liked this user's messages lose those likes
+        lost = (db.select(
+                    Like.user_id,
+                    db.func.count().label('n'))
+                .join(Message, Message.id == Like.message_id)
+                .where(Message.user_id == self.id)
+                .group_by(Like.user_id)
+                .subquery())
+
+        db.session.execute(
+            db.update(User)
+            .where(User.id == lost.c.user_id)
+            .values(likes_count=User.likes_count - lost.c.n,
+                    version=User.version + 1)
+            .execution_options(synchronize_session=False)
+        )
+
+        Message.adjust_counts(
+            db.select(Like.message_id).where(Like.user_id == self.id),
+            likes_count=-1,
+        )
+
+        # ...and the authors of the messages this user liked show fewer
+        User.touch(
+            db.select(Message.user_id)
+            .join(Like, Like.message_id == Message.id)
+            .where(Like.user_id == self.id)
+        )
+
+    @classmethod
+    def versions(cls, ids):
+        """Get {id: version} for those of `ids` that exist."""
+
+        rows = db.session.query(cls.id, cls.version).filter(cls.id.in_(ids))
+
+        return dict(rows.all())
+
+    @classmethod
+    def touch(cls, ids):
+        """Bump the version of the given users; see User.version.
+
+        `ids` is one id, a list of ids or a select of ids.
+        """
+
+        cls.adjust_counts(ids)
+
+    @classmethod
+    def reconcile_counts(cls, first_id, last_id):
+        """Recount the counters of users with ids in [first_id, last_id].
+
+        Repairs drift (e.g. from bulk loads or failed requests) and
+        returns how many users needed fixing. Run it in id batches so
+        each UPDATE holds row locks only briefly.
+        """
+
+        counts = {
+            cls.messages_count: (
+                db.select(db.func.count())
+                .where(Message.user_id == cls.id)
+                .scalar_subquery()),
+            cls.following_count: (
+                db.select(db.func.count())
+                .where(Follows.user_following_id == cls.id)
+                .scalar_subquery()),
+            cls.followers_count: (
+                db.select(db.func.count())
+                .where(Follows.user_being_followed_id == cls.id)
+                .scalar_subquery()),
+            cls.likes_count: (
+                db.select(db.func.count())
+                .where(Like.user_id == cls.id)
+                .scalar_subquery()),
+        }
+
+        result = db.session.execute(
+            db.update(cls)
+            .where(cls.id.between(first_id, last_id))
+            .where(db.or_(*(column != actual
+                            for column, actual in counts.items())))
+            .values({**counts, cls.version: cls.version + 1})
+            .execution_options(synchronize_session=False)
+        )
+
+        return result.rowcount
+
+    def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [
-            user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.followed_ids(other_user.id, [self.id]) == {self.id}
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [
-            user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.followed_ids(self.id, [other_user.id]) == {other_user.id}
+
+    @classmethod
+    def annotate_followed(cls, viewer, users):
+        """Set `is_followed` on each of `users`: does `viewer` follow them?
+
+        Answers every membership question with one query bounded by the
+        number of users passed in, rather than loading viewer.following.
+        """
+
+        users = list(users)
+
+        followed_ids = (
+            Follows.followed_ids(viewer.id, {user.id for user in users})
+            if viewer else set())
+
+        for user in users:
+            user.is_followed = user.id in followed_ids
+
+    def messages_page(self, before=None, per_page=PER_PAGE):
+        """One page of this user's messages, newest first.
+
+        `before` is the cursor from the previous page.
+        """
+
+        return paginate(
+            Message.query.filter(Message.user_id == self.id),
+            (Message.timestamp, Message.id),
+            before,
+            per_page,
+        )
+
+    def following_page(self, before=None, per_page=PER_PAGE):
+        """One page of the users this user follows, newest accounts first.
+
+        `before` is the cursor from the previous page.
+        """
+
+        return self._follows_page(
+            Follows.user_following_id,
+            Follows.user_being_followed_id,
+            before,
+            per_page,
+        )
+
+    def followers_page(self, before=None, per_page=PER_PAGE):
+        """One page of this user's followers, newest accounts first.
+
+        `before` is the cursor from the previous page.
+        """
+
+        return self._follows_page(
+            Follows.user_being_followed_id,
+            Follows.user_following_id,
+            before,
+            per_page,
+        )
+
+    def _follows_page(self, own_column, other_column, before, per_page):
+        """One page of users on the other side of this user's follows.
+
+        Ordered and paged by `other_column` rather than users.id, so the
+        follows index on (own_column, other_column) gives the page in order
+        without reading the rest of the list.
+        """
+
+        cursor = decode_cursor(before, (other_column,))
+
+        users = (User.query
+                 .join(Follows, other_column == User.id)
+                 .filter(own_column == self.id))
+        if cursor:
+            users = users.filter(keyset_before((other_column,), cursor))
+
+        users = (users
+                 .order_by(other_column.desc())
+                 .limit(per_page + 1)
+                 .all())
+
+        return make_page(users, per_page, lambda user: (user.id,))
+
+    def liked_messages_page(self, before=None, per_page=PER_PAGE):
+        """One page of messages this user has liked, latest like first.
+
+        `before` is the cursor from the previous page.
+        """
+
+        cursor = decode_cursor(before, (Like.id,))
+
+        rows = (Message.query
+                .join(Like, Like.message_id == Message.id)
+                .filter(Like.user_id == self.id)
+                .add_columns(Like.id))
+        if cursor:
+            rows = rows.filter(keyset_before((Like.id,), cursor))
+
+        rows = (rows
+                .options(db.joinedload(Message.user))
+                .order_by(Like.id.desc())
+                .limit(per_page + 1)
+                .all())
+
+        page = make_page(rows, per_page, lambda row: (row[1],))
+        page.items = [message for message, _ in page.items]
+
+        return page
 
 
-class Message(db.Model):
+class Message(CountersMixin, db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
@@ -267,9 +1036,153 @@ class Message(db.Model):
         nullable=False,
     )
 
-    # def is_liked(self, user):
-    #     self in g.user.liked_messages
-    #     return t f
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # English tsvector of `text` for search; set by a trigger, see below
+    search_vector = db.deferred(db.Column(
+        TSVECTOR,
+        server_default=db.FetchedValue(),
+        server_onupdate=db.FetchedValue(),
+    ))
+
+    # a user's messages, newest first: profile pages and read-time feed merges;
+    # search: matches by word, and the newest messages for common words
+    __table_args__ = (
+        db.Index(
+            'ix_messages_user_id_timestamp',
+            user_id, timestamp.desc(), id.desc(),
+        ),
+        db.Index(
+            'ix_messages_search_vector',
+            search_vector,
+            postgresql_using='gin',
+        ),
+        db.Index(
+            'ix_messages_timestamp',
+            timestamp.desc(), id.desc(),
+        ),
+    )
+
+    @classmethod
+    def search(cls, terms, by_relevance=False, before=None,
+               per_page=PER_PAGE):
+        """One page of messages matching the search `terms`.
+
+        `terms` is web-search syntax: words, "quoted phrases", `or`, and
+        -excluded words, stemmed in English. Results are newest first, or
+        with `by_relevance`, best match first among the newest
+        SEARCH_RANK_CANDIDATES matches. `before` is the cursor from the
+        previous page.
+
+        Raises InvalidCursor for a garbled cursor.
+        """
+
+        query = db.func.websearch_to_tsquery('english', terms)
+        matches = cls.search_vector.op('@@')(query)
+
+        if not by_relevance:
+            message_key = (cls.timestamp, cls.id)
+            cursor = decode_cursor(before, message_key)
+
+            messages = cls.query.filter(matches)
+            if cursor:
+                messages = messages.filter(keyset_before(message_key, cursor))
+
+            messages = (messages
+                        .options(db.joinedload(cls.user))
+                        .order_by(cls.timestamp.desc(), cls.id.desc())
+                        .limit(per_page + 1)
+                        .all())
+
+            return make_page(messages, per_page, lambda m: (m.timestamp, m.id))
+
+        # ts_rank is a real; as a double it survives the JSON cursor exactly
+        rank = db.cast(db.func.ts_rank(cls.search_vector, query), db.Float)
+
+        candidates = (db.select(cls.id, rank.label('rank'))
+                      .where(matches)
+                      .order_by(cls.timestamp.desc(), cls.id.desc())
+                      .limit(SEARCH_RANK_CANDIDATES)
+                      .subquery())
+
+        rank_key = (candidates.c.rank, candidates.c.id)
+        cursor = decode_cursor(before, rank_key)
+
+        rows = (cls.query
+                .join(candidates, candidates.c.id == cls.id)
+                .add_columns(candidates.c.rank))
+        if cursor:
+            rows = rows.filter(keyset_before(rank_key, cursor))
+
+        rows = (rows
+                .options(db.joinedload(cls.user))
+                .order_by(candidates.c.rank.desc(), candidates.c.id.desc())
+                .limit(per_page + 1)
+                .all())
+
+        page = make_page(rows, per_page, lambda row: (row[1], row[0].id))
+        page.items = [message for message, _ in page.items]
+
+        return page
+
+    @classmethod
+    def annotate_liked(cls, viewer, messages):
+        """Set `is_liked` on each of `messages`: has `viewer` liked it?
+
+        One query bounded by the number of messages passed in, rather than
+        loading viewer.liked_messages.
+        """
+
+        messages = list(messages)
+
+        liked_ids = (
+            Like.liked_ids(viewer.id, {message.id for message in messages})
+            if viewer else set())
+
+        for message in messages:
+            message.is_liked = message.id in liked_ids
+
+    @classmethod
+    def reconcile_counts(cls, first_id, last_id):
+        """Recount likes_count of messages with ids in [first_id, last_id].
+
+        Like User.reconcile_counts; returns how many needed fixing.
+        """
+
+        actual = (db.select(db.func.count())
+                  .where(Like.message_id == cls.id)
+                  .scalar_subquery())
+
+        authors = db.session.execute(
+            db.update(cls)
+            .where(cls.id.between(first_id, last_id))
+            .where(cls.likes_count != actual)
+            .values(likes_count=actual)
+            .returning(cls.user_id)
+            .execution_options(synchronize_session=False)
+        ).scalars().all()
+
+        if authors:
+            User.touch(list(set(authors)))
+
+        return len(authors)
+
+    def remove_from_counts(self):
+        """Take this message out of its author's and likers' counters.
+
+        Call before deleting it; the likes rows go by ON DELETE CASCADE.
+        """
+
+        User.adjust_counts(self.user_id, messages_count=-1)
+        User.adjust_counts(
+            db.select(Like.user_id).where(Like.message_id == self.id),
+            likes_count=-1,
+        )
 
     def serialize(self):
         """ Serialize message instance to python dictionary """
@@ -277,23 +1190,301 @@ class Message(db.Model):
         return {
             "id": self.id,
             "text": self.text,
-            "timestamp": self.timestamp,
+            # naive UTC; ISO 8601 with the offset spelled out
+            "timestamp": self.timestamp.replace(
+                tzinfo=timezone.utc).isoformat(),
             "user_id": self.user_id,
+            "likes_count": self.likes_count,
         }
 
 
+# see migrations/0005_message_search.py
+event.listen(
+    Message.__table__,
+    'after_create',
+    DDL("""
+        CREATE TRIGGER messages_search_vector_update
+        BEFORE INSERT OR UPDATE OF text ON messages
+        FOR EACH ROW EXECUTE FUNCTION
+        tsvector_update_trigger(search_vector, 'pg_catalog.english', text);
+        ALTER TABLE messages ALTER COLUMN search_vector SET STATISTICS 10000
+    """),
+)
 
 
+class TimelineEntry(db.Model):
+    """A message materialized into one user's home timeline.
 
+    Rows are written when a message is posted (fan-out-on-write), so the
+    home feed is one indexed range scan instead of an IN (...) over
+    everyone the user follows.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_id_timestamp',
+            'user_id', 'timestamp', 'message_id',
+        ),
+        db.Index('ix_timeline_entries_author_id_user_id', 'author_id', 'user_id'),
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+    # owner of the timeline
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        nullable=False,
+    )
+
+    # copied from the message so the feed can be ordered from this table
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @staticmethod
+    def _is_fan_out_exempt(author_id):
+        """Does `author_id` have too many followers to fan out to?"""
+
+        followers_count = (db.session
+                           .query(User.followers_count)
+                           .filter(User.id == author_id)
+                           .scalar())
+
+        return followers_count > FANOUT_FOLLOWER_LIMIT
+
+    @staticmethod
+    def _fan_out_exempt_followees(user_id):
+        """Ids of users followed by `user_id` who are not fanned out."""
+
+        query = (db.select(Follows.user_being_followed_id)
+                 .join(User, User.id == Follows.user_being_followed_id)
+                 .where(Follows.user_following_id == user_id,
+                        User.followers_count > FANOUT_FOLLOWER_LIMIT))
+
+        return db.session.execute(query).scalars().all()
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add `message` to its author's timeline and their followers'.
+
+        Authors over FANOUT_FOLLOWER_LIMIT only get their own copy.
+        """
+
+        author_id = message.user_id
+
+        db.session.execute(pg_insert(cls).values(
+            user_id=author_id,
+            message_id=message.id,
+            author_id=author_id,
+            timestamp=message.timestamp,
+        ).on_conflict_do_nothing())
 
+        if cls._is_fan_out_exempt(author_id):
+            return
+
+        followers = db.select(
+            Follows.user_following_id,
+            db.literal(message.id),
+            db.literal(author_id),
+            db.literal(message.timestamp),
+        ).where(Follows.user_being_followed_id == author_id)
+
+        db.session.execute(pg_insert(cls).from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            followers,
+        ).on_conflict_do_nothing())
+
+    @classmethod
+    def backfill(cls, user_id, author_id):
+        """Copy `author_id`'s recent messages into `user_id`'s timeline."""
+
+        if cls._is_fan_out_exempt(author_id):
+            return
+
+        recent = (db.select(
+                    db.literal(user_id),
+                    Message.id,
+                    Message.user_id,
+                    Message.timestamp)
+                  .where(Message.user_id == author_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(TIMELINE_BACKFILL))
+
+        db.session.execute(pg_insert(cls).from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            recent,
+        ).on_conflict_do_nothing())
+
+    @classmethod
+    def backfill_many(cls, pairs):
+        """backfill() for each of `pairs`, (user_id, author_id), in one
+        statement."""
+
+        if not pairs:
+            return
+
+        rows = unnest_rows(pairs, 'user_id', 'author_id')
+        recent = (db.select(Message.id, Message.user_id, Message.timestamp)
+                  .where(Message.user_id == rows.c.author_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(TIMELINE_BACKFILL)
+                  .lateral('recent'))
+        entries = (db.select(rows.c.user_id, recent.c.id, recent.c.user_id,
+                             recent.c.timestamp)
+                   .join(User, User.id == rows.c.author_id)
+                   .join(recent, db.true())
+                   .where(User.followers_count <= FANOUT_FOLLOWER_LIMIT))
+
+        db.session.execute(pg_insert(cls).from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            entries,
+        ).on_conflict_do_nothing())
+
+    @classmethod
+    def remove_authors(cls, pairs):
+        """remove_author() for each of `pairs`, (user_id, author_id), in
+        one statement."""
+
+        if not pairs:
+            return
+
+        rows = unnest_rows(pairs, 'user_id', 'author_id')
+
+        db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == rows.c.user_id,
+                   cls.author_id == rows.c.author_id)
+            .execution_options(synchronize_session=False))
+
+    @classmethod
+    def remove_author(cls, user_id, author_id):
+        """Drop every message by `author_id` from `user_id`'s timeline."""
+
+        (cls.query
+            .filter_by(user_id=user_id, author_id=author_id)
+            .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls):
+        """Rebuild every timeline from the messages and follows tables.
+
+        Used after bulk loads (seed.py) that bypass fan-out. Needs
+        correct follower counts, so reconcile counters first.
+        """
+
+        db.session.execute(db.delete(cls))
+
+        own = db.select(
+            Message.user_id,
+            Message.id,
+            Message.user_id,
+            Message.timestamp,
+        )
+
+        followed = (db.select(
+                        Follows.user_following_id,
+                        Message.id,
+                        Message.user_id,
+                        Message.timestamp)
+                    .join(Message,
+                          Message.user_id == Follows.user_being_followed_id))
+
+        exempt = (db.select(User.id)
+                  .where(User.followers_count > FANOUT_FOLLOWER_LIMIT))
+        followed = followed.where(Message.user_id.not_in(exempt))
+
+        db.session.execute(pg_insert(cls).from_select(
+            ['user_id', 'message_id', 'author_id', 'timestamp'],
+            db.union(own, followed),
+        ))
+
+    @classmethod
+    def feed_for(cls, user, before=None, per_page=PER_PAGE):
+        """One page of `user`'s home feed, newest first.
+
+        Reads the materialized timeline and merges in messages from
+        followed authors that are exempt from fan-out. `before` is the
+        cursor from the previous page.
+        """
+
+        entry_key = (cls.timestamp, cls.message_id)
+        message_key = (Message.timestamp, Message.id)
+        cursor = decode_cursor(before, message_key)
+
+        timeline = (db.select(cls.message_id.label('id'), cls.timestamp)
+                    .where(cls.user_id == user.id))
+        if cursor:
+            timeline = timeline.where(keyset_before(entry_key, cursor))
+
+        sources = [
+            timeline
+            .order_by(cls.timestamp.desc(), cls.message_id.desc())
+            .limit(per_page + 1)
+        ]
+
+        exempt_ids = cls._fan_out_exempt_followees(user.id)
+        if exempt_ids:
+            merged = (db.select(Message.id, Message.timestamp)
+                      .where(Message.user_id.in_(exempt_ids)))
+            if cursor:
+                merged = merged.where(keyset_before(message_key, cursor))
+
+            sources.append(
+                merged
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .limit(per_page + 1)
+            )
+
+        ids = db.union(*sources).subquery()
+
+        messages = (Message
+                    .query
+                    .join(ids, Message.id == ids.c.id)
+                    .options(db.joinedload(Message.user))
+                    .order_by(Message.timestamp.desc(), Message.id.desc())
+                    .limit(per_page + 1)
+                    .all())
+
+        return make_page(messages, per_page, lambda m: (m.timestamp, m.id))
 
 
 def connect_db(app):
     """Connect this database to provided Flask app.
 
-    You should call this in your Flask app.
+    You should call this in your Flask app. No app context is pushed
+    here: each request gets its own, and with it its own session, which
+    is removed when the request ends. Scripts and tests push one with
+    `app.app_context()`.
     """
 
-    app.app_context().push()
-    db.app = app
     db.init_app(app)
+
+    # A pre-forking server may fork after the engines have connected;
+    # the children must not share those sockets with the parent or each
+    # other, so they start with empty pools and leave the parent's
+    # connections to the parent. The engines are looked up now: in the
+    # child, get_engine() could wait forever on a lock that a thread of
+    # the parent held at the fork.
+    engines = [db.get_engine(app, bind=bind)
+               for bind in [None, *(app.config['SQLALCHEMY_BINDS'] or ())]]
+
+    def dispose_engines():
+        for engine in engines:
+            engine.dispose(close=False)
+
+    os.register_at_fork(after_in_child=dispose_engines)
@@ -0,0 +1,143 @@
+"""Keyset (cursor) pagination helpers for Warbler list views.
+
+A cursor is the sort key of the last row on a page, so fetching the next
+page is an indexed range scan (`WHERE (a, b) < (:a, :b)`) that costs the
+same however deep the reader has scrolled. OFFSET is never used.
+"""
+
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import tuple_
+
+PER_PAGE = 20
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor from the querystring can't be decoded."""
+
+
+class Page:
+    """One page of results plus the cursor for the page after it."""
+
+    def __init__(self, items, next_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def has_more(self):
+        return self.next_cursor is not None
+
+
+def encode_cursor(values):
+    """Encode a tuple of sort-key values as an opaque, URL-safe string."""
+
+    plain = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(plain, separators=(',', ':')).encode('UTF-8')
+
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    """Decode `cursor` into values matching the sort `columns`.
+
+    Returns None for an empty cursor; raises InvalidCursor if it is garbled
+    or its values don't fit the columns.
+    """
+
+    if not cursor:
+        return None
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise InvalidCursor(cursor)
+
+        return tuple(decode_value(column, value)
+                     for column, value in zip(columns, values))
+
+    except (ValueError, TypeError) as exc:
+        raise InvalidCursor(cursor) from exc
+
+
+def decode_value(column, value):
+    """Convert one decoded JSON `value` to `column`'s Python type.
+
+    Raises TypeError if it isn't of that type, so a tampered cursor is
+    rejected here rather than by the database.
+    """
+
+    kind = column.type.python_type
+
+    if kind is datetime:
+        if not isinstance(value, str):
+            raise TypeError(value)
+        return datetime.fromisoformat(value)
+
+    # JSON writes a whole float like any int; bool is never a number
+    if kind is float and type(value) is int:
+        return float(value)
+
+    if type(value) is not kind:
+        raise TypeError(value)
+
+    return value
+
+
+def keyset_before(columns, values):
+    """Filter clause for rows sorting after `values` in descending order."""
+
+    return tuple_(*columns) < tuple_(*values)
+
+
+def keyset_after(columns, values):
+    """Filter clause for rows sorting after `values` in ascending order."""
+
+    return tuple_(*columns) > tuple_(*values)
+
+
+def make_page(rows, per_page, key):
+    """Build a Page from up to `per_page + 1` rows.
+
+    The extra row only signals that there is a next page; `key(row)`
+    gives the sort-key values for the cursor.
+    """
+
+    if len(rows) <= per_page:
+        return Page(rows)
+
+    rows = rows[:per_page]
+
+    return Page(rows, encode_cursor(key(rows[-1])))
+
+
+def paginate(query, columns, cursor=None, per_page=PER_PAGE):
+    """Keyset-paginate an ORM `query` in descending `columns` order.
+
+    `columns` must be mapped attributes of the queried entity and together
+    unique (end with the primary key) so the ordering is stable.
+    """
+
+    values = decode_cursor(cursor, columns)
+    if values is not None:
+        query = query.filter(keyset_before(columns, values))
+
+    rows = (query
+            .order_by(*(column.desc() for column in columns))
+            .limit(per_page + 1)
+            .all())
+
+    return make_page(
+        rows,
+        per_page,
+        lambda row: tuple(getattr(row, column.key) for column in columns),
+    )
@@ -0,0 +1,87 @@
+"""Per-view SQL query budgets.
+
+Views declare the most SQL they may run per request:
+
+    @app.get('/')
+    @query_budget(statements=5, sql_ms=50)
+    def homepage():
+        ...
+
+After each request, the statements Flask-SQLAlchemy recorded for it
+(SQLALCHEMY_RECORD_QUERIES) are checked against the view's budget.
+Going over logs a warning naming the view and its statements. With
+QUERY_BUDGET_STRICT set, as the tests set it, it raises
+QueryBudgetExceeded instead. Then an N+1, such as a template lazy
+loading each message's author, fails the test suite as soon as a
+fixture has more rows than the budget.
+
+Statement counts don't depend on the data, so they are exact. SQL time
+does, so time budgets are loose and catch only gross regressions.
+"""
+
+from flask import current_app, g, request
+from flask_sqlalchemy import get_debug_queries
+
+
+class QueryBudgetExceeded(Exception):
+    """A view ran more SQL than its @query_budget allows."""
+
+
+def query_budget(statements, sql_ms=None):
+    """Declare the most statements (and SQL milliseconds) a view may run
+    per request, from its before_request hooks to its response."""
+
+    def decorator(view):
+        view.query_budget = (statements, sql_ms)
+        return view
+
+    return decorator
+
+
+def init_query_budgets(app):
+    """Check every request against its view's budget.
+
+    Call before registering other before_request hooks, so that SQL they
+    run (e.g. loading g.user) counts too.
+    """
+
+    app.before_request(start_query_budget)
+    app.after_request(check_query_budget)
+
+
+def start_query_budget():
+    """Note where this request's recorded statements start."""
+
+    g.query_budget_start = len(get_debug_queries())
+
+
+def check_query_budget(response):
+    """Compare the request's recorded statements with its view's budget."""
+
+    view = current_app.view_functions.get(request.endpoint)
+    budget = getattr(view, 'query_budget', None)
+
+    if budget is None or 'query_budget_start' not in g:
+        return response
+
+    max_statements, max_sql_ms = budget
+    queries = get_debug_queries()[g.query_budget_start:]
+    sql_ms = sum(query.duration for query in queries) * 1000
+
+    over = []
+    if len(queries) > max_statements:
+        over.append(f"{len(queries)} statements (budget {max_statements})")
+    if max_sql_ms is not None and sql_ms > max_sql_ms:
+        over.append(f"{sql_ms:.1f}ms of SQL (budget {max_sql_ms}ms)")
+
+    if over:
+        message = (f"{request.endpoint} ran {' and '.join(over)}:\n"
+                   + "\n".join(f"  {query.context}: {query.statement}"
+                               for query in queries))
+
+        if current_app.config.get('QUERY_BUDGET_STRICT'):
+            raise QueryBudgetExceeded(message)
+
+        current_app.logger.warning(message)
+
+    return response
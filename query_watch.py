@@ -0,0 +1,299 @@
+"""Catch N+1 queries and slow statements in production.
+
+Query budgets (query_budget.py) catch N+1s in the test suite, but only
+on the fixtures' data. init_query_watch() watches real traffic:
+
+- N+1s: in a sample of requests (QUERY_WATCH_SAMPLE_RATE), statements
+  are grouped by shape, i.e. with their parameters and IN lists
+  blanked. A shape that runs N_PLUS_ONE_REPEATS times or more in one
+  request is logged with the view, and the template line (or else the
+  line of Python) that ran it when it reached that count. That is
+  typically a lazy load in a template loop, such as
+  `message.user.image_url` per message.
+- Slow statements: any statement, in any request, that takes
+  SLOW_QUERY_MS or longer is logged with its plan from
+  EXPLAIN (ANALYZE, BUFFERS). The EXPLAIN runs after the fact, on a
+  background thread and a connection of its own to the same database,
+  and in a transaction that is rolled back. ANALYZE runs the statement
+  again, so only plain SELECTs get it; other statements get a plain
+  EXPLAIN. Each shape is explained at most once per
+  SLOW_QUERY_EXPLAIN_INTERVAL seconds per process.
+
+Both go to QUERY_LOG, rotated at QUERY_LOG_BYTES and keeping
+QUERY_LOG_BACKUPS old files; N+1s also go to the app's log. Processes
+don't coordinate rotation, so with several sharing the log, rotated
+files may be shorter than QUERY_LOG_BYTES. The log holds SQL with its
+values filled in, so keep it as private as the database.
+
+Settings come from the environment:
+
+- QUERY_WATCH_SAMPLE_RATE: fraction of requests checked for N+1s
+  (default 0.01).
+- N_PLUS_ONE_REPEATS: runs of one shape that count as an N+1
+  (default 5).
+- SLOW_QUERY_MS: statements at least this slow are explained
+  (default 200).
+- SLOW_QUERY_EXPLAIN_INTERVAL: seconds between EXPLAINs of one shape
+  (default 300).
+- QUERY_LOG: the log file (default logs/queries.log; empty for none).
+- QUERY_LOG_BYTES, QUERY_LOG_BACKUPS: when to rotate it, and how many
+  old files to keep (default 10MB and 5).
+"""
+
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from logging.handlers import RotatingFileHandler
+from time import perf_counter
+
+from flask import request
+from sqlalchemy import event
+
+from metrics import metrics
+
+QUERY_WATCH_SAMPLE_RATE = float(
+    os.environ.get('QUERY_WATCH_SAMPLE_RATE', 0.01))
+N_PLUS_ONE_REPEATS = int(os.environ.get('N_PLUS_ONE_REPEATS', 5))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_EXPLAIN_INTERVAL = float(
+    os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', 300))
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+QUERY_LOG = os.environ.get('QUERY_LOG', os.path.join(ROOT, 'logs',
+                                                     'queries.log'))
+QUERY_LOG_BYTES = int(os.environ.get('QUERY_LOG_BYTES', 10 * 1024 * 1024))
+QUERY_LOG_BACKUPS = int(os.environ.get('QUERY_LOG_BACKUPS', 5))
+
+# slow statements waiting to be explained; more are dropped
+EXPLAIN_QUEUE_SIZE = 10
+
+# longest an EXPLAIN ANALYZE may run
+EXPLAIN_TIMEOUT_MS = 30_000
+
+# bound parameters, e.g. %(user_id_1)s or %s, and runs of them in IN lists
+PARAMETER = re.compile(r"%\(\w+\)s|%s")
+PARAMETER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+
+logger = logging.getLogger('warbler.queries')
+
+
+class QueryWatch:
+    """N+1 and slow statement detection for one app's engines."""
+
+    def __init__(self, app, sample_rate=QUERY_WATCH_SAMPLE_RATE,
+                 repeats=N_PLUS_ONE_REPEATS, slow_ms=SLOW_QUERY_MS,
+                 explain_interval=SLOW_QUERY_EXPLAIN_INTERVAL):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.repeats = repeats
+        self.slow_ms = slow_ms
+        self.explain_interval = explain_interval
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next_explain = {}
+        self._queue = queue.Queue(EXPLAIN_QUEUE_SIZE)
+        self._pid = None
+
+    def listen(self, engine):
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+
+    def start_request(self):
+        """Count this request's statements by shape, if it's sampled."""
+
+        self._local.view = request.endpoint or ''
+        self._local.shapes = ({} if random.random() < self.sample_rate
+                              else None)
+        self._local.repeated = []
+
+    def end_request(self, error=None):
+        """Report the request's N+1s."""
+
+        view = getattr(self._local, 'view', '')
+        repeated = getattr(self._local, 'repeated', ())
+
+        for shape, origin in repeated:
+            count = self._local.shapes[shape]
+            message = (f"N+1 in {view or 'no view'}: {count} statements "
+                       f"from {origin}: {shape}")
+
+            self.app.logger.warning(message)
+            logger.warning(message)
+            metrics.inc('warbler_n_plus_one_total', (view,))
+
+        self._local.view = ''
+        self._local.shapes = None
+        self._local.repeated = []
+
+    def _before(self, conn, cursor, statement, parameters, context, many):
+        context._query_watch_start = perf_counter()
+
+    def _after(self, conn, cursor, statement, parameters, context, many):
+        seconds = perf_counter() - context._query_watch_start
+        shapes = getattr(self._local, 'shapes', None)
+
+        if shapes is not None:
+            shape = statement_shape(statement)
+            count = shapes[shape] = shapes.get(shape, 0) + 1
+
+            # where it came from when it first looks like an N+1
+            if count == self.repeats:
+                self._local.repeated.append((shape, statement_origin()))
+
+        if seconds * 1000 >= self.slow_ms:
+            # one set of an executemany's parameters is enough to plan it
+            self._slow(conn.engine, statement,
+                       parameters[0] if many else parameters, seconds)
+
+    def _slow(self, engine, statement, parameters, seconds):
+        """Queue a slow statement to be explained, unless its shape was
+        explained recently or the queue is full."""
+
+        view = getattr(self._local, 'view', '')
+        metrics.inc('warbler_slow_statements_total', (view,))
+
+        shape = statement_shape(statement)
+        now = time.monotonic()
+
+        with self._lock:
+            if self._next_explain.get(shape, 0) > now:
+                return
+            self._next_explain[shape] = now + self.explain_interval
+
+        self._start()
+
+        try:
+            self._queue.put_nowait(
+                (engine, view, statement, parameters, seconds))
+        except queue.Full:
+            pass
+
+    def _start(self):
+        """Start this process's explaining thread, if it hasn't yet.
+
+        The thread doesn't survive fork(), so a child starts its own.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._queue = queue.Queue(EXPLAIN_QUEUE_SIZE)
+            self._pid = os.getpid()
+
+            threading.Thread(target=self._run, name='query-watch',
+                             daemon=True).start()
+
+    def _run(self):
+        while True:
+            slow = self._queue.get()
+            try:
+                self._explain(*slow)
+            except Exception:
+                self.app.logger.exception("Couldn't explain a slow statement")
+            finally:
+                self._queue.task_done()
+
+    def _explain(self, engine, view, statement, parameters, seconds):
+        """Log `statement` with its plan, from a connection of our own.
+
+        A raw DBAPI connection, so the EXPLAIN itself isn't seen by the
+        engine's events, and isn't measured or explained in turn.
+        """
+
+        explain = ("EXPLAIN (ANALYZE, BUFFERS)" if is_plain_select(statement)
+                   else "EXPLAIN")
+
+        connection = engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(
+                f"SET LOCAL statement_timeout = {EXPLAIN_TIMEOUT_MS}")
+            cursor.execute(f"{explain} {statement}", parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            cursor.close()
+        except Exception as error:
+            plan = f"(EXPLAIN failed: {error})"
+        finally:
+            # ANALYZE ran the statement; undo anything it did
+            connection.rollback()
+            connection.close()
+
+        logger.warning("Slow statement in %s: %.1fms\n%s\n%s:\n%s",
+                       view or 'no view', seconds * 1000, statement,
+                       explain, plan)
+
+    def join(self):
+        """Wait until the slow statements queued so far are logged."""
+
+        if self._pid == os.getpid():
+            self._queue.join()
+
+
+def statement_shape(statement):
+    """`statement` with its parameters, and lists of them, as ?."""
+
+    return PARAMETER_LIST.sub("?, ...", PARAMETER.sub("?", statement))
+
+
+def is_plain_select(statement):
+    """Whether `statement` only reads, so running it again is harmless."""
+
+    words = statement.lstrip().upper()
+
+    return words.startswith("SELECT") and " FOR UPDATE" not in words
+
+
+def statement_origin():
+    """The template line running the current statement, if a template is,
+    else the innermost line of the app's own Python."""
+
+    python = None
+    frame = sys._getframe(1)
+
+    while frame is not None:
+        template = frame.f_globals.get('__jinja_template__')
+
+        if template is not None:
+            line = template.get_corresponding_lineno(frame.f_lineno)
+            return f"{template.name or '<template>'}:{line}"
+
+        code = frame.f_code
+        if (python is None and code.co_filename.startswith(ROOT)
+                and code.co_filename != __file__
+                and 'site-packages' not in code.co_filename):
+            python = (f"{os.path.relpath(code.co_filename, ROOT)}:"
+                      f"{frame.f_lineno} in {code.co_name}")
+
+        frame = frame.f_back
+
+    return python or "unknown"
+
+
+def init_query_watch(app, db):
+    """Watch the SQL of `app`'s engines for N+1s and slow statements."""
+
+    watch = app.extensions['query_watch'] = QueryWatch(app)
+
+    for bind in [None, *(app.config['SQLALCHEMY_BINDS'] or {})]:
+        watch.listen(db.get_engine(app, bind=bind))
+
+    app.before_request(watch.start_request)
+    app.teardown_request(watch.end_request)
+
+    if not logger.handlers and QUERY_LOG:
+        os.makedirs(os.path.dirname(QUERY_LOG) or '.', exist_ok=True)
+        handler = RotatingFileHandler(
+            QUERY_LOG, maxBytes=QUERY_LOG_BYTES,
+            backupCount=QUERY_LOG_BACKUPS, delay=True)
+        handler.setFormatter(
+            logging.Formatter("%(asctime)s [%(process)d] %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
@@ -0,0 +1,37 @@
+"""Recount the denormalized counters on users and messages and repair
+any drift.
+
+    python reconcile_counts.py
+
+Safe to run while the site is up: rows are fixed in id batches, each in
+its own short transaction.
+"""
+
+from app import create_app
+from models import db, Message, User
+
+BATCH_SIZE = 10_000
+
+
+def reconcile(batch_size=BATCH_SIZE):
+    """Recount every user's and message's counters.
+
+    Returns how many rows needed fixing.
+    """
+
+    repaired = 0
+
+    for model in (User, Message):
+        last_id = db.session.query(db.func.max(model.id)).scalar() or 0
+
+        for first_id in range(1, last_id + 1, batch_size):
+            repaired += model.reconcile_counts(
+                first_id, first_id + batch_size - 1)
+            db.session.commit()
+
+    return repaired
+
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        print(f"Repaired counters for {reconcile()} users and messages")
@@ -0,0 +1,249 @@
+"""Send reads to read replicas, and writes to the primary.
+
+With DATABASE_REPLICA_URLS set (comma-separated), config.py adds each
+replica as a bind, `replica0`, `replica1`, ... Each GET or HEAD request
+picks a healthy replica, and its session sends plain SELECTs there.
+Everything else goes to the primary (SQLALCHEMY_DATABASE_URI):
+
+- requests with any other method;
+- flushes, INSERT/UPDATE/DELETE and SELECT ... FOR UPDATE;
+- SELECTs over data-modifying CTEs (WITH ... AS (DELETE ...) SELECT),
+  which must be marked with execution_options(writes=True);
+- any read after the first write in the same session.
+
+Replication lags, so a user who just posted, liked or followed would
+often not see it on the page they are redirected to. After a request
+that writes, its user's session cookie pins their reads to the primary
+for REPLICA_STICKY_SECONDS.
+
+A replica is ejected when it can't be reached, or when it has fallen
+more than REPLICA_MAX_LAG_SECONDS behind. Each process checks its
+replicas at most every REPLICA_CHECK_SECONDS, and an ejected one is
+rechecked after REPLICA_EJECT_SECONDS. With no replica healthy, reads
+go to the primary.
+
+To try it locally, stand in a copy of the database for a replica:
+
+    createdb -T warbler warbler_replica
+    DATABASE_REPLICA_URLS=postgresql:///warbler_replica flask run
+
+The copy doesn't replicate, so writes show up in its pages only while
+they are sticky.
+"""
+
+import random
+import threading
+import time
+
+from flask import current_app, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, orm
+
+REPLICA_STICKY_SECONDS = 5
+REPLICA_CHECK_SECONDS = 5
+REPLICA_EJECT_SECONDS = 30
+REPLICA_MAX_LAG_SECONDS = 10
+
+PRIMARY_UNTIL_KEY = "primary_until"
+
+# seconds behind the primary; 0 on a replica that has replayed all it
+# received, and on a database that isn't a replica at all
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery()
+            OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the engine in `info['replica']`, if
+    set, until it first writes."""
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or is_write(clause):
+            # read this session's writes back from where they went
+            self.info['wrote'] = True
+            self.info['replica'] = None
+
+        replica = self.info.get('replica')
+
+        if replica is not None and is_plain_select(clause):
+            return replica
+
+        return super().get_bind(mapper, clause)
+
+
+def is_write(clause):
+    """Whether `clause` is INSERT/UPDATE/DELETE, or marked as writing.
+
+    A SELECT whose CTEs write looks like any other from the outside, and
+    finding them means walking the whole statement, so its maker marks
+    it with execution_options(writes=True) instead.
+    """
+
+    return (getattr(clause, 'is_dml', False)
+            or (hasattr(clause, 'get_execution_options')
+                and clause.get_execution_options().get('writes', False)))
+
+
+def is_plain_select(clause):
+    """Whether `clause` is a SELECT that takes no locks and doesn't write."""
+
+    return (getattr(clause, 'is_select', False)
+            and getattr(clause, '_for_update_arg', None) is None
+            and not is_write(clause))
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy whose sessions are RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class ReplicaSet:
+    """The replica binds of one app, and which of them are healthy."""
+
+    def __init__(self, db, app, keys, clock=time.monotonic):
+        self.db = db
+        self.app = app
+        self.keys = keys
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._healthy = dict.fromkeys(keys, True)
+        self._next_check = dict.fromkeys(keys, 0.0)
+
+        for key in keys:
+            event.listen(self.engine(key), 'handle_error',
+                         self._on_error(key))
+
+    def engine(self, key):
+        return self.db.get_engine(self.app, bind=key)
+
+    def choose(self):
+        """Pick a healthy replica's key at random, or None."""
+
+        now = self.clock()
+
+        for key in self.keys:
+            if self._next_check[key] <= now:
+                self.check(key)
+
+        healthy = [key for key in self.keys if self._healthy[key]]
+
+        return random.choice(healthy) if healthy else None
+
+    def check(self, key):
+        """Check that `key` answers and isn't lagging; eject it if not.
+
+        One thread checks at a time; others carry on with the last
+        known health rather than wait.
+        """
+
+        if not self._lock.acquire(blocking=False):
+            return
+
+        try:
+            if self._next_check[key] > self.clock():
+                return
+
+            # not through the engine's events, so the check doesn't
+            # count towards the request's query budget
+            connection = self.engine(key).raw_connection()
+            try:
+                cursor = connection.cursor()
+                cursor.execute(REPLICA_LAG_SQL)
+                lag = cursor.fetchone()[0]
+                cursor.close()
+                connection.commit()
+            finally:
+                connection.close()
+
+        except Exception as error:
+            self.eject(key, error)
+
+        else:
+            if lag > REPLICA_MAX_LAG_SECONDS:
+                self.eject(key, f"{lag:.0f}s behind the primary")
+            else:
+                self._healthy[key] = True
+                self._next_check[key] = self.clock() + REPLICA_CHECK_SECONDS
+
+        finally:
+            self._lock.release()
+
+    def eject(self, key, reason):
+        """Stop reading from `key` until it passes a check again."""
+
+        if self._healthy[key]:
+            self.app.logger.warning("Ejecting replica %s: %s", key, reason)
+
+        self._healthy[key] = False
+        self._next_check[key] = self.clock() + REPLICA_EJECT_SECONDS
+
+    def _on_error(self, key):
+        def on_error(context):
+            # no connection means connecting failed
+            if context.is_disconnect or context.connection is None:
+                self.eject(key, context.original_exception)
+
+        return on_error
+
+    def stats(self):
+        """Get {key: healthy} for each replica."""
+
+        return dict(self._healthy)
+
+
+def init_replicas(app, db):
+    """Route the reads of GET requests to `app`'s replica binds, if any.
+
+    Call before registering other before_request hooks, so that SQL they
+    run (e.g. loading g.user) goes to the replica too.
+    """
+
+    keys = sorted(key for key in (app.config['SQLALCHEMY_BINDS'] or {})
+                  if key.startswith('replica'))
+
+    if not keys:
+        return
+
+    app.extensions['replicas'] = ReplicaSet(db, app, keys)
+
+    app.before_request(route_reads)
+    app.after_request(stick_to_primary)
+
+
+def route_reads():
+    """Point this request's session at a replica, unless it may write or
+    its user wrote moments ago."""
+
+    db = current_app.extensions['sqlalchemy'].db
+    replicas = current_app.extensions['replicas']
+
+    db.session.info['wrote'] = False
+    db.session.info['replica'] = None
+
+    if request.method not in ('GET', 'HEAD'):
+        return
+
+    if session.get(PRIMARY_UNTIL_KEY, 0) > time.time():
+        return
+
+    key = replicas.choose()
+
+    if key is not None:
+        db.session.info['replica'] = replicas.engine(key)
+
+
+def stick_to_primary(response):
+    """After a write, read this user's pages from the primary for a bit."""
+
+    db = current_app.extensions['sqlalchemy'].db
+
+    if db.session.info.get('wrote'):
+        session[PRIMARY_UNTIL_KEY] = time.time() + REPLICA_STICKY_SECONDS
+
+    return response
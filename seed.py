@@ -1,19 +1,369 @@
-"""Seed database with sample data from CSV Files."""
+"""Load a CSV snapshot into a fresh database.
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+    python seed.py [--data-dir generator] [--chunk-rows 50000] [--restart]
 
-db.drop_all()
-db.create_all()
+Reads users.csv, messages.csv, follows.csv and (if present) likes.csv
+from --data-dir; each file's header names its columns. Rows stream into
+PostgreSQL COPY in chunks of --chunk-rows, so memory use is flat however
+big the snapshot is.
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+Primary keys, unique and foreign key constraints and indexes are dropped
+before loading and built once at the end, rather than maintained row by
+row. Then id sequences are moved past the loaded ids, counters are
+recounted and timelines rebuilt.
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+Each chunk commits together with a checkpoint of how far into its file
+the load has got. Run the same command again after an interruption and
+it carries on from the last checkpoint; --restart starts over.
+"""
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+import argparse
+import io
+import os
+import time
 
-db.session.commit()
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import AddConstraint, CreateIndex
+
+from app import create_app
+from migrate import stamp
+from models import db, TimelineEntry
+from reconcile_counts import reconcile
+
+CHUNK_ROWS = 50_000
+
+# table: is the CSV required?
+SNAPSHOT_TABLES = {
+    'users': True,
+    'messages': True,
+    'follows': True,
+    'likes': False,
+}
+
+# steps after the COPYs, in order
+FINISHING_STEPS = ('constraints', 'sequences', 'counters', 'timelines')
+
+
+##############################################################################
+# Checkpoints
+
+
+def has_checkpoints():
+    """Is there an unfinished load to resume?"""
+
+    return inspect(db.engine).has_table('seed_checkpoints')
+
+
+def create_checkpoints():
+    """Create the table recording each step's progress."""
+
+    with db.engine.begin() as conn:
+        conn.execute(text("""
+            CREATE TABLE seed_checkpoints (
+                step TEXT PRIMARY KEY,
+                byte_offset BIGINT NOT NULL DEFAULT 0,
+                rows BIGINT NOT NULL DEFAULT 0,
+                done BOOLEAN NOT NULL DEFAULT false
+            )
+        """))
+
+
+def get_checkpoint(step):
+    """Get (byte_offset, rows, done) for `step`."""
+
+    with db.engine.begin() as conn:
+        row = conn.execute(
+            text("SELECT byte_offset, rows, done FROM seed_checkpoints "
+                 "WHERE step = :step"),
+            {"step": step},
+        ).one_or_none()
+
+    return tuple(row) if row else (0, 0, False)
+
+
+SAVE_CHECKPOINT = """
+    INSERT INTO seed_checkpoints (step, byte_offset, rows, done)
+    VALUES (%(step)s, %(byte_offset)s, %(rows)s, %(done)s)
+    ON CONFLICT (step) DO UPDATE SET
+        byte_offset = EXCLUDED.byte_offset,
+        rows = EXCLUDED.rows,
+        done = EXCLUDED.done
+"""
+
+
+def mark_done(step):
+    """Record that `step` has finished."""
+
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(
+            SAVE_CHECKPOINT,
+            {"step": step, "byte_offset": 0, "rows": 0, "done": True},
+        )
+
+
+##############################################################################
+# Schema
+
+
+def create_schema():
+    """Create every table, without the constraints and indexes."""
+
+    db.drop_all()
+
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP TABLE IF EXISTS seed_checkpoints"))
+
+    db.create_all()
+
+    # create_all already built everything the migrations add
+    stamp()
+
+    drop_constraints_and_indexes()
+    create_checkpoints()
+
+
+def drop_constraints_and_indexes():
+    """Drop keys, constraints and indexes from the model tables.
+
+    build_constraints_and_indexes() puts them back from the models. The
+    catalogs are read directly: the inspector skips expression indexes.
+    """
+
+    tables = [table.name for table in db.metadata.sorted_tables]
+
+    with db.engine.begin() as conn:
+        # foreign keys first, since they depend on the other tables' keys
+        constraints = conn.execute(
+            text("""
+                SELECT conrelid::regclass::text, conname
+                FROM pg_constraint
+                WHERE conrelid::regclass::text = ANY(:tables)
+                  AND contype IN ('f', 'u', 'p')
+                ORDER BY contype = 'f' DESC
+            """),
+            {"tables": tables},
+        ).all()
+
+        for table, name in constraints:
+            conn.exec_driver_sql(
+                f'ALTER TABLE "{table}" DROP CONSTRAINT "{name}"')
+
+        # what's left is every index not backing a constraint
+        indexes = conn.execute(
+            text("""
+                SELECT indexrelid::regclass::text
+                FROM pg_index
+                WHERE indrelid::regclass::text = ANY(:tables)
+            """),
+            {"tables": tables},
+        ).scalars().all()
+
+        for index in indexes:
+            conn.exec_driver_sql(f'DROP INDEX {index}')
+
+
+def build_constraints_and_indexes():
+    """Recreate the model tables' keys, constraints and indexes."""
+
+    tables = db.metadata.sorted_tables
+
+    statements = []
+
+    for table in tables:
+        statements.append(AddConstraint(table.primary_key))
+        statements += [
+            AddConstraint(constraint)
+            for constraint in table.constraints
+            if isinstance(constraint, db.UniqueConstraint)
+        ]
+        statements += [CreateIndex(index) for index in table.indexes]
+
+    for table in tables:
+        statements += [
+            AddConstraint(constraint)
+            for constraint in table.foreign_key_constraints
+        ]
+
+    # one transaction, so an interrupted build leaves nothing to redo
+    with db.engine.begin() as conn:
+        for statement in statements:
+            start = time.monotonic()
+            conn.execute(statement)
+            print(f"  {str(statement).splitlines()[0].strip()[:70]} "
+                  f"({time.monotonic() - start:.1f}s)")
+
+
+def fix_sequences():
+    """Move each id sequence past the highest loaded id."""
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if 'id' in table.c and table.c.id.autoincrement in (True, 'auto'):
+                conn.execute(text(f"""
+                    SELECT setval(
+                        pg_get_serial_sequence('"{table.name}"', 'id'),
+                        coalesce(max(id), 1),
+                        max(id) IS NOT NULL)
+                    FROM "{table.name}"
+                """))
+
+        conn.execute(text("ANALYZE"))
+
+
+##############################################################################
+# Loading
+
+
+def read_chunks(csv_file, chunk_rows):
+    """Split a binary CSV stream into chunks of up to `chunk_rows` rows.
+
+    Yields (chunk, rows, offset of the chunk's end). A quoted field can
+    contain newlines, so a record ends only at a newline outside quotes:
+    where the quotes seen so far are balanced.
+    """
+
+    chunk = io.BytesIO()
+    rows = 0
+    quotes = 0
+
+    for line in iter(csv_file.readline, b''):
+        chunk.write(line)
+        quotes += line.count(b'"')
+
+        if quotes % 2 == 0:
+            quotes = 0
+            rows += 1
+
+            if rows == chunk_rows:
+                chunk.seek(0)
+                yield chunk, rows, csv_file.tell()
+                chunk = io.BytesIO()
+                rows = 0
+
+    if rows:
+        chunk.seek(0)
+        yield chunk, rows, csv_file.tell()
+
+
+def load_table(table, path, chunk_rows):
+    """COPY one CSV into `table`, resuming from its checkpoint.
+
+    Returns (rows loaded in this run, seconds taken).
+    """
+
+    offset, loaded, done = get_checkpoint(table)
+
+    if done:
+        print(f"{table}: already loaded ({loaded:,} rows)")
+        return 0, 0.0
+
+    columns = db.metadata.tables[table].c
+
+    with open(path, 'rb') as csv_file:
+        header = csv_file.readline().decode('UTF-8').strip().split(',')
+        unknown = [name for name in header if name not in columns]
+        if unknown:
+            raise ValueError(f"{path}: unknown columns {unknown}")
+
+        copy = (f'COPY "{table}" ({", ".join(header)}) '
+                f'FROM STDIN WITH (FORMAT csv)')
+
+        if offset:
+            csv_file.seek(offset)
+
+        start = time.monotonic()
+        rows_this_run = 0
+        conn = db.engine.raw_connection()
+
+        try:
+            for chunk, rows, end in read_chunks(csv_file, chunk_rows):
+                cursor = conn.cursor()
+                cursor.copy_expert(copy, chunk)
+                loaded += rows
+                cursor.execute(SAVE_CHECKPOINT, {
+                    "step": table,
+                    "byte_offset": end,
+                    "rows": loaded,
+                    "done": False,
+                })
+                conn.commit()
+
+                rows_this_run += rows
+                elapsed = time.monotonic() - start
+                print(f"\r{table}: {loaded:,} rows "
+                      f"({rows_this_run / elapsed:,.0f} rows/s)",
+                      end='', flush=True)
+
+        finally:
+            conn.close()
+
+    print()
+    mark_done(table)
+
+    return rows_this_run, time.monotonic() - start
+
+
+def load(data_dir, chunk_rows=CHUNK_ROWS, restart=False):
+    """Load the snapshot in `data_dir`, resuming an unfinished load."""
+
+    if restart or not has_checkpoints():
+        create_schema()
+    else:
+        print("Resuming the previous load")
+
+    total_rows = 0
+    total_seconds = 0.0
+
+    for table, required in SNAPSHOT_TABLES.items():
+        path = os.path.join(data_dir, f"{table}.csv")
+
+        if not required and not os.path.exists(path):
+            mark_done(table)
+            continue
+
+        rows, seconds = load_table(table, path, chunk_rows)
+        total_rows += rows
+        total_seconds += seconds
+
+    if total_seconds:
+        print(f"Copied {total_rows:,} rows in {total_seconds:.1f}s "
+              f"({total_rows / total_seconds:,.0f} rows/s)")
+
+    steps = {
+        'constraints': build_constraints_and_indexes,
+        'sequences': fix_sequences,
+        # COPY skips the counters and fan-out, so fill both in one pass each
+        'counters': reconcile,
+        'timelines': rebuild_timelines,
+    }
+
+    for step in FINISHING_STEPS:
+        if get_checkpoint(step)[2]:
+            continue
+
+        print(f"{step}...")
+        start = time.monotonic()
+        steps[step]()
+        mark_done(step)
+        print(f"{step}: {time.monotonic() - start:.1f}s")
+
+    with db.engine.begin() as conn:
+        conn.execute(text("DROP TABLE seed_checkpoints"))
+
+
+def rebuild_timelines():
+    """Rebuild every timeline in one transaction."""
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', default='generator')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    parser.add_argument('--restart', action='store_true')
+    args = parser.parse_args()
+
+    with create_app().app_context():
+        load(args.data_dir, args.chunk_rows, args.restart)
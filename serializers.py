@@ -0,0 +1,138 @@
+"""Row-based JSON serialization for the read API.
+
+The API queries select plain columns rather than ORM entities. The
+resulting rows skip the identity map and attribute instrumentation, and
+each one becomes a dict in a single pass. Timestamps are written as ISO
+8601 in UTC.
+"""
+
+from datetime import timezone
+
+from models import db, Follows, Like, Message, User
+from pagination import PER_PAGE, paginate
+
+MAX_BULK_IDS = 100
+
+MESSAGE_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.user_id,
+    Message.likes_count,
+    User.username,
+    User.image_url,
+)
+
+USER_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+    User.location,
+    User.messages_count,
+    User.followers_count,
+    User.following_count,
+    User.likes_count,
+)
+
+
+class InvalidIds(ValueError):
+    """Raised when an `ids` list can't be parsed or is too long."""
+
+
+def parse_ids(raw, limit=MAX_BULK_IDS):
+    """Parse a comma-separated `ids` querystring value into unique ints.
+
+    Keeps the order given. Raises InvalidIds for non-integers or more
+    than `limit` ids.
+    """
+
+    try:
+        ids = [int(part) for part in raw.split(',') if part.strip()]
+    except ValueError as exc:
+        raise InvalidIds(raw) from exc
+
+    ids = list(dict.fromkeys(ids))
+
+    if len(ids) > limit:
+        raise InvalidIds(raw)
+
+    return ids
+
+
+def iso_utc(timestamp):
+    """Format a naive UTC datetime as ISO 8601 with an explicit offset."""
+
+    return timestamp.replace(tzinfo=timezone.utc).isoformat()
+
+
+def message_rows():
+    """Query selecting MESSAGE_COLUMNS: each message with its author."""
+
+    return (db.session
+            .query(*MESSAGE_COLUMNS)
+            .join(User, User.id == Message.user_id))
+
+
+def messages_by_ids(ids):
+    """Get message rows for `ids`, in the order given; unknown ids are
+    left out."""
+
+    if not ids:
+        return []
+
+    found = {row.id: row
+             for row in message_rows().filter(Message.id.in_(ids))}
+
+    return [found[id] for id in ids if id in found]
+
+
+def user_messages_page(user_id, before=None, per_page=PER_PAGE):
+    """One page of message rows by `user_id`, newest first."""
+
+    return paginate(
+        message_rows().filter(Message.user_id == user_id),
+        (Message.timestamp, Message.id),
+        before,
+        per_page,
+    )
+
+
+def user_row(user_id):
+    """Get the USER_COLUMNS row for `user_id`, or None."""
+
+    return (db.session
+            .query(*USER_COLUMNS)
+            .filter(User.id == user_id)
+            .one_or_none())
+
+
+def serialize_messages(rows, viewer_id):
+    """Serialize message rows; is_liked is from `viewer_id`'s view."""
+
+    liked_ids = Like.liked_ids(viewer_id, {row.id for row in rows})
+
+    return [
+        {
+            "id": row.id,
+            "text": row.text,
+            "timestamp": iso_utc(row.timestamp),
+            "user_id": row.user_id,
+            "username": row.username,
+            "image_url": row.image_url,
+            "likes_count": row.likes_count,
+            "is_liked": row.id in liked_ids,
+        }
+        for row in rows
+    ]
+
+
+def serialize_user(row, viewer_id):
+    """Serialize a user row; is_followed is from `viewer_id`'s view."""
+
+    serialized = row._asdict()
+    serialized["is_followed"] = (
+        row.id in Follows.followed_ids(viewer_id, [row.id]))
+
+    return serialized
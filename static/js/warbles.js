@@ -1,27 +1,121 @@
 "use strict";
 
-const PORT = 5000;
-const BASE_URL = `http://127.0.0.1:${PORT}/`;
+const $messages = $("#messages");
+const $loadMore = $("#load-more");
 
-const $likeMsgForms = $("form[data-msg-id]");
+let nextCursor = $loadMore.data("next-cursor") || null;
+let isLoading = false;
+let scrollObserver = null;
 
-async function likeWarble(message_id) {
+/** Like or unlike a warble, depending on the form's current star.
+ *
+ * PUT and DELETE are idempotent, so a double click can't flip the like
+ * back; the star and count are set from the server's answer. */
+
+async function likeWarble(form) {
+  const $star = $(form).find(".bi");
+  const liked = $star.hasClass("bi-star-fill");
+
+  // forms added by infinite scroll have no token of their own
+  const token = $(form).find("[name=csrf_token]").val()
+    || $("[name=csrf_token]").first().val();
+  const data = new FormData();
+  data.append("csrf_token", token);
 
   const response = await axios({
-      url: `${BASE_URL}/api/messages/${message_id}/like`,
-      method: "POST",
+    url: `/api/messages/${form.dataset.msgId}/like`,
+    method: liked ? "DELETE" : "PUT",
+    data,
   });
 
-  console.log(response.data.message);
-  // appendToList(data);
+  const message = response.data.message;
+  $star.toggleClass("bi-star-fill", message.is_liked);
+  $star.toggleClass("bi-star", !message.is_liked);
+  $(form).find(".likes-count").text(message.likes_count);
+}
+
+// delegated so forms appended by infinite scroll are handled too
+$messages.on("submit", "form[data-msg-id]", function (e) {
+  e.preventDefault();
+  likeWarble(e.target);
+});
+
+
+/** Build the <li> for one message from /api/feed, matching home.html */
+
+function makeMessageItem(message) {
+  const date = new Date(message.timestamp).toLocaleDateString(
+    "en-GB", { day: "2-digit", month: "long", year: "numeric" });
+
+  const $item = $('<li class="list-group-item">');
+  $item.append($('<a class="message-link">')
+    .attr("href", `/messages/${message.id}`));
+  $item.append($("<a>")
+    .attr("href", `/users/${message.user_id}`)
+    .append($('<img alt="" class="timeline-image">')
+      .attr("src", message.image_url)));
+
+  const $area = $('<div class="message-area">');
+  $area.append($("<a>")
+    .attr("href", `/users/${message.user_id}`)
+    .text(`@${message.username}`));
+  $area.append(" ");
+  $area.append($('<span class="text-muted">').text(date));
+  $area.append($("<p>").text(message.text));
+  $item.append($area);
+
+  if (message.user_id !== $messages.data("user-id")) {
+    const star = message.is_liked ? "bi-star-fill" : "bi-star";
+    $item.append($('<form method="POST" style="z-index:500">')
+      .attr("data-msg-id", message.id)
+      .attr("action", `/messages/${message.id}/like`)
+      .append($('<button type="submit" class="btn btn-primary">')
+        .append($(`<i class="bi ${star}">`))
+        .append(" ")
+        .append($('<span class="likes-count">').text(message.likes_count))));
+  }
 
-  // $form.trigger("reset");
+  return $item;
 }
 
-/** Submit form and display newly added cupcake */
 
-$likeMsgForms.on("submit", function (e) {
-  e.preventDefault();
-  const msgId = e.target.dataset.msgId
-  const resp = likeWarble(msgId);
-})
\ No newline at end of file
+/** Fetch the next page of the feed and append it to the list. */
+
+async function loadMoreWarbles() {
+  if (isLoading || !nextCursor) return;
+  isLoading = true;
+
+  try {
+    const response = await axios.get("/api/feed", {
+      params: { before: nextCursor },
+    });
+
+    for (const message of response.data.messages) {
+      $messages.append(makeMessageItem(message));
+    }
+
+    nextCursor = response.data.next_cursor;
+    if (nextCursor) {
+      $loadMore.attr("href", `/?before=${nextCursor}`);
+      // re-observing re-checks visibility, in case the link is still in view
+      scrollObserver?.unobserve($loadMore[0]);
+      scrollObserver?.observe($loadMore[0]);
+    } else {
+      scrollObserver?.disconnect();
+      $loadMore.remove();
+    }
+  } finally {
+    isLoading = false;
+  }
+}
+
+
+// infinite scroll: load the next page as the "Older warbles" link nears
+// the viewport; the link itself still works without JS
+if ($loadMore.length && "IntersectionObserver" in window) {
+  scrollObserver = new IntersectionObserver(function (entries) {
+    if (entries.some(entry => entry.isIntersecting)) loadMoreWarbles();
+  }, { rootMargin: "600px" });
+
+  scrollObserver.observe($loadMore[0]);
+}
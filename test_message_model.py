@@ -6,9 +6,10 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
-from models import db, User, Message, Follows, connect_db
+from models import db, User, Message, Follows, Like
 
 from psycopg2.errors import UniqueViolation
 
@@ -23,20 +24,28 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app
+from app import create_app
+
+# The test profile: no debug toolbar or CSRF, and strict query budgets
+
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
-connect_db(app)
-
-db.drop_all()
-db.create_all()
+with app.app_context():
+    db.drop_all()
+    db.create_all()
 
 
 class MessageModelTestCase(TestCase):
     def setUp(self):
+        # run in this module's app, not whichever was created last
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
         Message.query.delete()
         User.query.delete()
 
@@ -57,7 +66,7 @@ class MessageModelTestCase(TestCase):
         db.session.add(new_msg)
         db.session.commit()
 
-        self.assertIn(new_msg, self.u1.messages)
+        self.assertEqual(self.u1.messages.all(), [new_msg])
 
     def test_message_empty_text(self):
         """test integrity error when adding message if text input is empty"""
@@ -66,3 +75,81 @@ class MessageModelTestCase(TestCase):
             db.session.add(new_msg)
             db.session.commit()
 
+    def test_annotate_liked(self):
+        """test viewer like state is attached to each message"""
+        liked = Message(user_id=self.u1_id, text="liked")
+        not_liked = Message(user_id=self.u1_id, text="not liked")
+        db.session.add_all([liked, not_liked])
+        db.session.flush()
+        db.session.add(Like(user_id=self.u1_id, message_id=liked.id))
+        db.session.commit()
+
+        Message.annotate_liked(self.u1, [liked, not_liked])
+        self.assertEqual(liked.is_liked, True)
+        self.assertEqual(not_liked.is_liked, False)
+
+    def test_search(self):
+        """test search matches stemmed words, newest or most relevant first"""
+        texts = ["warbling birds", "a bird sings", "birds, birds, birds",
+                 "cats only"]
+        for i, text in enumerate(texts):
+            db.session.add(Message(
+                user_id=self.u1_id,
+                text=text,
+                timestamp=datetime(2020, 1, 1, i),
+            ))
+        db.session.commit()
+
+        page = Message.search("bird", per_page=2)
+        self.assertEqual([m.text for m in page],
+                         ["birds, birds, birds", "a bird sings"])
+
+        page = Message.search("bird", before=page.next_cursor, per_page=2)
+        self.assertEqual([m.text for m in page], ["warbling birds"])
+        self.assertFalse(page.has_more)
+
+        page = Message.search("bird", by_relevance=True, per_page=1)
+        self.assertEqual([m.text for m in page], ["birds, birds, birds"])
+        page = Message.search("bird", by_relevance=True,
+                              before=page.next_cursor, per_page=5)
+        self.assertEqual(len(page), 2)
+
+        self.assertEqual([m.text for m in Message.search("bird -sings")],
+                         ["birds, birds, birds", "warbling birds"])
+        self.assertEqual([m.text for m in Message.search('"birds sing"')],
+                         ["a bird sings"])
+        self.assertEqual(len(Message.search('"sings bird"')), 0)
+        self.assertEqual(len(Message.search("the")), 0)
+
+    def test_set_liked(self):
+        """test likes toggle, repeat harmlessly and keep both counters"""
+        u2 = User.signup("u2", "u2@email.com", "password", None)
+        msg = Message(user_id=self.u1_id, text="likeable")
+        db.session.add_all([u2, msg])
+        db.session.commit()
+
+        self.assertEqual(Like.set_liked(u2.id, msg.id, True), (True, 1))
+        self.assertEqual(Like.set_liked(u2.id, msg.id, True), (True, 1))
+        self.assertEqual(Like.set_liked(u2.id, msg.id), (False, 0))
+        self.assertEqual(Like.set_liked(u2.id, msg.id), (True, 1))
+        self.assertEqual(Like.set_liked(self.u1_id, msg.id), (True, 2))
+        self.assertEqual(Like.set_liked(u2.id, msg.id, False), (False, 1))
+        self.assertEqual(Like.set_liked(u2.id, msg.id, False), (False, 1))
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(msg.id).likes_count, 1)
+        self.assertEqual(User.query.get(u2.id).likes_count, 0)
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+    def test_reconcile_counts(self):
+        """test reconcile_counts repairs drifted likes counts"""
+        msg = Message(user_id=self.u1_id, text="drifted", likes_count=7)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add(Like(user_id=self.u1_id, message_id=msg.id))
+        db.session.commit()
+
+        Message.reconcile_counts(msg.id, msg.id)
+        db.session.commit()
+
+        self.assertEqual(Message.query.get(msg.id).likes_count, 1)
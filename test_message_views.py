@@ -6,9 +6,12 @@
 
 
 import os
+import threading
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User, connect_db
+import models
+from models import db, Message, User, Follows, Like, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,31 +22,35 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import create_app, CURR_USER_KEY
+from fragment_cache import fragment_cache
+from metrics import metrics
+from pagination import encode_cursor
+from user_cache import user_cache
 
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+# The test profile: no debug toolbar or CSRF, and strict query budgets
 
-# This is a bit of hack, but don't use Flask DebugToolbar
-
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
-connect_db(app)
-
-db.drop_all()
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
+with app.app_context():
+    db.drop_all()
+    db.create_all()
 
 
 class MessageBaseViewTestCase(TestCase):
     def setUp(self):
+        # run in this module's app, not whichever was created last
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
         User.query.delete()
+        user_cache.clear()
+        fragment_cache.clear()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -130,7 +137,7 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
             html = resp.get_data(as_text=True)
             self.assertIn(self.u1.username, html)
 
-            self.assertEqual(len(self.u1.messages), 0)
+            self.assertEqual(self.u1.messages.count(), 0)
 
     def test_delete_message_not_authenticated(self):
         """Test delete message when not authenticated """
@@ -150,4 +157,583 @@ class MessageAddViewTestCase(MessageBaseViewTestCase):
 
             resp = client.post(f'/messages/{self.m1_id}/delete', follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
-            self.assertEqual(len(self.u1.messages), 1)
+            self.assertEqual(self.u1.messages.count(), 1)
+
+
+class MessageTimelineTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        db.session.add(Follows(
+            user_being_followed_id=self.u1_id,
+            user_following_id=self.u2.id))
+        User.adjust_counts(self.u1_id, followers_count=1)
+        User.adjust_counts(self.u2.id, following_count=1)
+        db.session.commit()
+
+        self.u2_id = self.u2.id
+
+    def tearDown(self):
+        models.FANOUT_FOLLOWER_LIMIT = 10_000
+
+    def test_add_message_fans_out(self):
+        """Posting a message adds it to the author's and followers' timelines"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post("/messages/new", data={"text": "fanned out"})
+
+        message = Message.query.filter_by(text="fanned out").one()
+        owners = {entry.user_id for entry in
+                  TimelineEntry.query.filter_by(message_id=message.id)}
+        self.assertEqual(owners, {self.u1_id, self.u2_id})
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = client.get("/")
+            self.assertIn("fanned out", resp.get_data(as_text=True))
+
+    def test_add_message_fan_out_exempt(self):
+        """Authors over the follower limit are merged in at read time"""
+
+        models.FANOUT_FOLLOWER_LIMIT = 0
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post("/messages/new", data={"text": "read time merge"})
+
+        message = Message.query.filter_by(text="read time merge").one()
+        owners = {entry.user_id for entry in
+                  TimelineEntry.query.filter_by(message_id=message.id)}
+        self.assertEqual(owners, {self.u1_id})
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            resp = client.get("/")
+            self.assertIn("read time merge", resp.get_data(as_text=True))
+
+    def test_delete_message_leaves_timelines(self):
+        """Deleting a message removes it from every timeline"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post("/messages/new", data={"text": "short lived"})
+            message = Message.query.filter_by(text="short lived").one()
+            message_id = message.id
+
+            client.post(f"/messages/{message_id}/delete")
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(message_id=message_id).count(), 0)
+
+
+class MessageFeedPaginationTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        for i in range(25):
+            msg = Message(text=f"paged-{i:02}", user_id=self.u1_id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+    def test_homepage_first_page(self):
+        """Homepage shows one page of the feed and a cursor link"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('id="load-more"', html)
+            self.assertEqual(html.count('class="list-group-item"'), 20)
+
+    def test_feed_api_pages(self):
+        """Following next_cursor walks the whole feed exactly once"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            first = client.get("/api/feed").json
+            self.assertEqual(len(first["messages"]), 20)
+            self.assertIsNotNone(first["next_cursor"])
+
+            second = client.get(
+                "/api/feed", query_string={"before": first["next_cursor"]}).json
+            self.assertIsNone(second["next_cursor"])
+
+            ids = [m["id"] for m in first["messages"] + second["messages"]]
+            self.assertEqual(len(ids), 25)
+            self.assertEqual(len(set(ids)), 25)
+
+    def test_feed_api_bad_cursor(self):
+        """A garbled cursor is a 400"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get("/api/feed?before=not-a-cursor")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_feed_api_wrong_cursor_types(self):
+        """A well-formed cursor holding the wrong values is a 400"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for values in (["2020-01-01T00:00:00", "1"],
+                           [1, 1], ["yesterday", 1],
+                           ["2020-01-01T00:00:00", [1]]):
+                resp = client.get("/api/feed",
+                                  query_string={"before": encode_cursor(values)})
+                self.assertEqual(resp.status_code, 400)
+
+    def test_feed_api_not_authenticated(self):
+        """The feed API needs a logged in user"""
+
+        with self.client as client:
+            resp = client.get("/api/feed")
+            self.assertEqual(resp.status_code, 401)
+
+
+class MessageSearchTestCase(MessageBaseViewTestCase):
+    def test_search_page(self):
+        """Search page lists matching messages"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get("/messages/search?q=m1")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("m1-text", html)
+
+            resp = client.get("/messages/search?q=nothing")
+            self.assertIn("no warbles found", resp.get_data(as_text=True))
+
+            resp = client.get("/messages/search?q=m1&before=garbled")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_search_api(self):
+        """Search API pages through matches"""
+
+        for i in range(25):
+            db.session.add(Message(text=f"paged {i}", user_id=self.u1_id))
+        db.session.commit()
+
+        with self.client as client:
+            resp = client.get("/api/messages/search?q=paged")
+            self.assertEqual(resp.status_code, 401)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for order in ("recent", "relevant"):
+                seen = []
+                cursor = ""
+                while True:
+                    resp = client.get(
+                        f"/api/messages/search?q=paged&order={order}"
+                        f"&before={cursor}")
+                    seen += [m["id"] for m in resp.json["messages"]]
+                    cursor = resp.json["next_cursor"]
+                    if not cursor:
+                        break
+
+                self.assertEqual(len(seen), 25)
+                self.assertEqual(len(set(seen)), 25)
+
+
+class MessageCountersTestCase(MessageBaseViewTestCase):
+    def test_add_delete_message_counters(self):
+        """Posting and deleting keep the author's and likers' counters"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post("/messages/new", data={"text": "counted"})
+            self.assertEqual(User.query.get(self.u1_id).messages_count, 1)
+
+            message = Message.query.filter_by(text="counted").one()
+            message_id = message.id
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+
+            client.post(f"/messages/{message_id}/like")
+            self.assertEqual(User.query.get(self.u2.id).likes_count, 1)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post(f"/messages/{message_id}/delete")
+
+        self.assertEqual(User.query.get(self.u1_id).messages_count, 0)
+        self.assertEqual(User.query.get(self.u2.id).likes_count, 0)
+
+
+class MessageLikeApiTestCase(MessageBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        m2 = Message(text="u2's warble", user_id=self.u2.id)
+        db.session.add(m2)
+        db.session.commit()
+        self.m2_id = m2.id
+
+    def test_put_delete_like(self):
+        """PUT likes and DELETE unlikes, both safe to repeat"""
+
+        url = f"/api/messages/{self.m2_id}/like"
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for _ in range(2):
+                resp = client.put(url)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json["message"]["is_liked"], True)
+                self.assertEqual(resp.json["message"]["likes_count"], 1)
+
+            self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+            for _ in range(2):
+                resp = client.delete(url)
+                self.assertEqual(resp.json["message"]["is_liked"], False)
+                self.assertEqual(resp.json["message"]["likes_count"], 0)
+
+            resp = client.post(url)
+            self.assertEqual(resp.json["message"]["is_liked"], True)
+
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+        self.assertEqual(Message.query.get(self.m2_id).likes_count, 1)
+
+    def test_like_api_rejected(self):
+        """Liking needs a login and someone else's existing warble"""
+
+        with self.client as client:
+            resp = client.put(f"/api/messages/{self.m2_id}/like")
+            self.assertEqual(resp.status_code, 401)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+
+            resp = client.put(f"/api/messages/{self.m2_id}/like")
+            self.assertEqual(resp.status_code, 403)
+
+            resp = client.put("/api/messages/99999999/like")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(Like.query.count(), 0)
+
+
+class WriteBehindTestCase(MessageBaseViewTestCase):
+    """Likes and follows through the write-behind queue"""
+
+    @classmethod
+    def setUpClass(cls):
+        with patch.dict(os.environ, WRITE_BEHIND='async'):
+            cls.async_app = create_app('test')
+        with patch.dict(os.environ, WRITE_BEHIND='durable'):
+            cls.durable_app = create_app('test')
+
+        # flush only when a test says so
+        cls.async_app.extensions['write_behind'].interval = 3600
+
+    def setUp(self):
+        super().setUp()
+
+        m2 = Message(text="u2's warble", user_id=self.u2.id)
+        db.session.add(m2)
+        db.session.commit()
+        self.m2_id = m2.id
+        self.u2_id = self.u2.id
+
+        # a session made under the module's app would keep using its engine
+        db.session.remove()
+        self.addCleanup(db.session.remove)
+
+    def client_for(self, other_app):
+        context = other_app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+        client = other_app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+        return client
+
+    def test_like_api_answers_at_once(self):
+        """The like API answers before the flush, and repeated toggles
+        collapse into one write"""
+
+        client = self.client_for(self.async_app)
+        url = f"/api/messages/{self.m2_id}/like"
+
+        resp = client.put(url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["message"]["is_liked"], True)
+        self.assertEqual(resp.json["message"]["likes_count"], 1)
+        self.assertEqual(Like.query.count(), 0)
+
+        for is_liked, likes_count in [(False, 0), (True, 1), (False, 0),
+                                      (True, 1)]:
+            resp = client.post(url)
+            self.assertEqual(resp.json["message"]["is_liked"], is_liked)
+            self.assertEqual(resp.json["message"]["likes_count"], likes_count)
+
+        self.assertEqual(Like.query.count(), 0)
+
+        self.async_app.extensions['write_behind'].flush()
+        db.session.expire_all()
+
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(Message.query.get(self.m2_id).likes_count, 1)
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 1)
+
+    def test_durable_like(self):
+        """In durable mode the like is committed before the response"""
+
+        client = self.client_for(self.durable_app)
+
+        resp = client.put(f"/api/messages/{self.m2_id}/like")
+        self.assertEqual(resp.json["message"]["is_liked"], True)
+        db.session.expire_all()
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(Message.query.get(self.m2_id).likes_count, 1)
+
+        resp = client.delete(f"/api/messages/{self.m2_id}/like")
+        self.assertEqual(resp.json["message"]["is_liked"], False)
+        db.session.expire_all()
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Message.query.get(self.m2_id).likes_count, 0)
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+    def test_follow_unfollow(self):
+        """Batched follows and unfollows update counters and timelines"""
+
+        client = self.client_for(self.durable_app)
+
+        resp = client.post(f"/users/follow/{self.u2_id}")
+        self.assertEqual(resp.status_code, 302)
+
+        db.session.expire_all()
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u1_id,
+                                          message_id=self.m2_id).count(),
+            1)
+
+        resp = client.post(f"/users/stop-following/{self.u2_id}")
+        self.assertEqual(resp.status_code, 302)
+
+        db.session.expire_all()
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u1_id,
+                                          author_id=self.u2_id).count(),
+            0)
+
+    def test_like_deleted_message(self):
+        """A like of a message deleted before the flush changes nothing"""
+
+        client = self.client_for(self.async_app)
+
+        resp = client.put(f"/api/messages/{self.m2_id}/like")
+        self.assertEqual(resp.status_code, 200)
+
+        Message.query.filter_by(id=self.m2_id).delete()
+        db.session.commit()
+
+        self.async_app.extensions['write_behind'].flush()
+        db.session.expire_all()
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(User.query.get(self.u1_id).likes_count, 0)
+
+    def test_concurrent_toggles(self):
+        """Two toggles at once, one reading the like while the other's
+        flush lands, leave the message as it was"""
+
+        self.client_for(self.async_app)
+        write_behind = self.async_app.extensions['write_behind']
+        liked_ids = Like.liked_ids
+        reading = threading.Event()
+        flushed = threading.Event()
+
+        def slow_liked_ids(user_id, message_ids):
+            liked = liked_ids(user_id, message_ids)
+            if threading.current_thread() is not threading.main_thread():
+                reading.set()
+                # the other toggle's flush lands now, if it can
+                flushed.wait(1)
+            return liked
+
+        def toggle():
+            with self.async_app.app_context():
+                write_behind.like(self.u1_id, self.m2_id, None, 0)
+                db.session.remove()
+
+        with patch.object(Like, 'liked_ids', slow_liked_ids):
+            other = threading.Thread(target=toggle)
+            other.start()
+            reading.wait(5)
+
+            write_behind.like(self.u1_id, self.m2_id, None, 0)
+            write_behind.flush()
+            flushed.set()
+            other.join()
+
+        write_behind.flush()
+        db.session.expire_all()
+
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Message.query.get(self.m2_id).likes_count, 0)
+
+
+class MessageReadApiTestCase(MessageBaseViewTestCase):
+    def test_bulk_fetch(self):
+        """Bulk fetch keeps the requested order and skips unknown ids"""
+
+        m2 = Message(text="m2-text", user_id=self.u2.id)
+        db.session.add(m2)
+        db.session.commit()
+        m2_id = m2.id
+
+        with self.client as client:
+            resp = client.get(f"/api/messages?ids={self.m1_id}")
+            self.assertEqual(resp.status_code, 401)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(
+                f"/api/messages?ids={m2_id},99999999,{self.m1_id}")
+            self.assertEqual(resp.status_code, 200)
+
+            messages = resp.json["messages"]
+            self.assertEqual([m["id"] for m in messages], [m2_id, self.m1_id])
+            self.assertEqual(messages[0]["username"], "u2")
+            self.assertTrue(messages[0]["timestamp"].endswith("+00:00"))
+
+            resp = client.get("/api/messages?ids=1,two")
+            self.assertEqual(resp.status_code, 400)
+
+            ids = ",".join(str(i) for i in range(101))
+            resp = client.get(f"/api/messages?ids={ids}")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_conditional_get(self):
+        """A matching If-None-Match gets 304 until the resource changes"""
+
+        url = f"/api/messages?ids={self.m1_id}"
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+
+            resp = client.get(url)
+            etag = resp.headers["ETag"]
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.data, b"")
+
+            client.put(f"/api/messages/{self.m1_id}/like")
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["messages"][0]["likes_count"], 1)
+
+
+class FragmentCacheTestCase(MessageBaseViewTestCase):
+    def test_message_fragments_cached(self):
+        """Message bodies render once; like buttons stay per viewer"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+
+            client.get("/messages/search?q=m1")
+            html = client.get("/messages/search?q=m1").get_data(as_text=True)
+
+            self.assertIn("m1-text", html)
+            self.assertIn("bi-star", html)
+            self.assertEqual(fragment_cache.stats()["misses"], 1)
+            self.assertEqual(fragment_cache.stats()["hits"], 1)
+
+            # the author's own view has the same body and no like button
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = client.get("/messages/search?q=m1").get_data(as_text=True)
+            self.assertIn("m1-text", html)
+            self.assertNotIn("bi-star", html)
+            self.assertEqual(fragment_cache.stats()["hits"], 2)
+
+    def test_hits_and_misses_on_metrics(self):
+        """/metrics counts the fragment cache's hits and misses"""
+
+        metrics.clear()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+
+            client.get("/messages/search?q=m1")
+            client.get("/messages/search?q=m1")
+
+            text = client.get("/metrics").get_data(as_text=True)
+
+        self.assertIn("\nwarbler_fragment_cache_misses_total 1\n", text)
+        self.assertIn("\nwarbler_fragment_cache_hits_total 1\n", text)
+
+    def test_fragments_invalidated(self):
+        """Profile edits and deletes drop the author's fragments"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.get(f"/users/{self.u1_id}")
+            self.assertEqual(fragment_cache.stats()["size"], 1)
+
+            client.post("/users/profile", data={
+                "username": "u1-renamed",
+                "email": "u1@email.com",
+                "password": "password",
+            })
+            self.assertEqual(fragment_cache.stats()["size"], 0)
+
+            html = client.get(f"/users/{self.u1_id}").get_data(as_text=True)
+            self.assertIn("@u1-renamed", html)
+
+            client.post(f"/messages/{self.m1_id}/delete")
+            self.assertEqual(fragment_cache.stats()["size"], 0)
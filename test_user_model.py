@@ -8,7 +8,9 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows, connect_db
+from models import db, User, Message, Follows, Like
+from hashing import hasher, HashingUnavailable, PasswordHasher
+from pagination import InvalidCursor, encode_cursor
 
 from psycopg2.errors import UniqueViolation
 
@@ -23,20 +25,28 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app
+from app import create_app
+
+# The test profile: no debug toolbar or CSRF, and strict query budgets
+
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
-connect_db(app)
-
-db.drop_all()
-db.create_all()
+with app.app_context():
+    db.drop_all()
+    db.create_all()
 
 
 class UserModelTestCase(TestCase):
     def setUp(self):
+        # run in this module's app, not whichever was created last
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
         User.query.delete()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
@@ -58,8 +68,8 @@ class UserModelTestCase(TestCase):
         """ Test fresh user with no messages and followers """
         u1 = User.query.get(self.u1_id)
 
-        self.assertEqual(len(u1.messages), 0)
-        self.assertEqual(len(u1.followers), 0)
+        self.assertEqual(u1.messages.count(), 0)
+        self.assertEqual(u1.followers.count(), 0)
 
 
     def test_is_not_following(self):
@@ -83,6 +93,128 @@ class UserModelTestCase(TestCase):
         self.assertEqual(self.u1.is_followed_by(self.u2), False)
 
 
+    def test_annotate_followed(self):
+        """ Test viewer follow state is attached to each user """
+        self.u1.following.append(self.u2)
+        db.session.commit()
+
+        User.annotate_followed(self.u1, [self.u1, self.u2])
+        self.assertEqual(self.u1.is_followed, False)
+        self.assertEqual(self.u2.is_followed, True)
+
+        User.annotate_followed(None, [self.u2])
+        self.assertEqual(self.u2.is_followed, False)
+
+
+    def test_reconcile_counts(self):
+        """ Test reconcile_counts repairs drifted counters """
+        self.u1.following.append(self.u2)
+        db.session.add(Message(user_id=self.u1_id, text="uncounted"))
+        db.session.commit()
+
+        repaired = User.reconcile_counts(self.u1_id, self.u2_id)
+        db.session.commit()
+
+        self.assertEqual(repaired, 2)
+        self.assertEqual(self.u1.messages_count, 1)
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u2.followers_count, 1)
+
+
+    def test_search(self):
+        """ Test prefix matches come first, then pages of substring matches """
+        db.session.add_all(
+            User(username=name, email=f"{name}@email.com", password="x")
+            for name in ("Bob", "bobby", "Abobo", "jimbob", "alice", "Zbob")
+        )
+        db.session.commit()
+
+        page = User.search("BOB", per_page=3)
+        self.assertEqual([u.username for u in page], ["Bob", "bobby", "Abobo"])
+        self.assertTrue(page.has_more)
+
+        page = User.search("BOB", after=page.next_cursor, per_page=3)
+        self.assertEqual([u.username for u in page], ["jimbob", "Zbob"])
+        self.assertFalse(page.has_more)
+
+        # too short for substring matches; LIKE wildcards are literal
+        self.assertEqual([u.username for u in User.search("bo")],
+                         ["Bob", "bobby"])
+        self.assertEqual(len(User.search("%")), 0)
+        self.assertEqual(len(User.search("")), 8)
+
+        with self.assertRaises(InvalidCursor):
+            User.search("bob", after="garbled")
+
+        # well-formed, but not an (id, username, id) key
+        for values in (["1", "bob", 1], [1, "bob"], [1, ["bob"], 1],
+                       [True, "bob", 1], [1, "bob", 1.5]):
+            with self.assertRaises(InvalidCursor):
+                User.search("bob", after=encode_cursor(values))
+
+
+    def test_follows_pages(self):
+        """ Test followers and following are paged, newest accounts first """
+        others = [
+            User(username=f"fan{i}", email=f"fan{i}@email.com", password="x")
+            for i in range(5)
+        ]
+        db.session.add_all(others)
+        db.session.flush()
+        db.session.add_all(
+            Follows(user_being_followed_id=self.u1_id,
+                    user_following_id=other.id)
+            for other in others)
+        db.session.commit()
+
+        page = self.u1.followers_page(per_page=3)
+        self.assertEqual(page.items, others[:1:-1])
+
+        page = self.u1.followers_page(before=page.next_cursor, per_page=3)
+        self.assertEqual(page.items, others[1::-1])
+        self.assertFalse(page.has_more)
+
+        self.assertEqual(others[0].following_page().items, [self.u1])
+        self.assertEqual(self.u2.followers_page().items, [])
+
+
+    def test_messages_and_likes_pages(self):
+        """ Test own and liked messages are paged, newest first """
+        messages = [Message(user_id=self.u2_id, text=f"m{i}")
+                    for i in range(3)]
+        db.session.add_all(messages)
+        db.session.flush()
+        for message in reversed(messages):
+            db.session.add(Like(user_id=self.u1_id, message_id=message.id))
+        db.session.commit()
+
+        page = self.u2.messages_page(per_page=2)
+        self.assertEqual(page.items, messages[:0:-1])
+        page = self.u2.messages_page(before=page.next_cursor, per_page=2)
+        self.assertEqual(page.items, messages[:1])
+
+        # latest like first, whenever the message was posted
+        page = self.u1.liked_messages_page(per_page=2)
+        self.assertEqual(page.items, messages[:2])
+        page = self.u1.liked_messages_page(before=page.next_cursor)
+        self.assertEqual(page.items, messages[2:])
+        self.assertFalse(page.has_more)
+
+
+    def test_autocomplete(self):
+        """ Test autocomplete ranks prefix matches first """
+        db.session.add_all(
+            User(username=name, email=f"{name}@email.com", password="x")
+            for name in ("jimbob", "bobby", "Bob")
+        )
+        db.session.commit()
+
+        self.assertEqual([u.username for u in User.autocomplete("bob")],
+                         ["Bob", "bobby", "jimbob"])
+        self.assertEqual([u.username for u in User.autocomplete("bob", 1)],
+                         ["Bob"])
+
+
     def test_user_signed_up(self):
         """ Test user signed up successfully """
         self.assertIsInstance(self.u1, User)
@@ -140,3 +272,42 @@ class UserModelTestCase(TestCase):
         self.assertNotIsInstance(u, User)
 
 
+    def test_user_authentication_rehash(self):
+        """Rehash a stored hash with an old work factor on login."""
+        rounds = hasher.rounds
+        hasher.rounds = 4
+
+        try:
+            u = User.authenticate(username="u1", password="password")
+            db.session.commit()
+        finally:
+            hasher.rounds = rounds
+
+        self.assertIsInstance(u, User)
+        self.assertTrue(u.password.startswith("$2b$04$"))
+        self.assertIsInstance(
+            User.authenticate(username="u1", password="password"), User)
+
+    def test_hashing_queue_full(self):
+        """Refuse to queue more hashes than the limit."""
+        busy = PasswordHasher(workers=1, queue_limit=1)
+        busy._slots.acquire()
+
+        with self.assertRaises(HashingUnavailable):
+            busy.hash("password")
+
+    def test_hashing_recovers_from_dead_process(self):
+        """A pool process dying fails its hash, and the next one runs in a
+        new pool."""
+        recovering = PasswordHasher(workers=1, rounds=4)
+        self.addCleanup(recovering.shutdown)
+        self.assertTrue(recovering.hash("password").startswith("$2b$04$"))
+
+        for process in list(recovering._pool._processes.values()):
+            process.kill()
+            process.join()
+
+        with self.assertRaises(HashingUnavailable):
+            recovering.hash("password")
+
+        self.assertTrue(recovering.hash("password").startswith("$2b$04$"))
@@ -5,10 +5,17 @@
 #    FLASK_DEBUG=False python -m unittest test_message_views.py
 
 
+import json
 import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, Message, User, connect_db
+from sqlalchemy import event
+
+from models import db, Message, User, Follows, Like, TimelineEntry
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -19,31 +26,39 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
-
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+from app import create_app, CURR_USER_KEY
+from fragment_cache import fragment_cache
+from metrics import Metrics, metrics, render
+from pagination import PER_PAGE
+from query_budget import QueryBudgetExceeded
+from query_watch import statement_shape
+from reconcile_counts import reconcile
+from replicas import PRIMARY_UNTIL_KEY, REPLICA_EJECT_SECONDS
+from user_cache import user_cache
 
-# This is a bit of hack, but don't use Flask DebugToolbar
+# The test profile: no debug toolbar or CSRF, and strict query budgets
 
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+app = create_app('test')
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
 # and create fresh new clean test data
 
-connect_db(app)
-
-db.drop_all()
-db.create_all()
-
-# Don't have WTForms use CSRF at all, since it's a pain to test
-
-app.config['WTF_CSRF_ENABLED'] = False
+with app.app_context():
+    db.drop_all()
+    db.create_all()
 
 
 class UserBaseViewTestCase(TestCase):
     def setUp(self):
+        # run in this module's app, not whichever was created last
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
         User.query.delete()
+        user_cache.clear()
+        fragment_cache.clear()
 
         u1 = User.signup("u1", "u1@email.com", "password", None)
         u2 = User.signup("u2", "u2@email.com", "password", None)
@@ -82,6 +97,65 @@ class UserFollowUnfollowTestCase(UserBaseViewTestCase):
             self.assertEqual(resp_followers_page.status_code, 200)
 
 
+    def test_follow_twice(self):
+        """Following someone you already follow changes nothing"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for _ in range(2):
+                resp = client.post(f"/users/follow/{self.u2_id}")
+                self.assertEqual(resp.status_code, 302)
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+        self.assertEqual(Follows.query.count(), 1)
+
+    def test_unfollow_not_followed(self):
+        """Unfollowing someone you don't follow changes nothing; an
+        unknown user is a 404"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.post(f"/users/stop-following/{self.u2_id}")
+            self.assertEqual(resp.status_code, 302)
+
+            resp = client.post("/users/stop-following/99999999")
+            self.assertEqual(resp.status_code, 404)
+
+        db.session.expire_all()
+        self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+    def test_profile_lists_paged(self):
+        """Profile lists show a page and a cursor link to the next one"""
+
+        db.session.add_all(
+            Message(text=f"warble {i}", user_id=self.u2_id) for i in range(25))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            html = client.get(f"/users/{self.u2_id}").get_data(as_text=True)
+            self.assertIn("warble 24", html)
+            self.assertNotIn("warble 4<", html)
+
+            cursor = html.split("?before=")[1].split('"')[0]
+            html = (client.get(f"/users/{self.u2_id}?before={cursor}")
+                    .get_data(as_text=True))
+            self.assertIn("warble 4<", html)
+            self.assertNotIn("Older warbles", html)
+
+            for path in ("", "/following", "/followers", "/likes"):
+                resp = client.get(f"/users/{self.u2_id}{path}?before=garbled")
+                self.assertEqual(resp.status_code, 400)
+
     def test_cant_followers_page_not_logged_in(self):
         """test to not be able to go to other user's followers page when not logged in"""
         with self.client as client:
@@ -89,10 +163,870 @@ class UserFollowUnfollowTestCase(UserBaseViewTestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertEqual(resp.request.path, "/")
 
+    def test_follow_backfills_timeline(self):
+        """Following a user copies their recent messages into the timeline"""
+
+        db.session.add(Message(text="before follow", user_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post(f"/users/follow/{self.u2_id}")
+            resp = client.get("/")
+            self.assertIn("before follow", resp.get_data(as_text=True))
+
+    def test_unfollow_clears_timeline(self):
+        """Unfollowing a user drops their messages from the timeline"""
+
+        db.session.add(Message(text="after unfollow", user_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post(f"/users/follow/{self.u2_id}")
+            client.post(f"/users/stop-following/{self.u2_id}")
+
+            self.assertEqual(
+                TimelineEntry.query.filter_by(
+                    user_id=self.u1_id, author_id=self.u2_id).count(),
+                0)
+            resp = client.get("/")
+            self.assertNotIn("after unfollow", resp.get_data(as_text=True))
+
+    def test_follow_unfollow_counters(self):
+        """Following and unfollowing keep both users' counters in step"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post(f"/users/follow/{self.u2_id}")
+            self.assertEqual(User.query.get(self.u1_id).following_count, 1)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 1)
+
+            client.post(f"/users/stop-following/{self.u2_id}")
+            self.assertEqual(User.query.get(self.u1_id).following_count, 0)
+            self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+
+    def test_delete_user_counters(self):
+        """Deleting a user takes them out of other users' counters"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post(f"/users/follow/{self.u2_id}")
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u3_id
+
+            client.post(f"/users/follow/{self.u1_id}")
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post("/users/delete")
+
+        self.assertEqual(User.query.get(self.u2_id).followers_count, 0)
+        self.assertEqual(User.query.get(self.u3_id).following_count, 0)
+
     # TODO: ADD TEST FOR FOLLOWING PAGES
     # TODO: ADD TEST FOR LIKING THINGS.
     # LEAVE TODOS IN GITHUB HOSTED CODE FOR EMPLOYERS TO SEE SHOWING FUTURE THOUGHTS
 
 
     # // When you’re logged in, can you see the follower / following pages for any user?
-    # // When you’re logged out, are you disallowed from visiting a user’s follower / following pages?
\ No newline at end of file
+    # // When you’re logged out, are you disallowed from visiting a user’s follower / following pages?
+
+
+class UserSearchTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        db.session.add_all(
+            User(username=f"page-{i:02}", email=f"page-{i}@email.com",
+                 password="x")
+            for i in range(22)
+        )
+        db.session.commit()
+
+    def test_list_users_pages(self):
+        """Users are listed a page at a time, with a link to the next page"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get("/users?q=page")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@page-19", html)
+            self.assertNotIn("@page-20", html)
+            self.assertIn("More users", html)
+
+            cursor = html.split("after=")[1].split('"')[0]
+            resp = client.get(f"/users?q=page&after={cursor}")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@page-21", html)
+            self.assertNotIn("@page-19", html)
+            self.assertNotIn("More users", html)
+
+            resp = client.get("/users?after=garbled")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_search_api(self):
+        """Autocomplete returns matching users as JSON"""
+
+        with self.client as client:
+            resp = client.get("/api/users/search?q=u2")
+            self.assertEqual(resp.status_code, 401)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get("/api/users/search?q=u2")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(
+                [user["id"] for user in resp.json["users"]], [self.u2_id])
+
+
+class UserCacheTestCase(UserBaseViewTestCase):
+    def test_session_user_cached(self):
+        """Repeat requests resolve the logged in user from the cache"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.get(f"/users/{self.u2_id}")
+            resp = client.get(f"/users/{self.u2_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f"/users/{self.u1_id}", resp.get_data(as_text=True))
+            self.assertEqual(user_cache.stats()["misses"], 1)
+            self.assertEqual(user_cache.stats()["hits"], 1)
+
+    def test_hits_and_misses_on_metrics(self):
+        """/metrics counts the cache's hits and misses"""
+
+        metrics.clear()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.get(f"/users/{self.u2_id}")
+
+            # this request's user is a hit too
+            text = client.get("/metrics").get_data(as_text=True)
+
+        self.assertIn("\nwarbler_user_cache_misses_total 1\n", text)
+        self.assertIn("\nwarbler_user_cache_hits_total 1\n", text)
+
+    def test_profile_edit_invalidates(self):
+        """Saving the profile drops the cached snapshot"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post("/users/profile", data={
+                "username": "u1-renamed",
+                "email": "u1@email.com",
+                "password": "password",
+            })
+
+            self.assertEqual(user_cache.stats()["size"], 0)
+
+            resp = client.get(f"/users/{self.u1_id}")
+            self.assertIn("@u1-renamed", resp.get_data(as_text=True))
+
+    def test_logout_invalidates(self):
+        """Logging out drops the cached snapshot"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.get("/")
+            client.post("/logout")
+
+            self.assertEqual(user_cache.stats()["size"], 0)
+
+
+class UserReadApiTestCase(UserBaseViewTestCase):
+    def test_user_api(self):
+        """The user API has the profile and counters, but not the email"""
+
+        with self.client as client:
+            resp = client.get(f"/api/users/{self.u2_id}")
+            self.assertEqual(resp.status_code, 401)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post(f"/users/follow/{self.u2_id}")
+
+            resp = client.get(f"/api/users/{self.u2_id}")
+            user = resp.json["user"]
+            self.assertEqual(user["username"], "u2")
+            self.assertEqual(user["followers_count"], 1)
+            self.assertEqual(user["is_followed"], True)
+            self.assertNotIn("email", user)
+            self.assertNotIn("password", user)
+
+            resp = client.get("/api/users/99999999")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_user_messages_api(self):
+        """The user messages API pages through every message once"""
+
+        for i in range(25):
+            db.session.add(Message(text=f"api {i}", user_id=self.u2_id))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            seen = []
+            cursor = ""
+            while True:
+                resp = client.get(
+                    f"/api/users/{self.u2_id}/messages?before={cursor}")
+                seen += [m["id"] for m in resp.json["messages"]]
+                cursor = resp.json["next_cursor"]
+                if not cursor:
+                    break
+
+            self.assertEqual(len(set(seen)), 25)
+
+            resp = client.get(f"/api/users/{self.u2_id}/messages?before=x")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/api/users/99999999/messages")
+            self.assertEqual(resp.status_code, 404)
+
+
+class CachePolicyTestCase(UserBaseViewTestCase):
+    def test_anonymous_pages_public(self):
+        """Anonymous pages are public and set no cookie; forms aren't cached"""
+
+        with self.client as client:
+            resp = client.get("/")
+            self.assertEqual(resp.cache_control.public, True)
+            self.assertGreater(resp.cache_control.max_age, 0)
+            self.assertNotIn("Set-Cookie", resp.headers)
+
+            resp = client.get("/no-such-page")
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.cache_control.public, True)
+
+            resp = client.get("/login")
+            self.assertEqual(resp.cache_control.no_store, True)
+
+    def test_logged_in_pages_private(self):
+        """Logged-in pages are private; redirects aren't cached"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            # the first page may put a CSRF token in the session
+            client.get("/users")
+
+            resp = client.get("/users")
+            self.assertIn("private", resp.headers["Cache-Control"])
+            self.assertGreater(resp.cache_control.max_age, 0)
+            self.assertIn("Cookie", resp.vary)
+
+            resp = client.post(f"/users/follow/{self.u2_id}")
+            self.assertEqual(resp.cache_control.no_store, True)
+
+    def test_fingerprinted_static(self):
+        """Pages link fingerprinted static files, which are immutable"""
+
+        with self.client as client:
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn("/static/stylesheets/style.css?v=", html)
+
+            start = html.index("/static/stylesheets/style.css?v=")
+            url = html[start:html.index('"', start)]
+
+            resp = client.get(url)
+            self.assertEqual(resp.cache_control.immutable, True)
+            self.assertGreater(resp.cache_control.max_age, 86400)
+
+            # a version that isn't the file's fingerprint revalidates
+            resp = client.get("/static/stylesheets/style.css?v=made-up")
+            self.assertEqual(resp.status_code, 200)
+            self.assertFalse(resp.cache_control.immutable)
+            self.assertIsNone(resp.cache_control.max_age)
+
+    def test_profile_etag(self):
+        """The profile revalidates to 304 until the user or viewer changes"""
+
+        m = Message(text="etagged", user_id=self.u2_id)
+        db.session.add(m)
+        db.session.commit()
+        m_id = m.id
+
+        url = f"/users/{self.u2_id}"
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            # the first page may put a CSRF token in the session
+            client.get(url)
+
+            resp = client.get(url)
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+            etag = resp.headers["ETag"]
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u3_id
+
+            client.put(f"/api/messages/{m_id}/like")
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("etagged", resp.get_data(as_text=True))
+            etag = resp.headers["ETag"]
+
+            client.post(f"/users/follow/{self.u2_id}")
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_follow_lists_revalidate(self):
+        """The following page a follow form redirects to is revalidated,
+        and shows the change rather than a cached copy"""
+
+        url = f"/users/{self.u1_id}/following"
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.post(f"/users/follow/{self.u2_id}")
+
+            # the first page may put a CSRF token in the session
+            client.get(url)
+
+            resp = client.get(url)
+            self.assertIn("no-cache", resp.headers["Cache-Control"])
+            self.assertIn("<p>@u2</p>", resp.get_data(as_text=True))
+            etag = resp.headers["ETag"]
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            client.post(f"/users/stop-following/{self.u2_id}")
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("<p>@u2</p>", resp.get_data(as_text=True))
+
+            # and the other side's followers page
+            url = f"/users/{self.u2_id}/followers"
+            etag = client.get(url).headers["ETag"]
+            client.post(f"/users/follow/{self.u2_id}")
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("<p>@u1</p>", resp.get_data(as_text=True))
+
+    def test_profile_etag_covers_csrf_token(self):
+        """A new CSRF secret, or a token past half its time limit, gets a
+        fresh page rather than a 304 keeping the old token"""
+
+        url = f"/users/{self.u2_id}"
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            client.get(url)
+            etag = client.get(url).headers["ETag"]
+
+            # logging in afresh, in a new session
+            with client.session_transaction() as sess:
+                sess.clear()
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            etag = resp.headers["ETag"]
+
+            resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            later = time.time() + app.config['WTF_CSRF_TIME_LIMIT']
+            with patch('caching.time.time', return_value=later):
+                resp = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+
+class ThreadedRequestsTestCase(UserBaseViewTestCase):
+    def test_concurrent_requests(self):
+        """Requests on other threads each get their own context and
+        session, and see only their own user"""
+
+        user_ids = [self.u1_id, self.u2_id, self.u3_id, self.u4_id] * 5
+        usernames = {self.u1_id: "u1", self.u2_id: "u2",
+                     self.u3_id: "u3", self.u4_id: "u4"}
+
+        def get_homepage(user_id):
+            client = app.test_client()
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = client.get("/")
+            return resp.status_code, resp.get_data(as_text=True)
+
+        # SQL time is wall-clock, so time the threads spend waiting on
+        # each other would count against the views' budgets
+        with patch.dict(app.config, QUERY_BUDGET_STRICT=False):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                responses = list(executor.map(get_homepage, user_ids))
+
+        for user_id, (status, html) in zip(user_ids, responses):
+            self.assertEqual(status, 200)
+            self.assertIn(f"<p>@{usernames[user_id]}</p>", html)
+
+
+class QueryBudgetTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # more rows than a page, so a query per row can't fit a budget
+        for i in range(PER_PAGE + 5):
+            fan = User(username=f"fan{i}", email=f"fan{i}@email.com",
+                       password="password")
+            db.session.add(fan)
+            db.session.flush()
+
+            message = Message(text=f"warble {i}", user_id=fan.id)
+            db.session.add(message)
+            db.session.flush()
+
+            db.session.add_all([
+                Follows(user_being_followed_id=fan.id,
+                        user_following_id=self.u1_id),
+                Follows(user_being_followed_id=self.u1_id,
+                        user_following_id=fan.id),
+                Like(user_id=self.u1_id, message_id=message.id),
+            ])
+
+        db.session.commit()
+        reconcile()
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.fan_id = fan.id
+        self.message_id = message.id
+
+    def test_pages_within_budget(self):
+        """Every page stays within its query budget on a full page of rows"""
+
+        urls = [
+            "/",
+            "/users",
+            "/users?q=fan",
+            f"/users/{self.u1_id}",
+            f"/users/{self.fan_id}",
+            f"/users/{self.u1_id}/following",
+            f"/users/{self.u1_id}/followers",
+            f"/users/{self.u1_id}/likes",
+            f"/messages/{self.message_id}",
+            "/messages/search?q=warble",
+            "/api/feed",
+            "/api/users/search?q=fan",
+            "/api/messages/search?q=warble",
+            f"/api/users/{self.fan_id}",
+            f"/api/users/{self.fan_id}/messages",
+        ]
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for url in urls:
+                # a fresh session, so nothing the page needs is loaded yet
+                db.session.remove()
+
+                resp = client.get(url)
+                self.assertEqual(resp.status_code, 200, url)
+
+    def test_over_budget(self):
+        """Going over budget raises in strict mode and logs otherwise"""
+
+        homepage = app.view_functions['warbler.homepage']
+
+        with patch.object(homepage, 'query_budget', (1, None)):
+            with self.client as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.u1_id
+
+                with self.assertRaises(QueryBudgetExceeded):
+                    client.get("/")
+
+                app.config['QUERY_BUDGET_STRICT'] = False
+                try:
+                    with self.assertLogs(app.logger, 'WARNING') as logs:
+                        resp = client.get("/")
+                finally:
+                    app.config['QUERY_BUDGET_STRICT'] = True
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn("homepage ran", logs.output[0])
+
+
+class MetricsTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.clear()
+
+    def sample(self, text, series):
+        """The value of `series` in scraped `text`, or None."""
+
+        for line in text.splitlines():
+            if line.startswith(series + " "):
+                return float(line.split()[-1])
+
+        return None
+
+    def test_metrics_endpoint(self):
+        """/metrics reports requests, SQL, templates, hashing and the
+        pool by view"""
+
+        with self.client as client:
+            resp = client.post("/login", data={"username": "u1",
+                                               "password": "password"})
+            self.assertEqual(resp.status_code, 302)
+
+            client.get("/")
+            client.get("/")
+
+            resp = client.get("/metrics")
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        text = resp.get_data(as_text=True)
+
+        self.assertIn("# TYPE warbler_request_duration_seconds histogram",
+                      text)
+        self.assertEqual(self.sample(
+            text,
+            'warbler_requests_total{view="warbler.homepage",status="200"}'),
+            2)
+        self.assertEqual(self.sample(
+            text, 'warbler_request_duration_seconds_count'
+                  '{view="warbler.homepage"}'), 2)
+        self.assertEqual(self.sample(
+            text, 'warbler_request_duration_seconds_bucket'
+                  '{view="warbler.homepage",le="+Inf"}'), 2)
+        self.assertEqual(self.sample(
+            text, 'warbler_response_size_bytes_count'
+                  '{view="warbler.homepage"}'), 2)
+        self.assertGreater(self.sample(
+            text, 'warbler_sql_statements_total{view="warbler.homepage"}'),
+            0)
+        self.assertEqual(self.sample(
+            text, 'warbler_template_render_seconds_count'
+                  '{template="home.html"}'), 2)
+        self.assertEqual(self.sample(
+            text, 'warbler_password_hash_seconds_count'
+                  '{operation="check"}'), 1)
+        self.assertIsNotNone(self.sample(
+            text, 'warbler_db_pool_wait_seconds_count'))
+
+        # the first homepage loads the user; the next and /metrics hit
+        self.assertEqual(
+            self.sample(text, 'warbler_user_cache_misses_total'), 1)
+        self.assertEqual(
+            self.sample(text, 'warbler_user_cache_hits_total'), 2)
+        self.assertIsNotNone(
+            self.sample(text, 'warbler_fragment_cache_hits_total'))
+        self.assertIsNotNone(
+            self.sample(text, 'warbler_fragment_cache_misses_total'))
+
+    def test_shared_directory(self):
+        """Totals other processes wrote are added to this one's"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            shared = Metrics(directory=directory)
+            shared.inc('warbler_requests_total', ('warbler.homepage', '200'))
+            shared.observe('warbler_request_duration_seconds',
+                           ('warbler.homepage',), 0.02)
+
+            # as another process would have written them
+            with open(os.path.join(directory, "1.json"), 'w') as file:
+                json.dump(
+                    [['warbler_requests_total',
+                      ['warbler.homepage', '200'], 3],
+                     ['warbler_request_duration_seconds',
+                      ['warbler.homepage'], [0] * 13 + [1, 12.0]]],
+                    file)
+
+            text = render(shared.all_totals())
+
+        # counters without labels are there before anything is counted
+        self.assertEqual(
+            self.sample(text, 'warbler_fragment_cache_hits_total'), 0)
+
+        self.assertEqual(self.sample(
+            text,
+            'warbler_requests_total{view="warbler.homepage",status="200"}'),
+            4)
+        self.assertEqual(self.sample(
+            text, 'warbler_request_duration_seconds_bucket'
+                  '{view="warbler.homepage",le="0.025"}'), 1)
+        self.assertEqual(self.sample(
+            text, 'warbler_request_duration_seconds_count'
+                  '{view="warbler.homepage"}'), 2)
+        self.assertEqual(self.sample(
+            text, 'warbler_request_duration_seconds_sum'
+                  '{view="warbler.homepage"}'), 12.02)
+
+
+class QueryWatchTestCase(UserBaseViewTestCase):
+    def setUp(self):
+        super().setUp()
+        self.watch = app.extensions['query_watch']
+
+    def test_statement_shape(self):
+        """Shapes blank parameters and collapse IN lists"""
+
+        self.assertEqual(
+            statement_shape("SELECT * FROM users WHERE id IN "
+                            "(%(id_1_1)s, %(id_1_2)s, %(id_1_3)s) "
+                            "AND username = %(username_1)s"),
+            "SELECT * FROM users WHERE id IN (?, ...) AND username = ?")
+
+    def test_n_plus_one_names_template_line(self):
+        """A lazy load per row in a template is flagged with its line"""
+
+        u5 = User.signup("u5", "u5@email.com", "password", None)
+        db.session.flush()
+        db.session.add_all(
+            Message(text="warble", user_id=user_id)
+            for user_id in (self.u1_id, self.u2_id, self.u3_id,
+                            self.u4_id, u5.id))
+        db.session.commit()
+
+        template = app.jinja_env.from_string(
+            "{% for message in messages %}\n"
+            "{{ message.user.username }}\n"
+            "{% endfor %}")
+
+        with patch.object(self.watch, 'sample_rate', 1):
+            with app.test_request_context("/"):
+                self.watch.start_request()
+
+                # nothing loaded yet, so each author is a query
+                db.session.expunge_all()
+                template.render(messages=Message.query.all())
+
+                with self.assertLogs('warbler.queries', 'WARNING') as logs:
+                    self.watch.end_request()
+
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("5 statements from <template>:2", logs.output[0])
+        self.assertIn("FROM users", logs.output[0])
+
+    def test_unsampled_requests_unchecked(self):
+        """Requests outside the sample aren't checked"""
+
+        with patch.object(self.watch, 'sample_rate', 0):
+            with app.test_request_context("/"):
+                self.watch.start_request()
+
+                for user_id in [self.u1_id] * 10:
+                    db.session.expire_all()
+                    User.query.get(user_id)
+
+                with self.assertNoLogs('warbler.queries'):
+                    self.watch.end_request()
+
+    def test_slow_statements_explained(self):
+        """Slow SELECTs are logged with their plan from EXPLAIN ANALYZE,
+        and writes with a plain EXPLAIN"""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            with patch.object(self.watch, 'slow_ms', 0), \
+                    patch.object(self.watch, '_next_explain', {}), \
+                    self.assertLogs('warbler.queries', 'WARNING') as logs:
+                client.post(f"/users/follow/{self.u2_id}")
+                self.watch.join()
+
+        output = "\n".join(logs.output)
+
+        self.assertIn("Slow statement in warbler.start_following", output)
+        self.assertIn("EXPLAIN (ANALYZE, BUFFERS):", output)
+        self.assertIn("Execution Time", output)
+        self.assertIn("INSERT INTO follows", output)
+        self.assertIn("\nEXPLAIN:\n", output)
+
+        # the EXPLAINs were rolled back
+        self.assertEqual(Follows.query.count(), 1)
+
+
+class ReplicaRoutingTestCase(UserBaseViewTestCase):
+    """Routing with a second URL for the test database standing in for a
+    replica"""
+
+    @classmethod
+    def setUpClass(cls):
+        replica_url = os.environ['DATABASE_URL'] + "?application_name=replica"
+
+        with patch.dict(os.environ, DATABASE_REPLICA_URLS=replica_url):
+            cls.replica_app = create_app('test')
+
+    def setUp(self):
+        super().setUp()
+
+        # a session made under the other app would keep using its engine
+        db.session.remove()
+
+        context = self.replica_app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        self.addCleanup(db.session.remove)
+
+        self.client = self.replica_app.test_client()
+        self.statements = {None: 0, 'replica0': 0}
+
+        for bind in self.statements:
+            engine = db.get_engine(self.replica_app, bind=bind)
+            count = self.counter(bind)
+            event.listen(engine, 'before_cursor_execute', count)
+            self.addCleanup(event.remove, engine, 'before_cursor_execute',
+                            count)
+
+    def counter(self, bind):
+        def count(*args):
+            self.statements[bind] += 1
+
+        return count
+
+    def login(self, client, **session_values):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+            sess.update(session_values)
+
+    def test_reads_from_replica(self):
+        """GET requests read from the replica"""
+        with self.client as client:
+            self.login(client)
+
+            resp = client.get(f"/users/{self.u2_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreater(self.statements['replica0'], 0)
+            self.assertEqual(self.statements[None], 0)
+
+    def test_writes_stick_to_primary(self):
+        """Writes go to the primary, and so do the user's next reads"""
+        with self.client as client:
+            self.login(client)
+
+            resp = client.post(f"/users/follow/{self.u2_id}")
+            self.assertEqual(resp.status_code, 302)
+            self.assertGreater(self.statements[None], 0)
+            self.assertEqual(self.statements['replica0'], 0)
+
+            resp = client.get(f"/users/{self.u2_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(self.statements['replica0'], 0)
+
+            # once the sticky window is over
+            self.login(client, **{PRIMARY_UNTIL_KEY: 0})
+            before = self.statements[None]
+
+            resp = client.get(f"/users/{self.u2_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreater(self.statements['replica0'], 0)
+            self.assertEqual(self.statements[None], before)
+
+    def test_writing_select_to_primary(self):
+        """A SELECT over data-modifying CTEs goes to the primary"""
+        message = Message(text="warble", user_id=self.u2_id)
+        db.session.add(message)
+        db.session.commit()
+        message_id = message.id
+        before = self.statements[None]
+
+        db.session.info['replica'] = db.get_engine(self.replica_app,
+                                                   bind='replica0')
+        db.session.info['wrote'] = False
+
+        self.assertEqual(Like.set_liked(self.u1_id, message_id, True),
+                         (True, 1))
+        self.assertGreater(self.statements[None], before)
+        self.assertEqual(self.statements['replica0'], 0)
+        self.assertTrue(db.session.info['wrote'])
+        self.assertIsNone(db.session.info['replica'])
+
+    def test_ejected_replica(self):
+        """Reads go to the primary while the replica is ejected, and back
+        once it passes a check"""
+        replicas = self.replica_app.extensions['replicas']
+
+        with self.assertLogs(self.replica_app.logger, 'WARNING'):
+            replicas.eject('replica0', "test")
+
+        with self.client as client:
+            self.login(client)
+
+            resp = client.get(f"/users/{self.u2_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreater(self.statements[None], 0)
+            self.assertEqual(self.statements['replica0'], 0)
+
+            later = time.monotonic() + REPLICA_EJECT_SECONDS
+            with patch.object(replicas, 'clock', lambda: later):
+                resp = client.get(f"/users/{self.u2_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertGreater(self.statements['replica0'], 0)
+            self.assertEqual(replicas.stats(), {'replica0': True})
+
+    def test_unreachable_replica(self):
+        """A replica that can't be reached is ejected"""
+        with patch.dict(os.environ,
+                        DATABASE_REPLICA_URLS="postgresql://localhost:1/none"):
+            unreachable_app = create_app('test')
+
+        db.session.remove()
+
+        with unreachable_app.app_context():
+            client = unreachable_app.test_client()
+            self.login(client)
+
+            with self.assertLogs(unreachable_app.logger, 'WARNING') as logs:
+                resp = client.get(f"/users/{self.u2_id}")
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Ejecting replica replica0", logs.output[0])
+            self.assertEqual(
+                unreachable_app.extensions['replicas'].stats(),
+                {'replica0': False})
+
+            db.session.remove()
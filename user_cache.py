@@ -0,0 +1,119 @@
+"""In-process cache of logged-in users for add_user_to_g.
+
+Every request resolves the viewer from the session. Rather than a
+`User.query.get()` each time, we keep a detached snapshot of the user's
+profile fields per user id, with a TTL, and merge it into the request's
+session without touching the database.
+
+Counters and the password hash are left out of the snapshot on purpose:
+counters change on every follow and like, so they are loaded fresh (one
+query) only on the pages that show them.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy.orm import make_transient_to_detached
+
+from metrics import metrics
+
+USER_CACHE_TTL = 60
+USER_CACHE_SIZE = 10_000
+
+SNAPSHOT_FIELDS = (
+    'id',
+    'username',
+    'email',
+    'image_url',
+    'header_image_url',
+    'bio',
+    'location',
+)
+
+
+class UserCache:
+    """Thread-safe LRU of detached user snapshots, keyed by user id."""
+
+    def __init__(self, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL,
+                 clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """Get the cached snapshot for `user_id`, or None.
+
+        The snapshot is detached; merge it into a session with
+        `session.merge(snapshot, load=False)` before use.
+        """
+
+        now = self.clock()
+
+        with self._lock:
+            entry = self._entries.get(user_id)
+
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[user_id]
+                self.misses += 1
+                metrics.inc('warbler_user_cache_misses_total')
+                return None
+
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            metrics.inc('warbler_user_cache_hits_total')
+
+            return entry[1]
+
+    def put(self, user):
+        """Cache a detached copy of `user`'s profile fields."""
+
+        snapshot = type(user)(
+            **{field: getattr(user, field) for field in SNAPSHOT_FIELDS})
+        make_transient_to_detached(snapshot)
+
+        with self._lock:
+            self._entries[user.id] = (self.clock() + self.ttl, snapshot)
+            self._entries.move_to_end(user.id)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        """Forget `user_id`, e.g. after their profile changes."""
+
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        """Forget every user and reset the statistics."""
+
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Get {hits, misses, hit_rate, size} since the last clear().
+
+        /metrics reports the hits and misses as counters, which clear()
+        doesn't reset.
+        """
+
+        with self._lock:
+            lookups = self.hits + self.misses
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+            }
+
+
+user_cache = UserCache()
@@ -0,0 +1,299 @@
+"""Write-behind batching of likes and follows.
+
+Each like and follow used to be its own transaction, with its own
+commit. When a message goes viral, thousands of them a second queue on
+the same counter rows, one fsync each. With WRITE_BEHIND set, views
+hand them to this process's queue instead, and a background thread
+applies everything queued every WRITE_BEHIND_INTERVAL seconds, in one
+transaction of a few multi-row statements (Like.apply_changes and
+Follows.apply_changes).
+
+Intents are keyed by (user, target), so repeated toggles by the same
+user collapse into their final state, and a like undone before the
+flush never reaches the database. The flush computes counters from the
+rows it actually changed, so batches from several processes, or
+replaying a change already made, can't skew them.
+
+WRITE_BEHIND is one of:
+
+- 'async': the like API answers at once with the state the like will
+  have once flushed. The likes_count it reports is the database's plus
+  this process's pending changes, so concurrent likes elsewhere may
+  make it briefly off by a few. An intent that can't be applied, e.g.
+  because the message was deleted meanwhile, is logged and dropped, and
+  intents still queued are lost if the process is killed.
+- 'durable': every request waits until its batch has committed. Commits
+  are shared by every write in an interval, but none is acknowledged
+  before it is on disk.
+
+Forms redirect to a page showing the change, so they wait for the
+flush in either mode.
+
+At most WRITE_BEHIND_MAX_PENDING intents wait at once. When the queue is
+full, or a flush takes longer than WRITE_BEHIND_TIMEOUT seconds to
+confirm, callers get WriteBehindUnavailable and can answer 503.
+
+Settings come from the environment:
+
+- WRITE_BEHIND_INTERVAL: seconds between flushes (default 0.05).
+- WRITE_BEHIND_MAX_PENDING: intents queued at once (default 10000).
+- WRITE_BEHIND_TIMEOUT: seconds a caller waits (default 5).
+"""
+
+import atexit
+import os
+import threading
+
+from models import db, Follows, Like
+
+WRITE_BEHIND_INTERVAL = float(os.environ.get('WRITE_BEHIND_INTERVAL', 0.05))
+WRITE_BEHIND_MAX_PENDING = int(
+    os.environ.get('WRITE_BEHIND_MAX_PENDING', 10_000))
+WRITE_BEHIND_TIMEOUT = float(os.environ.get('WRITE_BEHIND_TIMEOUT', 5))
+
+
+class WriteBehindUnavailable(Exception):
+    """The queue is full, or a write wasn't confirmed in time."""
+
+
+class Batch:
+    """Intents applied together in one flush."""
+
+    def __init__(self):
+        # (user_id, message_id) -> liked once flushed
+        self.likes = {}
+        # (follower_id, followed_id) -> following once flushed
+        self.follows = {}
+        # message_id -> change to its likes_count once flushed
+        self.likes_counts = {}
+        self.failed = set()
+        self.done = threading.Event()
+
+    def __len__(self):
+        return len(self.likes) + len(self.follows)
+
+
+class WriteBehind:
+    """A queue of likes and follows, flushed by a background thread."""
+
+    def __init__(self, app, durable=False, interval=WRITE_BEHIND_INTERVAL,
+                 max_pending=WRITE_BEHIND_MAX_PENDING,
+                 timeout=WRITE_BEHIND_TIMEOUT):
+        self.app = app
+        self.durable = durable
+        self.interval = interval
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._batch = Batch()
+        self._flushing = None
+        self._wake = threading.Event()
+        self._pid = None
+
+        atexit.register(self._flush_at_exit)
+
+    def _start(self):
+        """Start this process's flushing thread, if it hasn't yet.
+
+        A queue inherited across fork() (e.g. from a pre-forking server's
+        master) belongs to the parent, whose thread didn't come along,
+        so the child starts afresh.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+
+            self._batch = Batch()
+            self._flushing = None
+            self._pid = os.getpid()
+
+            threading.Thread(
+                target=self._run, name='write-behind', daemon=True).start()
+
+    def like(self, user_id, message_id, liked, likes_count, wait=False):
+        """Queue liking (`liked=True`), unliking (False) or toggling
+        (None) a message for a user.
+
+        `likes_count` is the message's count as loaded. Returns
+        (is_liked, likes_count) as they will be after the flush.
+        """
+
+        self._start()
+        key = (user_id, message_id)
+
+        while True:
+            with self._lock:
+                batch = self._batch
+
+                if key not in batch.likes and len(batch) < self.max_pending:
+                    flushing = self._flushing
+                    if flushing is not None and key in flushing.likes:
+                        batch.likes[key] = flushing.likes[key]
+                    else:
+                        # a toggle needs to know what it undoes. Read under
+                        # the lock: a flush landing between the read and
+                        # the change would make the read stale, and two
+                        # quick toggles would queue the same change.
+                        batch.likes[key] = bool(
+                            Like.liked_ids(user_id, [message_id]))
+
+                if key in batch.likes:
+                    was = batch.likes[key]
+                    is_liked = not was if liked is None else liked
+                    batch.likes[key] = is_liked
+                    batch.likes_counts[message_id] = (
+                        batch.likes_counts.get(message_id, 0)
+                        + is_liked - was)
+
+                    likes_count += self._likes_count_change(message_id)
+                    break
+
+            self._wait_for_room(batch)
+
+        self._wrote()
+
+        if wait or self.durable:
+            self._wait(batch, key)
+
+        return is_liked, likes_count
+
+    def follow(self, follower_id, followed_id, following, wait=False):
+        """Queue following (`following=True`) or unfollowing (False)."""
+
+        self._start()
+        key = (follower_id, followed_id)
+
+        while True:
+            with self._lock:
+                batch = self._batch
+
+                if key in batch.follows or len(batch) < self.max_pending:
+                    batch.follows[key] = following
+                    break
+
+            self._wait_for_room(batch)
+
+        self._wrote()
+
+        if wait or self.durable:
+            self._wait(batch, key)
+
+    def _likes_count_change(self, message_id):
+        """Pending change to a message's likes_count. Hold the lock."""
+
+        return sum(batch.likes_counts.get(message_id, 0)
+                   for batch in (self._batch, self._flushing)
+                   if batch is not None)
+
+    def _wait_for_room(self, batch):
+        """Flush the full `batch` now, and wait until it's done."""
+
+        self._wake.set()
+
+        if not batch.done.wait(self.timeout):
+            raise WriteBehindUnavailable("Too many writes queued")
+
+    def _wrote(self):
+        # read this user's pages from the primary, where this is going
+        db.session.info['wrote'] = True
+
+    def _wait(self, batch, key):
+        """Wait until `batch` has committed the intent for `key`."""
+
+        if not batch.done.wait(self.timeout):
+            raise WriteBehindUnavailable("Write not confirmed in time")
+
+        if key in batch.failed:
+            raise WriteBehindUnavailable("Write failed")
+
+    def flush(self):
+        """Apply everything queued so far, and wait until it's done."""
+
+        with self._lock:
+            batch = self._batch
+
+        if batch and self._pid == os.getpid():
+            self._wake.set()
+            batch.done.wait(self.timeout)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            with self._lock:
+                if not self._batch:
+                    continue
+                batch = self._flushing = self._batch
+                self._batch = Batch()
+
+            try:
+                with self.app.app_context():
+                    self._apply(batch)
+            finally:
+                with self._lock:
+                    self._flushing = None
+                batch.done.set()
+
+    def _apply(self, batch):
+        """Apply `batch` in one transaction; if that fails, each intent
+        in its own, so that one bad intent doesn't lose the rest."""
+
+        try:
+            apply_intents(batch.likes.items(), batch.follows.items())
+            db.session.commit()
+            return
+
+        except Exception:
+            db.session.rollback()
+            self.app.logger.exception(
+                "Write-behind batch of %d failed; retrying one by one",
+                len(batch))
+
+        for key, liked in batch.likes.items():
+            self._apply_one(batch, key, [(key, liked)], [])
+
+        for key, following in batch.follows.items():
+            self._apply_one(batch, key, [], [(key, following)])
+
+    def _apply_one(self, batch, key, likes, follows):
+        try:
+            apply_intents(likes, follows)
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            batch.failed.add(key)
+            self.app.logger.exception("Write-behind dropped %s", key)
+
+    def _flush_at_exit(self):
+        self.flush()
+
+
+def apply_intents(likes, follows):
+    """Apply (key, liked) likes and (key, following) follows."""
+
+    likes = list(likes)
+    follows = list(follows)
+
+    Like.apply_changes([key for key, liked in likes if liked],
+                       [key for key, liked in likes if not liked])
+    Follows.apply_changes([key for key, following in follows if following],
+                          [key for key, following in follows
+                           if not following])
+
+
+def init_write_behind(app):
+    """Queue likes and follows if app.config['WRITE_BEHIND'] is set."""
+
+    mode = app.config['WRITE_BEHIND']
+
+    if not mode:
+        return
+
+    if mode not in ('async', 'durable'):
+        raise ValueError(f"WRITE_BEHIND must be 'async' or 'durable': {mode}")
+
+    app.extensions['write_behind'] = WriteBehind(
+        app, durable=mode == 'durable')